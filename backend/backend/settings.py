@@ -73,6 +73,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Take the write lock at BEGIN and wait for it, instead of failing with
+        # "database is locked" when concurrent requests/workers write.
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+        # A file, not the default shared-cache in-memory database, so test threads
+        # wait on the write lock like real connections do.
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
@@ -95,6 +101,19 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Log in by email or username with one indexed lookup (store/backends.py)
+AUTHENTICATION_BACKENDS = ['store.backends.EmailBackend']
+
+# PBKDF2 cost; hashes at another cost are rehashed on the next login
+PASSWORD_HASH_ITERATIONS = int(os.getenv('PASSWORD_HASH_ITERATIONS', '1000000'))
+PASSWORD_HASHERS = [
+    'store.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.2/topics/i18n/
@@ -118,7 +137,7 @@ MEDIA_URL = 'media/'
 # REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'store.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
@@ -128,6 +147,10 @@ REST_FRAMEWORK = {
         'rest_framework.filters.SearchFilter',
         'rest_framework.filters.OrderingFilter',
     ],
+    'DEFAULT_THROTTLE_CLASSES': ['store.throttling.TokenBucketThrottle'],
+    # Reverse proxies in front of Django. Anonymous rate limits key on the client
+    # address they append to X-Forwarded-For; with 0 the header is ignored.
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', 0)),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 24,
     'DEFAULT_RENDERER_CLASSES': [
@@ -143,6 +166,21 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
 }
 
+# In-process LRU of user + profile snapshots behind JWT auth (store/authentication.py)
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60  # seconds; saves in this process invalidate at once
+
+# Token buckets per view ``throttle_scope``, per user or client IP (store/throttling.py)
+THROTTLE_ENABLED = os.getenv('THROTTLE_ENABLED', '1') == '1'
+THROTTLE_SHARED = os.getenv('THROTTLE_SHARED', '0') == '1'  # buckets in the default cache, for several workers
+THROTTLE_RATES = {
+    'login': '20/min',
+    'register': '20/hour',
+    'search': '60/min',
+    'coupon': '30/min',
+    'stk_push': '10/min',
+}
+
 # CORS
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",
@@ -158,12 +196,98 @@ MPESA_CONSUMER_SECRET = os.environ.get('MPESA_CONSUMER_SECRET', '')
 MPESA_SHORTCODE = os.environ.get('MPESA_SHORTCODE', '174379')
 MPESA_PASSKEY = os.environ.get('MPESA_PASSKEY', '')
 MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL', '')
-MPESA_BASE_URL = 'https://sandbox.safaricom.co.ke'   # Change to live for production
+MPESA_BASE_URL = os.environ.get('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke')   # Change to live for production
 
 # PayPal
 PAYPAL_CLIENT_ID = os.environ.get('PAYPAL_CLIENT_ID', '')
 PAYPAL_CLIENT_SECRET = os.environ.get('PAYPAL_CLIENT_SECRET', '')
-PAYPAL_BASE_URL = 'https://api-m.sandbox.paypal.com'  # Change to live for production
+PAYPAL_BASE_URL = os.environ.get('PAYPAL_BASE_URL', 'https://api-m.sandbox.paypal.com')  # Change to live for production
+
+# Stock held for M-Pesa/PayPal orders while payment is pending (seconds)
+STOCK_RESERVATION_TTL = 15 * 60
+
+# Coupons: seconds an active-coupon snapshot is served from memory
+COUPON_CACHE_TTL = 30
+
+# Exchange rates: seconds the ExchangeRate table is served from memory
+EXCHANGE_RATE_CACHE_TTL = 300
+
+# Repricing (manage.py reprice): KES prices are rounded to a multiple of this many shillings
+KES_PRICE_ROUNDING = os.getenv('KES_PRICE_ROUNDING', '1')
+REPRICE_CHUNK_SIZE = 10000      # rows per UPDATE
+
+# Nearest pickup stations: in-memory grid index (store/geo.py)
+PICKUP_GRID_DEGREES = 0.25  # cell size, ~28km at the equator
+PICKUP_INDEX_TTL = 300  # seconds; station/county/country saves rebuild at once
+PICKUP_NEAREST_MAX = 50  # largest k
+GEOGRAPHY_BUNDLE_MAX_AGE = 300  # browser cache for /geography/bundle/ without ?v=
+
+# Delivery quotes (store/shipping.py); the defaults apply while no DeliveryZone exists
+DELIVERY_DEFAULT_FEES = {'KES': '350', 'USD': '3.00'}  # home delivery
+DELIVERY_DEFAULT_ETA_DAYS = (2, 5)
+SHIPPING_RULES_TTL = 300  # seconds; zone/rate/station saves rebuild at once
+SHIPPING_QUOTE_MAX_PAIRS = 500  # carts × destinations per batch quote request
+
+# Idempotency-Key support for order/payment POSTs
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60      # how long a completed response is replayed (seconds)
+IDEMPOTENCY_LOCK_TIMEOUT = 120          # after this an unfinished (crashed) request's key can be reused
+
+# Gateway OAuth tokens are refreshed this many seconds before they expire
+GATEWAY_TOKEN_REFRESH_MARGIN = 60
+
+# Pooled gateway HTTP clients (store/gateways.py)
+GATEWAY_POOL_SIZE = int(os.getenv('GATEWAY_POOL_SIZE', 10))        # keep-alive connections per gateway per process
+GATEWAY_CONNECT_TIMEOUT = 3.05
+GATEWAY_READ_TIMEOUT = 30
+GATEWAY_MAX_RETRIES = 2                 # idempotent calls only; STK push is never retried
+GATEWAY_RETRY_BACKOFF = 0.25            # seconds, doubled per attempt with ±50% jitter
+GATEWAY_LATENCY_LOG_INTERVAL = 300      # seconds between run_jobs' latency log lines
+
+# Background jobs (store/jobs.py, run by `manage.py run_jobs`)
+JOB_WORKER_THREADS = int(os.getenv('JOB_WORKER_THREADS', 4))
+JOB_MAX_ATTEMPTS = 5
+JOB_LEASE_SECONDS = 180                 # a running job is handed to another worker after this (crashed worker)
+JOB_RETRY_BACKOFF = 5                   # seconds, doubled per attempt with ±50% jitter...
+JOB_RETRY_MAX_BACKOFF = 300             # ...up to this
+BULK_ACTION_INLINE_MAX = 500            # admin bulk actions on more rows than this run as a background job
+BULK_UPDATE_CHUNK_SIZE = 1000           # rows per UPDATE (and per transaction) in those jobs
+
+# Admin changelists on large tables (store/paginators.py)
+ADMIN_ESTIMATED_COUNT_OVER = 100000     # unfiltered tables bigger than this show the planner's row estimate
+ADMIN_COUNT_CACHE_SECONDS = 60          # exact counts of filtered changelists are reused for this long
+
+# Recently viewed products, buffered per process and written in batches (store/tracking.py)
+RECENTLY_VIEWED_BUFFER_SIZE = 500       # flush once this many (shopper, product) views are waiting...
+RECENTLY_VIEWED_FLUSH_INTERVAL = 10     # ...or the oldest has waited this many seconds
+RECENTLY_VIEWED_KEEP = 20               # views kept per shopper; older ones are deleted on flush
+RECENTLY_VIEWED_BUFFER_MAX = 10000      # buffered views past this are dropped, e.g. while the database is down
+RECENTLY_VIEWED_FLUSH_RETRIES = 5       # failed flushes in a row before the buffered views are dropped
+
+# M-Pesa callbacks applied per transaction by `manage.py process_mpesa_callbacks`
+MPESA_CALLBACK_BATCH_SIZE = 200
+
+# reconcile_payments re-checks transactions still pending after this many minutes
+PAYMENT_RECONCILE_AFTER = int(os.getenv('PAYMENT_RECONCILE_AFTER', '15'))
+
+# Payment status watch endpoint (SSE / long-poll). Changes made in another
+# process are picked up by one poll per process every POLL_INTERVAL seconds.
+PAYMENT_STATUS_POLL_INTERVAL = float(os.getenv('PAYMENT_STATUS_POLL_INTERVAL', '2'))
+PAYMENT_STATUS_WAIT_MAX = 30        # longest long poll, seconds
+PAYMENT_STATUS_STREAM_MAX = 300     # longest SSE stream, seconds
+PAYMENT_STATUS_HEARTBEAT = 15       # SSE keep-alive comment interval, seconds
+
+# Serve the payment endpoints from store/async_views.py (needs httpx; run under ASGI, e.g. uvicorn)
+ASYNC_PAYMENT_VIEWS = os.getenv('ASYNC_PAYMENT_VIEWS', 'False') == 'True'
+
+# Cache — shared state such as gateway tokens lives here. The default is
+# per-process; point it at Redis/Memcached so all workers share one copy, e.g.
+#   CACHE_BACKEND=django.core.cache.backends.redis.RedisCache CACHE_LOCATION=redis://127.0.0.1:6379/1
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
 
 # Frontend URL (for PayPal redirect URLs)
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:5173')
@@ -181,6 +305,7 @@ LOGGING = {
     'root': {'handlers': ['console'], 'level': 'INFO'},
     'loggers': {
         'store': {'handlers': ['console'], 'level': 'DEBUG', 'propagate': False},
+        'httpx': {'level': 'WARNING'},      # one INFO line per gateway call otherwise
     },
 }
 
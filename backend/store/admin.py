@@ -1,17 +1,24 @@
+import re
+
 from django.contrib import admin
 from django.utils.html import format_html
-from django.db.models import Count, Sum
+from django.db.models import Count, OuterRef, Prefetch, Subquery, Sum
 from django.utils.text import slugify
+from django.utils import timezone
 
 from .models import (
-    Country, County, PickupStation,
+    Country, County, PickupStation, DeliveryZone, DeliveryRate,
     Category, Brand, Product, ProductVariant, ProductImage,
     ProductSpecification, Review, Banner,
     Cart, CartItem, Address, Order, OrderItem,
     MpesaTransaction, PayPalTransaction,
     UserProfile, Wishlist, RecentlyViewed,
-    Coupon, ExchangeRate,
+    Coupon, ExchangeRate, RepricingRun, BackgroundJob,
 )
+from . import bulk, jobs
+from .currency import CurrencyError
+from .paginators import EstimatedCountPaginator
+from .pricing import reprice
 
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
@@ -25,6 +32,19 @@ def thumbnail(image_field, size=60):
     return '—'
 
 
+class LargeTableMixin:
+    """
+    For changelists over tables with millions of rows: estimated counts
+    (store/paginators.py) and no second count of the whole table. These
+    admins filter by date with list_filter rather than date_hierarchy, whose
+    year links scan the table, and keep their search_fields to index-backed
+    lookups: exact (``field__exact``), case-insensitive exact (``=``) and
+    case-insensitive prefix (``^``).
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 # ── Geography ─────────────────────────────────────────────────────────────────
 
 @admin.register(Country)
@@ -57,6 +77,32 @@ class PickupStationAdmin(admin.ModelAdmin):
     list_editable = ('is_active', 'delivery_fee_kes')
 
 
+# ── Delivery ──────────────────────────────────────────────────────────────────
+
+class DeliveryRateInline(admin.TabularInline):
+    model  = DeliveryRate
+    extra  = 1
+    fields = ('delivery_type', 'max_weight_kg', 'fee_kes', 'fee_usd')
+
+
+@admin.register(DeliveryZone)
+class DeliveryZoneAdmin(admin.ModelAdmin):
+    list_display      = ('name', 'is_default', 'eta_min_days', 'eta_max_days', 'free_over_kes', 'county_count', 'is_active')
+    list_editable     = ('is_active',)
+    list_filter       = ('is_active', 'is_default')
+    search_fields     = ('name', 'counties__name')
+    filter_horizontal = ('counties',)
+    inlines           = [DeliveryRateInline]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_county_count=Count('counties'))
+
+    def county_count(self, obj):
+        return obj._county_count
+    county_count.short_description = 'Counties'
+    county_count.admin_order_field = '_county_count'
+
+
 # ── Catalogue ─────────────────────────────────────────────────────────────────
 
 @admin.register(Category)
@@ -73,11 +119,12 @@ class CategoryAdmin(admin.ModelAdmin):
     thumb.short_description = ''
 
     def product_count(self, obj):
-        return obj.products.count()
+        return obj._pc
     product_count.short_description = 'Products'
+    product_count.admin_order_field = '_pc'
 
     def get_queryset(self, request):
-        return super().get_queryset(request).annotate(_pc=Count('products'))
+        return super().get_queryset(request).select_related('parent').annotate(_pc=Count('products'))
 
 
 @admin.register(Brand)
@@ -87,13 +134,29 @@ class BrandAdmin(admin.ModelAdmin):
     search_fields = ('name',)
     prepopulated_fields = {'slug': ('name',)}
 
+    actions       = ['deactivate_catalogue']
+
     def logo_thumb(self, obj):
         return thumbnail(obj.logo, 40)
     logo_thumb.short_description = ''
 
+    def deactivate_catalogue(self, request, queryset):
+        # Brands go after their products, so a job rebuilding an "active
+        # brands" changelist still finds them.
+        label = 'Deactivate brands and their products'
+        bulk.report(self, request, label, *bulk.update(
+            Product, request, queryset, {'is_active': False},
+            through='brand', selected_changes={'is_active': False}, label=label,
+        ))
+    deactivate_catalogue.short_description = 'Deactivate selected brands and all their products'
+
     def product_count(self, obj):
-        return obj.products.count()
+        return obj._pc
     product_count.short_description = 'Products'
+    product_count.admin_order_field = '_pc'
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_pc=Count('products'))
 
 
 # ── Product inlines ───────────────────────────────────────────────────────────
@@ -130,7 +193,7 @@ class ReviewInline(admin.TabularInline):
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display  = (
         'main_thumb', 'name', 'brand', 'category',
         'price_usd', 'sale_price_usd', 'price_kes',
@@ -140,16 +203,24 @@ class ProductAdmin(admin.ModelAdmin):
     list_editable = ('is_featured', 'is_best_seller', 'is_new_arrival')
     list_filter   = (
         'is_active', 'is_featured', 'is_best_seller', 'is_new_arrival',
-        'is_amazon_choice', 'is_prime', 'condition',
-        'brand', 'category',
+        'is_amazon_choice', 'is_prime', 'condition', 'kes_price_locked',
+        'brand', 'category', 'created_at',
     )
-    search_fields = ('name', 'slug', 'sku', 'asin')
+    search_fields = ('^name', 'slug__exact', 'sku__exact', 'asin__exact')
     prepopulated_fields = {'slug': ('name',)}
     readonly_fields   = ('id', 'sku', 'asin', 'created_at', 'updated_at', 'effective_price_usd', 'discount_percent', 'average_rating', 'review_count')
     inlines           = [ProductImageInline, ProductVariantInline, ProductSpecificationInline, ReviewInline]
     save_on_top       = True
-    date_hierarchy    = 'created_at'
     ordering          = ('-created_at',)
+    actions           = [
+        'reprice_kes',
+        bulk.action('Mark as featured', is_featured=True),
+        bulk.action('Remove from featured', is_featured=False),
+        bulk.action('Mark as best seller', is_best_seller=True),
+        bulk.action('Remove best seller mark', is_best_seller=False),
+        bulk.action('Activate', is_active=True),
+        bulk.action('Deactivate', is_active=False),
+    ]
 
     fieldsets = (
         ('Identity', {
@@ -161,7 +232,7 @@ class ProductAdmin(admin.ModelAdmin):
         ('Pricing', {
             'fields': (
                 ('price_usd', 'sale_price_usd', 'effective_price_usd', 'discount_percent'),
-                ('price_kes', 'sale_price_kes'),
+                ('price_kes', 'sale_price_kes', 'kes_price_locked'),
             )
         }),
         ('Flags', {
@@ -180,30 +251,59 @@ class ProductAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_queryset(self, request):
+        # Stock and thumbnails for the whole page in two queries, not a few per row. Stock is a
+        # subquery rather than a join so the queryset (which actions also get) isn't grouped.
+        stock = (
+            ProductVariant.objects.filter(product=OuterRef('pk'), is_active=True)
+            .values('product').annotate(total=Sum('stock')).values('total')
+        )
+        return (
+            super().get_queryset(request)
+            .select_related('brand', 'category')
+            .annotate(_stock=Subquery(stock))
+            .prefetch_related('images')
+        )
+
     def main_thumb(self, obj):
-        return thumbnail(obj.main_image.image if obj.main_image else None, 48)
+        images = obj.images.all()
+        main = next((image for image in images if image.is_primary), None) or next(iter(images), None)
+        return thumbnail(main.image if main else None, 48)
     main_thumb.short_description = ''
 
+    def reprice_kes(self, request, queryset):
+        try:
+            run = reprice(queryset, user=request.user, scope=f'{queryset.count()} selected product(s)')
+        except CurrencyError as e:
+            self.message_user(request, f'{e} Add a USD→KES exchange rate first.', level='error')
+            return
+        self.message_user(
+            request, f'Repriced {run.products_updated} product(s) and {run.variants_updated} variant(s) '
+                     f'at {run.rate}; {run.products_locked} locked product(s) left as is.',
+        )
+    reprice_kes.short_description = 'Reprice KES from USD at the current rate'
+
     def stock_qty(self, obj):
-        qty = obj.stock_quantity
+        qty = obj._stock or 0
         color = '#007600' if qty > 10 else ('#e47911' if qty > 0 else '#b12704')
         return format_html('<span style="color:{};font-weight:700;">{}</span>', color, qty)
     stock_qty.short_description = 'Stock'
+    stock_qty.admin_order_field = '_stock'
 
     def in_stock_badge(self, obj):
-        if obj.in_stock:
+        if obj._stock:
             return format_html('<span style="color:#007600;">✔ In Stock</span>')
         return format_html('<span style="color:#b12704;">✘ Out</span>')
     in_stock_badge.short_description = 'Avail.'
 
 
 @admin.register(Review)
-class ReviewAdmin(admin.ModelAdmin):
+class ReviewAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display  = ('product', 'user', 'rating', 'title', 'is_approved', 'is_verified_purchase', 'helpful_votes', 'created_at')
     list_editable = ('is_approved',)
-    list_filter   = ('is_approved', 'is_verified_purchase', 'rating')
-    search_fields = ('product__name', 'user__username', 'title', 'comment')
-    date_hierarchy = 'created_at'
+    list_filter   = ('is_approved', 'is_verified_purchase', 'rating', 'created_at')
+    list_select_related = ('product', 'user')
+    search_fields = ('^product__name', 'user__username__exact', '^title')
     readonly_fields = ('created_at',)
 
 
@@ -243,6 +343,11 @@ class CartAdmin(admin.ModelAdmin):
     inlines       = [CartItemInline]
     readonly_fields = ('total_usd', 'total_kes', 'item_count')
 
+    def get_queryset(self, request):
+        # item_count and total_kes walk items.all(); prefetch them with their products and variants.
+        items = CartItem.objects.select_related('product', 'variant__product')
+        return super().get_queryset(request).select_related('user').prefetch_related(Prefetch('items', queryset=items))
+
     def total_kes_display(self, obj):
         return f'KES {obj.total_kes:,.0f}'
     total_kes_display.short_description = 'Total (KES)'
@@ -283,23 +388,30 @@ class PayPalTransactionInline(admin.TabularInline):
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display  = (
         'order_number', 'full_name', 'status_badge', 'payment_status_badge',
         'payment_method', 'total_display', 'currency',
         'delivery_type', 'created_at',
     )
-    list_filter   = ('status', 'payment_status', 'payment_method', 'delivery_type', 'currency')
-    search_fields = ('order_number', 'full_name', 'email', 'phone', 'mpesa_transaction_id', 'paypal_order_id')
+    list_filter   = ('status', 'payment_status', 'payment_method', 'delivery_type', 'currency', 'created_at')
+    # Phone numbers are matched in get_search_results().
+    search_fields = ('order_number__exact', 'mpesa_transaction_id__exact', 'paypal_order_id__exact', '=email',
+                     '^full_name')
     readonly_fields = (
         'id', 'order_number', 'created_at', 'updated_at',
         'mpesa_checkout_request_id', 'mpesa_transaction_id',
         'paypal_order_id', 'paypal_capture_id',
     )
-    date_hierarchy  = 'created_at'
     ordering        = ('-created_at',)
     inlines         = [OrderItemInline, MpesaTransactionInline, PayPalTransactionInline]
     save_on_top     = True
+    actions         = [
+        bulk.action('Mark as processing', status='processing'),
+        bulk.action('Mark as shipped', status='shipped'),
+        bulk.action('Mark as out for delivery', status='out_for_delivery'),
+        bulk.action('Mark as delivered', status='delivered'),
+    ]
 
     fieldsets = (
         ('Order Info', {
@@ -341,6 +453,19 @@ class OrderAdmin(admin.ModelAdmin):
         'refunded': '#e2e3e5', 'returned': '#e2e3e5',
     }
 
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if term.upper().startswith('AMZ-'):
+            return queryset.filter(order_number=term.upper()), False
+        # A phone number matches however it was typed at checkout: 07…, 7…, 2547… or +2547….
+        digits = re.sub(r'[\s()+-]', '', term)
+        if digits.isdigit() and len(digits) >= 9:
+            local = digits[-9:]
+            return queryset.filter(phone__in=[f'0{local}', local, f'254{local}', f'+254{local}']), False
+        if '@' in term:
+            return queryset.filter(email__iexact=term), False
+        return super().get_search_results(request, queryset, search_term)
+
     def status_badge(self, obj):
         color = self.STATUS_COLORS.get(obj.status, '#333')
         bg    = self.STATUS_BG.get(obj.status, '#eee')
@@ -362,7 +487,7 @@ class OrderAdmin(admin.ModelAdmin):
     payment_status_badge.short_description = 'Payment'
 
     def total_display(self, obj):
-        return format_html('<strong>{} {:,.2f}</strong>', obj.currency, obj.total)
+        return format_html('<strong>{} {}</strong>', obj.currency, f'{obj.total:,.2f}')
     total_display.short_description = 'Total'
 
 
@@ -414,10 +539,11 @@ class WishlistAdmin(admin.ModelAdmin):
 
 
 @admin.register(RecentlyViewed)
-class RecentlyViewedAdmin(admin.ModelAdmin):
+class RecentlyViewedAdmin(LargeTableMixin, admin.ModelAdmin):
     list_display  = ('user', 'session_key', 'product', 'viewed_at')
-    search_fields = ('user__username', 'product__name')
-    date_hierarchy = 'viewed_at'
+    list_filter   = ('viewed_at',)
+    list_select_related = ('user', 'product')
+    search_fields = ('user__username__exact', '^product__name')
 
 
 # ── Utilities ─────────────────────────────────────────────────────────────────
@@ -451,6 +577,55 @@ class ExchangeRateAdmin(admin.ModelAdmin):
     search_fields = ('from_currency', 'to_currency')
 
 
+@admin.register(RepricingRun)
+class RepricingRunAdmin(admin.ModelAdmin):
+    list_display  = ('started_at', 'scope', 'rate', 'rounding', 'products_updated', 'variants_updated',
+                     'products_locked', 'started_by', 'finished_at')
+    readonly_fields = [f.name for f in RepricingRun._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(LargeTableMixin, admin.ModelAdmin):
+    list_display  = ('kind', 'label', 'status', 'progress_bar', 'attempts', 'max_attempts', 'order', 'run_after',
+                     'created_at')
+    list_filter   = ('status', 'kind', 'created_at')
+    search_fields = ('id__exact', 'order__order_number__exact')
+    readonly_fields = ('id', 'attempts', 'locked_until', 'done', 'total', 'progress_bar', 'result', 'last_error',
+                       'created_at', 'updated_at')
+    raw_id_fields = ('user', 'order')
+    actions = ['requeue', 'cancel']
+
+    def label(self, obj):
+        return obj.payload.get('label', '') if isinstance(obj.payload, dict) else ''
+    label.short_description = 'Label'
+
+    def progress_bar(self, obj):
+        if not obj.total:
+            return '—'
+        pct = min(100, int(obj.done / obj.total * 100))
+        color = {'dead': '#b12704', 'cancelled': '#888'}.get(obj.status, '#007600')
+        return format_html(
+            '<div style="width:100px;background:#eee;border-radius:4px;overflow:hidden;">'
+            '<div style="width:{}%;background:{};height:10px;"></div></div>'
+            '<small>{}/{}</small>',
+            pct, color, obj.done, obj.total
+        )
+    progress_bar.short_description = 'Progress'
+
+    def requeue(self, request, queryset):
+        count = queryset.filter(status='dead').update(status='queued', attempts=0, run_after=timezone.now())
+        self.message_user(request, f'{count} dead job(s) requeued.')
+    requeue.short_description = 'Requeue selected dead jobs'
+
+    def cancel(self, request, queryset):
+        count = jobs.cancel(queryset)
+        self.message_user(request, f'{count} job(s) cancelled; running ones stop after their current chunk.')
+    cancel.short_description = 'Cancel selected queued or running jobs'
+
+
 # ── Admin Site Branding ───────────────────────────────────────────────────────
 
 admin.site.site_header  = 'Aamazon Kenya — Admin'
@@ -0,0 +1,244 @@
+"""
+Async versions of the payment views, for running under ASGI.
+
+They are wired in place of the sync views when ``ASYNC_PAYMENT_VIEWS`` is on
+(see urls.py) and return the same JSON bodies and status codes. Like the
+sync views, an STK push or PayPal order creation is only queued as a payment
+job (payments.py) and answered with ``202``. The PayPal capture still calls
+the gateway in the request; it awaits it with httpx and the async ORM
+rather than holding a worker thread for the round trip.
+
+``PaymentStatusWatchView`` is async-only: it streams payment status changes
+(SSE) or answers long polls, parked on events.py instead of a thread.
+
+DRF views are sync-only, so ``AsyncAPIView`` does the little of APIView these
+endpoints need: JSON parsing, JWT authentication and ``{'detail': ...}``
+errors.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import callbacks, events, gateways, jobs, payments, reservations, throttling
+from .authentication import CachedJWTAuthentication
+from .gateways import GatewayError
+from .idempotency import async_idempotent
+from .models import Order, PayPalTransaction
+from .serializers import MpesaSTKSerializer, PayPalCaptureSerializer, PayPalCreateOrderSerializer
+
+
+class AsyncAPIView(View):
+    authentication_required = True
+    throttle_scope = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token-authenticated like the DRF views, so exempt from the session CSRF check.
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        handler = getattr(self, request.method.lower(), None)
+        if request.method.lower() not in self.http_method_names or handler is None:
+            return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+        try:
+            request.data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'detail': 'JSON parse error.'}, status=400)
+        try:
+            user = await sync_to_async(CachedJWTAuthentication().authenticate)(request)
+        except AuthenticationFailed as e:
+            return JsonResponse({'detail': str(e.detail)}, status=401)
+        request.user = user[0] if user is not None else AnonymousUser()
+        if self.authentication_required and not request.user.is_authenticated:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+        if throttling.rate_for(self.throttle_scope):
+            wait = math.ceil(
+                await sync_to_async(throttling.check)(self.throttle_scope, request) if settings.THROTTLE_SHARED
+                else throttling.check(self.throttle_scope, request)
+            )
+            if wait:
+                return JsonResponse({'detail': f'Request was throttled. Expected available in {wait} seconds.'},
+                                    status=429, headers={'Retry-After': str(wait)})
+        return await handler(request, *args, **kwargs)
+
+
+# ─── M-Pesa ───────────────────────────────────────────────────────────────────
+
+class MpesaSTKPushView(AsyncAPIView):
+    http_method_names = ['post']
+    throttle_scope = 'stk_push'
+
+    @async_idempotent
+    async def post(self, request):
+        serializer = MpesaSTKSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        phone = serializer.validated_data['phone']
+        order_id = serializer.validated_data['order_id']
+        try:
+            order = await Order.objects.aget(id=order_id, user=request.user)
+        except Order.DoesNotExist:
+            return JsonResponse({'error': 'Order not found.'}, status=404)
+        job = await sync_to_async(jobs.enqueue)(payments.MPESA_STK_PUSH, {'phone': phone}, user=request.user,
+                                                order=order)
+        return JsonResponse(payments.accepted(request, job, 'Sending the M-Pesa prompt to your phone.'), status=202)
+
+
+class MpesaCallbackView(AsyncAPIView):
+    http_method_names = ['post']
+    authentication_required = False
+
+    async def post(self, request):
+        # Just store it; process_mpesa_callbacks applies the inbox in batches.
+        await callbacks.arecord(request.data)
+        return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+
+# ─── PayPal ───────────────────────────────────────────────────────────────────
+
+class PayPalCreateOrderView(AsyncAPIView):
+    http_method_names = ['post']
+
+    @async_idempotent
+    async def post(self, request):
+        serializer = PayPalCreateOrderSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        try:
+            order = await Order.objects.aget(id=serializer.validated_data['order_id'], user=request.user)
+        except Order.DoesNotExist:
+            return JsonResponse({'error': 'Order not found.'}, status=404)
+        job = await sync_to_async(jobs.enqueue)(payments.PAYPAL_CREATE_ORDER, user=request.user, order=order)
+        return JsonResponse(payments.accepted(request, job, 'Creating your PayPal order.'), status=202)
+
+
+class PayPalCaptureView(AsyncAPIView):
+    http_method_names = ['post']
+
+    async def post(self, request):
+        serializer = PayPalCaptureSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        paypal_order_id = serializer.validated_data['paypal_order_id']
+        try:
+            order = await Order.objects.aget(id=serializer.validated_data['order_id'], user=request.user)
+        except Order.DoesNotExist:
+            return JsonResponse({'error': 'Order not found.'}, status=404)
+
+        try:
+            _, data = await gateways.async_paypal_capture(paypal_order_id, request_id=f'capture-{paypal_order_id}')
+        except GatewayError as e:
+            return JsonResponse({'error': str(e)}, status=502)
+        if data.get('status') != 'COMPLETED':
+            await sync_to_async(payments.paypal_capture_failed)(order, paypal_order_id, data)
+            return JsonResponse({'error': 'Payment capture failed', 'details': data}, status=400)
+
+        capture_id = data['purchase_units'][0]['payments']['captures'][0]['id']
+        await PayPalTransaction.objects.filter(paypal_order_id=paypal_order_id).aupdate(
+            capture_id=capture_id, status='completed', raw_response=data,
+        )
+        order.payment_status = 'paid'
+        order.status = 'confirmed'
+        order.paypal_capture_id = capture_id
+        await order.asave()
+        await sync_to_async(reservations.commit)(order)
+        events.publish(order.id)
+        return JsonResponse({'status': 'success', 'capture_id': capture_id})
+
+
+# ─── Payment status (SSE / long-poll) ─────────────────────────────────────────
+
+async def _payment_status(order_id, user):
+    """Return ``(status payload, change stamp)``; the payload carries a ``version`` to send back as ``since``."""
+    order = await payments.status_queryset().aget(id=order_id, user=user)
+    status = await sync_to_async(payments.payment_status)(order)
+    body = json.dumps(status, sort_keys=True, cls=DjangoJSONEncoder).encode()
+    status['version'] = hashlib.sha1(body).hexdigest()[:16]
+    return status, payments.status_stamp(order)
+
+
+class PaymentStatusWatchView(AsyncAPIView):
+    """
+    Wait for an order's payment status to change.
+
+    * ``Accept: text/event-stream`` — Server-Sent Events: the current status
+      straight away, then one ``status`` event per change, until the payment
+      settles or ``PAYMENT_STATUS_STREAM_MAX`` seconds pass.
+    * otherwise a long poll: ``?since=<version>&timeout=<seconds>`` returns as
+      soon as the status differs from ``since`` (immediately without it), or
+      the unchanged status when the timeout runs out.
+    """
+    http_method_names = ['get']
+
+    async def get(self, request, order_id):
+        try:
+            status, stamp = await _payment_status(order_id, request.user)
+        except Order.DoesNotExist:
+            return JsonResponse({'error': 'Order not found.'}, status=404)
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            return StreamingHttpResponse(
+                self._stream(request, order_id, status, stamp), content_type='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+            )
+
+        since = request.GET.get('since')
+        try:
+            timeout = min(float(request.GET.get('timeout', 25)), settings.PAYMENT_STATUS_WAIT_MAX)
+        except ValueError:
+            return JsonResponse({'error': 'timeout must be a number of seconds.'}, status=400)
+        if since != status['version'] or payments.is_settled(status):
+            return JsonResponse(status)
+        async for status, _ in self._changes(request, order_id, status, stamp, timeout):
+            break
+        return JsonResponse(status)
+
+    async def _changes(self, request, order_id, status, stamp, timeout, heartbeat=None):
+        """
+        Yield ``(status, changed)`` each time the status changes; with
+        ``heartbeat``, also ``(status, False)`` after that many idle seconds.
+        Stops at ``timeout``.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        watcher = events.subscribe(order_id, stamp)
+        try:
+            while (remaining := deadline - loop.time()) > 0:
+                if not await watcher.wait(min(remaining, heartbeat or remaining)):
+                    if heartbeat and deadline - loop.time() > 0:
+                        yield status, False
+                    continue
+                latest, watcher.stamp = await _payment_status(order_id, request.user)
+                if latest['version'] != status['version']:
+                    status = latest
+                    yield status, True
+        finally:
+            events.unsubscribe(watcher)
+
+    async def _stream(self, request, order_id, status, stamp):
+        yield _sse(status)
+        if payments.is_settled(status):
+            return
+        async for status, changed in self._changes(request, order_id, status, stamp,
+                                                   settings.PAYMENT_STATUS_STREAM_MAX,
+                                                   heartbeat=settings.PAYMENT_STATUS_HEARTBEAT):
+            if not changed:
+                yield ': keep-alive\n\n'
+                continue
+            yield _sse(status)
+            if payments.is_settled(status):
+                return
+
+
+def _sse(status):
+    return f"event: status\nid: {status['version']}\ndata: {json.dumps(status, cls=DjangoJSONEncoder)}\n\n"
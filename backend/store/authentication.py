@@ -0,0 +1,123 @@
+"""
+JWT authentication that resolves the user without a query.
+
+simplejwt's JWTAuthentication loads the User row on every request, and
+UserSerializer then loads ``profile`` as well. ``CachedJWTAuthentication``
+takes the user id from the signed token and builds the User, with its
+profile, from an in-process LRU of row snapshots. The LRU holds up to
+``USER_CACHE_SIZE`` users for ``USER_CACHE_TTL`` seconds. A miss costs one
+query (user joined to profile).
+
+Saving or deleting a user or profile drops its snapshot (signals.py), so a
+password change or deactivation applies at once in this process. Other
+processes see it within the TTL.
+
+Each request gets fresh instances built with ``Model.from_db``, so they
+behave like loaded rows: they work as foreign keys and with ``save()`` and
+``check_password()``, and nothing mutable is shared between threads.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # str(user id) -> (expires, user values, profile values or None)
+_generation = [0]
+
+
+def _values(instance):
+    return tuple(getattr(instance, f.attname) for f in instance._meta.concrete_fields)
+
+
+def _build(model, values):
+    return model.from_db(DEFAULT_DB_ALIAS, [f.attname for f in model._meta.concrete_fields], values)
+
+
+def _load(user_id):
+    user = (
+        get_user_model()._default_manager.select_related('profile')
+        .filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    )
+    if user is None:
+        return None
+    profile = getattr(user, 'profile', None)
+    return _values(user), _values(profile) if profile is not None else None
+
+
+def _snapshot(key):
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > now:
+            _cache.move_to_end(key)
+            return entry[1:]
+        generation = _generation[0]
+    loaded = _load(key)
+    if loaded is not None:
+        with _lock:
+            # Skip storing if an invalidation raced with the load.
+            if _generation[0] == generation:
+                _cache[key] = (now + getattr(settings, 'USER_CACHE_TTL', 60), *loaded)
+                _cache.move_to_end(key)
+                while len(_cache) > getattr(settings, 'USER_CACHE_SIZE', 10000):
+                    _cache.popitem(last=False)
+    return loaded
+
+
+def cached_user(user_id):
+    """The user with ``user_id`` (and its profile) from the snapshot LRU, or None."""
+    snapshot = _snapshot(str(user_id))
+    if snapshot is None:
+        return None
+    user_values, profile_values = snapshot
+    user = _build(get_user_model(), user_values)
+    profile = None
+    if profile_values is not None:
+        from .models import UserProfile
+
+        profile = _build(UserProfile, profile_values)
+        profile._state.fields_cache['user'] = user
+    # A cached None makes ``user.profile`` raise DoesNotExist without a query.
+    user._state.fields_cache['profile'] = profile
+    return user
+
+
+def invalidate(user_id=None):
+    """Forget one user's snapshot, or all of them."""
+    with _lock:
+        _generation[0] += 1
+        if user_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(str(user_id), None)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication with users from ``cached_user()``; same checks and errors."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_('Token contained no recognizable user identification')) from e
+
+        user = cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN and (
+            validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password)
+        ):
+            raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+        return user
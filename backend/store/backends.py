@@ -0,0 +1,44 @@
+"""
+Email-or-username login in one indexed lookup.
+
+Emails are matched case-insensitively through the unique ``LOWER(email)``
+index that migration 0009 adds to auth_user (partial on ``email > ''`` so
+accounts without an email don't collide). ``users_with_email()`` repeats that
+condition so the planner can use the index.
+
+An unknown login still runs the password hasher once, so a miss takes as
+long as a wrong password and doesn't reveal which emails are registered.
+Stored hashes made at another ``PASSWORD_HASH_ITERATIONS`` cost are rehashed
+on the next successful login (store/hashers.py).
+"""
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.db.models.functions import Lower
+
+
+def users_with_email(email):
+    """Users whose email is ``email``, ignoring case (index-backed)."""
+    User = get_user_model()
+    return User._default_manager.alias(email_ci=Lower('email')).filter(
+        email_ci=(email or '').strip().lower(), email__gt='',
+    )
+
+
+class EmailBackend(ModelBackend):
+    """Authenticate with ``email=`` or ``username=`` (an email or a username)."""
+
+    def authenticate(self, request, username=None, password=None, email=None, **kwargs):
+        User = get_user_model()
+        login = email if email is not None else username or kwargs.get(User.USERNAME_FIELD)
+        if not login or password is None:
+            return None
+        user = users_with_email(login).first() if '@' in login else None
+        if user is None and email is None:
+            user = User._default_manager.filter(**{User.USERNAME_FIELD: login}).first()
+        if user is None:
+            User().set_password(password)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
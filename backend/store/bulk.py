@@ -0,0 +1,165 @@
+"""
+Bulk admin actions that scale to large selections.
+
+``action(description, **changes)`` makes an admin action that sets
+``changes`` on the selected rows. Small selections, up to
+``BULK_ACTION_INLINE_MAX`` rows, are updated in the request. Larger ones
+become an ``admin.bulk_update`` BackgroundJob, run by ``manage.py run_jobs``:
+
+* the job stores what was selected, not the rows: the ticked primary keys
+  (one changelist page at most), or for "select all" the changelist's filter
+  and search query string, which the worker turns back into the changelist
+  queryset (``selection()`` / ``selected()``);
+* rows are updated with set-based UPDATEs, ``BULK_UPDATE_CHUNK_SIZE`` at a
+  time, each chunk in its own transaction;
+* progress (``done`` / ``total``) is saved after each chunk and shown in the
+  BackgroundJob admin, where the job can also be cancelled. A cancelled job
+  stops after its current chunk and keeps the chunks already done.
+
+UPDATEs skip ``save()`` and model signals. ``auto_now`` fields are stamped
+explicitly, and changed orders wake their payment status watchers
+(events.py).
+"""
+
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin import helpers
+from django.db import transaction
+from django.http import QueryDict
+from django.test import RequestFactory
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
+from django.utils.text import slugify
+
+from . import events, jobs
+
+logger = logging.getLogger('store')
+
+BULK_UPDATE = 'admin.bulk_update'
+
+# Run after each chunk with the chunk's primary keys.
+_AFTER_CHUNK = {
+    'store.Order': lambda pks: events.publish(*pks),
+}
+
+
+def _chunks(queryset, size):
+    """Primary keys of ``queryset`` in pk order, ``size`` at a time."""
+    queryset, last = queryset.order_by('pk'), None
+    while True:
+        pks = list((queryset if last is None else queryset.filter(pk__gt=last)).values_list('pk', flat=True)[:size])
+        if pks:
+            yield pks
+        if len(pks) < size:
+            return
+        last = pks[-1]
+
+
+def selection(request, queryset):
+    """
+    JSON description of the rows an admin action was run on: the ticked
+    primary keys, or the changelist query string when "select all" was used.
+    """
+    spec = {'model': queryset.model._meta.label}
+    if request.POST.get('select_across') == '1':
+        spec['changelist'] = request.GET.urlencode()
+    else:
+        spec['pks'] = request.POST.getlist(helpers.ACTION_CHECKBOX_NAME)
+    return spec
+
+
+def selected(spec, job):
+    """The queryset ``spec`` (from selection()) describes, as ``job``'s user would see it in the changelist."""
+    model = apps.get_model(spec['model'])
+    if 'pks' in spec:
+        return model._default_manager.filter(pk__in=spec['pks'])
+    modeladmin = admin.site._registry[model]
+    url = reverse(f'admin:{model._meta.app_label}_{model._meta.model_name}_changelist')
+    request = RequestFactory().get(url, QueryDict(spec['changelist']))
+    request.user = job.user
+    return modeladmin.get_changelist_instance(request).get_queryset(request)
+
+
+def _target(model, through, rows):
+    """``model`` rows reached from the selected ``rows``: themselves, or those whose ``through`` points at them."""
+    if through is None:
+        return rows
+    return model._default_manager.filter(**{f'{through}__in': rows.values('pk')})
+
+
+def apply(queryset, changes, on_chunk=None):
+    """Set ``changes`` on the rows of ``queryset``, chunk by chunk; returns rows updated."""
+    model = queryset.model
+    manager = model._default_manager
+    stamped = [f.name for f in model._meta.concrete_fields if getattr(f, 'auto_now', False)]
+    after_chunk = _AFTER_CHUNK.get(model._meta.label)
+    done = 0
+    for pks in _chunks(queryset, settings.BULK_UPDATE_CHUNK_SIZE):
+        now = timezone.now()
+        with transaction.atomic():
+            done += manager.filter(pk__in=pks).update(**changes, **{name: now for name in stamped})
+        if after_chunk:
+            after_chunk(pks)
+        if on_chunk:
+            on_chunk(done)
+    return done
+
+
+def update(model, request, queryset, changes, *, through=None, selected_changes=None, label=''):
+    """
+    Set ``changes`` on the ``model`` rows reached from the action's
+    ``queryset`` (see _target()), then ``selected_changes`` on the selected
+    rows themselves. Runs now if there are few rows, else enqueues a job.
+    Returns (rows updated, None) or (0, job).
+    """
+    total = _target(model, through, queryset).count()
+    if total <= settings.BULK_ACTION_INLINE_MAX:
+        updated = apply(_target(model, through, queryset), changes)
+        if selected_changes:
+            apply(queryset, selected_changes)
+        return updated, None
+    job = jobs.enqueue(BULK_UPDATE, {
+        'model': model._meta.label, 'through': through, 'selection': selection(request, queryset),
+        'changes': changes, 'selected_changes': selected_changes, 'label': label,
+    }, user=request.user)
+    job.total = total
+    job.save(update_fields=['total'])
+    return 0, job
+
+
+@jobs.handler(BULK_UPDATE)
+def run_update(job):
+    payload = job.payload
+    rows = selected(payload['selection'], job)
+    target = _target(apps.get_model(payload['model']), payload['through'], rows)
+    jobs.report_progress(job, 0, target.count())
+    updated = apply(target, payload['changes'], on_chunk=lambda done: jobs.report_progress(job, done))
+    if payload['selected_changes']:
+        apply(rows, payload['selected_changes'])
+    logger.info(f"Bulk update '{payload['label']}' on {payload['model']}: {updated} row(s)")
+    return {'updated': updated}
+
+
+def report(modeladmin, request, label, updated, job):
+    """Tell the operator what happened to their selection."""
+    if job is None:
+        modeladmin.message_user(request, f'{label}: {updated} row(s) updated.')
+        return
+    url = reverse('admin:store_backgroundjob_change', args=[job.pk])
+    modeladmin.message_user(request, format_html(
+        '{}: {} rows queued as a <a href="{}">background job</a>; follow its progress there.', label, job.total, url,
+    ))
+
+
+def action(description, **changes):
+    """An admin action that sets ``changes`` on the selected rows."""
+    def bulk_action(modeladmin, request, queryset):
+        report(modeladmin, request, description, *update(queryset.model, request, queryset, changes,
+                                                         label=description))
+    bulk_action.__name__ = f"bulk_{slugify(description).replace('-', '_')}"
+    bulk_action.short_description = description
+    return bulk_action
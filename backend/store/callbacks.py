@@ -0,0 +1,174 @@
+"""
+M-Pesa callback inbox.
+
+``MpesaCallbackView`` only records what Safaricom sent: one
+``INSERT ... ON CONFLICT DO NOTHING`` into MpesaCallback, then the
+acknowledgement. The unique (CheckoutRequestID, ResultCode) constraint makes
+Safaricom's repeat deliveries no-ops, so the endpoint stays fast during
+payday bursts and a callback is never applied twice.
+
+``apply_pending()`` (run by ``manage.py process_mpesa_callbacks``) applies
+the inbox in batches. Each batch runs in one transaction: it locks the inbox
+rows and their MpesaTransaction/Order rows with ``select_for_update``, applies
+the results with bulk updates, then marks the rows processed. Watchers of the
+affected orders (events.py) are woken once it commits.
+
+* A success is applied unless the transaction already succeeded; it
+  overrides an earlier failure because the customer has been charged. A
+  success settled by an STK query result (reconcile.py, ``source``
+  ``stkpushquery``) has no receipt yet; the real callback fills it in.
+* A failure is only applied to a transaction that is still pending; it marks
+  the order's payment failed unless another push already paid it.
+* Transactions of one order share one Order instance, so a retry's success
+  and the first push's failure in one batch leave the order paid, whichever
+  comes first, and only orders left unpaid have their stock released.
+* A callback for an unknown CheckoutRequestID is marked ``unknown``. It is
+  requeued by ``requeue_unknown()`` once the STK push records the transaction.
+
+``manage.py replay_mpesa_callbacks`` requeues or imports callbacks by hand.
+"""
+
+import logging
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from . import events, reservations
+from .models import MpesaCallback, MpesaTransaction, Order
+
+logger = logging.getLogger('store')
+
+
+def _inbox_row(data, source='callback'):
+    stk = (data or {}).get('Body', {}).get('stkCallback', {})
+    checkout_request_id = stk.get('CheckoutRequestID')
+    if not checkout_request_id:
+        logger.warning(f'M-Pesa callback without a CheckoutRequestID: {data}')
+        return None
+    return MpesaCallback(checkout_request_id=checkout_request_id, result_code=str(stk.get('ResultCode', '')),
+                         source=source, payload=data)
+
+
+def record(data):
+    """Store a raw callback body; repeats of one already stored are dropped."""
+    row = _inbox_row(data)
+    if row is not None:
+        MpesaCallback.objects.bulk_create([row], ignore_conflicts=True)
+
+
+def record_many(bodies, source='callback'):
+    """record() for many bodies in one statement; returns the rows offered."""
+    rows = [row for row in (_inbox_row(body, source) for body in bodies) if row is not None]
+    MpesaCallback.objects.bulk_create(rows, ignore_conflicts=True)
+    return rows
+
+
+async def arecord(data):
+    row = _inbox_row(data)
+    if row is not None:
+        await MpesaCallback.objects.abulk_create([row], ignore_conflicts=True)
+
+
+def requeue_unknown(checkout_request_id):
+    """Re-apply callbacks that arrived before their MpesaTransaction was saved."""
+    return MpesaCallback.objects.filter(checkout_request_id=checkout_request_id, outcome='unknown').update(
+        processed_at=None, outcome='',
+    )
+
+
+def _receipt(stk):
+    items = {i['Name']: i.get('Value', '') for i in stk.get('CallbackMetadata', {}).get('Item', [])}
+    return items.get('MpesaReceiptNumber', '')
+
+
+def _apply(callback, tx, now):
+    """Apply one callback to ``tx`` in memory; returns the outcome."""
+    succeeded = callback.result_code == '0'
+    stk = callback.payload['Body']['stkCallback']
+    if tx.status == 'success' and succeeded and not tx.mpesa_receipt and _receipt(stk):
+        tx.mpesa_receipt = tx.order.mpesa_transaction_id = _receipt(stk)
+        tx.updated_at = tx.order.updated_at = now
+        return 'applied'
+    if tx.status == 'success' or (not succeeded and tx.status != 'pending'):
+        return 'duplicate'
+    tx.result_code = callback.result_code
+    tx.result_desc = stk.get('ResultDesc', '')
+    tx.updated_at = now
+    if succeeded:
+        tx.mpesa_receipt = _receipt(stk)
+        tx.status = 'success'
+        tx.order.payment_status = 'paid'
+        tx.order.status = 'confirmed'
+        tx.order.mpesa_transaction_id = tx.mpesa_receipt
+        tx.order.updated_at = now
+    else:
+        tx.status = 'failed'
+        if tx.order.payment_status != 'paid':
+            tx.order.payment_status = 'failed'
+            tx.order.updated_at = now
+    return 'applied'
+
+
+def apply_pending(batch_size=None, checkout_request_ids=None):
+    """
+    Apply up to ``batch_size`` unprocessed callbacks, only those for
+    ``checkout_request_ids`` if given; returns how many were processed.
+    """
+    batch_size = batch_size or settings.MPESA_CALLBACK_BATCH_SIZE
+    connection = connections[router.db_for_write(MpesaCallback)]
+    with transaction.atomic():
+        pending = MpesaCallback.objects.filter(processed_at__isnull=True).order_by('received_at')
+        if checkout_request_ids is not None:
+            pending = pending.filter(checkout_request_id__in=checkout_request_ids)
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)      # parallel workers take disjoint batches
+        else:
+            pending = pending.select_for_update()
+        inbox = list(pending[:batch_size])
+        if not inbox:
+            return 0
+
+        txs = {
+            tx.checkout_request_id: tx
+            for tx in MpesaTransaction.objects.select_for_update().select_related('order')
+            .filter(checkout_request_id__in={c.checkout_request_id for c in inbox}).order_by('id')
+        }
+        orders = {}
+        for tx in txs.values():
+            tx.order = orders.setdefault(tx.order_id, tx.order)
+        now = timezone.now()
+        changed = {}
+        for callback in inbox:
+            tx = txs.get(callback.checkout_request_id)
+            if tx is None:
+                logger.warning(f'M-Pesa callback for unknown tx: {callback.checkout_request_id}')
+                callback.outcome = 'unknown'
+            else:
+                callback.outcome = _apply(callback, tx, now)
+                if callback.outcome == 'applied':
+                    changed[tx.id] = tx
+            callback.processed_at = now
+
+        txs = list(changed.values())
+        paid = list({tx.order_id: tx.order for tx in txs if tx.status == 'success'}.values())
+        failed = [order for order in {tx.order_id: tx.order for tx in txs}.values() if order.payment_status == 'failed']
+        MpesaTransaction.objects.bulk_update(txs, ['result_code', 'result_desc', 'mpesa_receipt', 'status', 'updated_at'])
+        Order.objects.bulk_update(paid, ['payment_status', 'status', 'mpesa_transaction_id', 'updated_at'])
+        Order.objects.bulk_update(failed, ['payment_status', 'updated_at'])
+        for order in paid:
+            reservations.commit(order)
+        if failed:
+            reservations.release(*failed)
+        MpesaCallback.objects.bulk_update(inbox, ['processed_at', 'outcome'])
+        order_ids = [tx.order_id for tx in txs]
+        transaction.on_commit(lambda: events.publish(*order_ids))
+    return len(inbox)
+
+
+def apply_all(batch_size=None, checkout_request_ids=None):
+    """Drain the inbox (or its callbacks for ``checkout_request_ids``); returns the number processed."""
+    total = 0
+    while processed := apply_pending(batch_size, checkout_request_ids):
+        total += processed
+    return total
@@ -0,0 +1,175 @@
+"""
+Checkout — turns a user's cart into an Order as one atomic unit.
+
+Stock rows are locked in primary-key order so that concurrent checkouts
+touching the same variants always queue up in the same order. Orders paid
+through a gateway then hold their quantities as stock reservations until
+the payment resolves (store/reservations.py); the rest take them off stock
+with a guarded F() update that can never go negative, even on backends where
+SELECT ... FOR UPDATE is a no-op (SQLite).
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Prefetch
+
+from . import coupons, reservations, shipping
+from .identifiers import new_order_number
+from .models import Cart, CartItem, Order, OrderItem, ProductImage
+
+DEFERRED_PAYMENT_METHODS = ('mpesa', 'paypal')
+
+
+class CheckoutError(Exception):
+    """Raised when the cart cannot be turned into an order; rolls the checkout back."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _primary_image(product):
+    # Works off the prefetched images instead of Product.main_image,
+    # which issues a fresh query per product.
+    images = product.images.all()
+    return next((img for img in images if img.is_primary), images[0] if images else None)
+
+
+def _wanted_stock(cart_items):
+    wanted = defaultdict(int)
+    for item in cart_items:
+        if item.variant_id:
+            wanted[item.variant_id] += item.quantity
+    return wanted
+
+
+def _coupon_lines(cart_items, currency):
+    for item in cart_items:
+        yield item.product.category_id, item.subtotal_kes if currency == 'KES' else item.subtotal_usd
+
+
+def place_order(request, data):
+    """Create an Order from ``request.user``'s cart using validated ``OrderCreateSerializer`` data."""
+    currency = data.get('currency', 'USD')
+    # Taken before the transaction: inside one, the sequence row would stay
+    # locked until the order commits and every checkout would queue on it.
+    order_number = new_order_number()
+
+    with transaction.atomic():
+        # Locking the cart first serialises double-submits of the same cart
+        # and keeps the lock order (cart → variants) the same for everyone.
+        cart = Cart.objects.select_for_update().filter(user=request.user).first()
+        if cart is None:
+            raise CheckoutError('Your cart is empty.')
+
+        cart_items = list(
+            CartItem.objects.filter(cart=cart)
+            .select_related('product', 'variant__product')
+            .prefetch_related(Prefetch('product__images', queryset=ProductImage.objects.order_by('order')))
+            .order_by('id')
+        )
+        if not cart_items:
+            raise CheckoutError('Your cart is empty.')
+
+        wanted = _wanted_stock(cart_items)
+        if wanted:
+            try:
+                reservations.lock_available(wanted)
+            except reservations.InsufficientStock as e:
+                raise CheckoutError(str(e), status=409)
+
+        subtotal, weight = shipping.cart_totals(cart_items, currency)
+        try:
+            delivery = shipping.quote(
+                data.get('delivery_type', 'home'), currency, subtotal, weight,
+                county_id=data.get('shipping_county_id'), station_id=data.get('pickup_station_id'),
+            )
+        except shipping.ShippingError as e:
+            raise CheckoutError(str(e))
+        shipping_fee = delivery.fee
+
+        # Apply coupon (redeemed last, see below)
+        discount = Decimal('0')
+        coupon = None
+        if data.get('coupon_code'):
+            try:
+                coupon = coupons.get_coupon(data['coupon_code'])
+                discount, _ = coupons.compute_discount(coupon, _coupon_lines(cart_items, currency), currency)
+            except coupons.CouponError as e:
+                raise CheckoutError(str(e))
+
+        tax = subtotal * Decimal('0.16')  # 16% VAT
+        total = subtotal + shipping_fee + tax - discount
+
+        order = Order.objects.create(
+            order_number=order_number,
+            user=request.user,
+            full_name=data['full_name'],
+            email=data['email'],
+            phone=data['phone'],
+            payment_method=data['payment_method'],
+            currency=currency,
+            delivery_type=data.get('delivery_type', 'home'),
+            pickup_station_id=data.get('pickup_station_id'),
+            shipping_address=data.get('shipping_address', ''),
+            shipping_city=data.get('shipping_city', ''),
+            shipping_county_id=data.get('shipping_county_id'),
+            shipping_country_id=data.get('shipping_country_id'),
+            shipping_postal_code=data.get('shipping_postal_code', ''),
+            subtotal=subtotal,
+            shipping_fee=shipping_fee,
+            tax=tax,
+            discount=discount,
+            total=total,
+            estimated_delivery=delivery.eta_max,
+            mpesa_phone=data.get('mpesa_phone', ''),
+            notes=data.get('notes', ''),
+        )
+
+        order_items = []
+        for cart_item in cart_items:
+            product, variant = cart_item.product, cart_item.variant
+            image_url = ''
+            main_image = _primary_image(product)
+            if main_image and main_image.image:
+                try:
+                    image_url = request.build_absolute_uri(main_image.image.url)
+                except Exception:
+                    pass
+            order_items.append(OrderItem(
+                order=order,
+                product=product,
+                variant=variant,
+                product_name=product.name,
+                variant_name=variant.name if variant else '',
+                sku=variant.sku if variant else product.sku,
+                image_url=image_url,
+                price=cart_item.unit_price_kes if currency == 'KES' else cart_item.unit_price_usd,
+                quantity=cart_item.quantity,
+                currency=currency,
+            ))
+        OrderItem.objects.bulk_create(order_items)
+
+        # Gateway payments hold the stock until the payment resolves;
+        # everything else takes it straight away.
+        if wanted and order.payment_method in DEFERRED_PAYMENT_METHODS:
+            reservations.hold(order, wanted)
+        elif wanted:
+            try:
+                reservations.take(wanted)
+            except reservations.InsufficientStock as e:
+                raise CheckoutError(str(e), status=409)
+
+        CartItem.objects.filter(cart=cart).delete()
+
+        # The usage counter is the most contended row in a flash sale, so it is
+        # bumped last to hold its lock for as short a time as possible.
+        if coupon is not None:
+            try:
+                coupons.redeem(coupon)
+            except coupons.CouponError as e:
+                raise CheckoutError(str(e))
+
+    return order
@@ -0,0 +1,153 @@
+"""
+Coupon engine shared by CouponValidateView and checkout.
+
+Active coupons (and the category ids each one applies to, expanded down the
+category tree) are kept in a small in-process cache that is rebuilt every
+``COUPON_CACHE_TTL`` seconds or when a Coupon/Category changes, so looking a
+code up costs no queries. Redemption is a single conditional UPDATE that only
+succeeds while ``used_count < max_uses``, which keeps a flash-sale burst from
+over-redeeming a limited coupon without holding locks.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .currency import CurrencyError, convert
+from .models import Category, Coupon
+
+CENT = Decimal('0.01')
+
+_lock = threading.Lock()
+_cache = {'expires': 0.0, 'coupons': {}}
+
+
+class CouponError(Exception):
+    """The coupon cannot be applied; the message is safe to show to the shopper."""
+
+
+class ActiveCoupon:
+    """Cached snapshot of a Coupon plus the category ids it is restricted to (None = all)."""
+
+    __slots__ = ('id', 'code', 'description', 'discount_type', 'discount_value',
+                 'min_order_value', 'max_uses', 'used_count', 'valid_from', 'valid_until',
+                 'category_ids')
+
+    def __init__(self, coupon, category_ids):
+        for field in self.__slots__[:-1]:
+            setattr(self, field, getattr(coupon, field))
+        self.category_ids = category_ids
+
+    def applies_to(self, category_id):
+        return self.category_ids is None or category_id in self.category_ids
+
+
+def _descendants(roots, children):
+    seen, stack = set(), list(roots)
+    while stack:
+        cat_id = stack.pop()
+        if cat_id not in seen:
+            seen.add(cat_id)
+            stack.extend(children.get(cat_id, ()))
+    return frozenset(seen)
+
+
+def _load():
+    children = defaultdict(list)
+    for cat_id, parent_id in Category.objects.values_list('id', 'parent_id'):
+        if parent_id:
+            children[parent_id].append(cat_id)
+
+    coupons = {}
+    qs = Coupon.objects.filter(is_active=True, valid_until__gte=timezone.now()).prefetch_related('categories')
+    for coupon in qs:
+        roots = [c.id for c in coupon.categories.all()]
+        coupons[coupon.code.upper()] = ActiveCoupon(coupon, _descendants(roots, children) if roots else None)
+    return coupons
+
+
+def _active_coupons():
+    now = time.monotonic()
+    if _cache['expires'] > now:
+        return _cache['coupons']
+    with _lock:
+        if _cache['expires'] <= now:
+            _cache['coupons'] = _load()
+            _cache['expires'] = now + getattr(settings, 'COUPON_CACHE_TTL', 30)
+    return _cache['coupons']
+
+
+def invalidate():
+    _cache['expires'] = 0.0
+
+
+def get_coupon(code):
+    """Return the ActiveCoupon for ``code`` or raise CouponError."""
+    coupon = _active_coupons().get((code or '').strip().upper())
+    now = timezone.now()
+    if coupon is None or not (coupon.valid_from <= now <= coupon.valid_until):
+        raise CouponError('Invalid or expired coupon code.')
+    if coupon.max_uses is not None and coupon.used_count >= coupon.max_uses:
+        raise CouponError('Coupon has reached its usage limit.')
+    return coupon
+
+
+def compute_discount(coupon, lines, currency):
+    """
+    Work out the discount for ``lines`` — an iterable of ``(category_id, line_total)``
+    in ``currency``. Returns ``(total_discount, per_line_discounts)``.
+
+    Only lines in the coupon's categories (or their subcategories) are
+    discounted, and the minimum order value is checked against those lines.
+    Fixed-amount coupons are converted to ``currency`` at the current rate
+    and spread across the eligible lines in proportion to their totals.
+    """
+    lines = [(category_id, Decimal(amount)) for category_id, amount in lines]
+    eligible = [amount if coupon.applies_to(category_id) else None for category_id, amount in lines]
+    eligible_total = sum((a for a in eligible if a is not None), Decimal('0'))
+    if not eligible_total:
+        raise CouponError('This coupon does not apply to any items in your cart.')
+    if eligible_total < coupon.min_order_value:
+        raise CouponError(f'Minimum order value for this coupon is {coupon.min_order_value}.')
+
+    if coupon.discount_type == 'percent':
+        rate = coupon.discount_value / 100
+        per_line = [(a * rate).quantize(CENT, ROUND_HALF_UP) if a is not None else Decimal('0') for a in eligible]
+        return sum(per_line, Decimal('0')), per_line
+
+    try:
+        value = convert(coupon.discount_value, coupon.discount_type.removeprefix('fixed_'), currency)
+    except CurrencyError:
+        return Decimal('0'), [Decimal('0')] * len(lines)
+
+    total = min(value, eligible_total)
+    per_line, remaining = [], total
+    last = max(i for i, a in enumerate(eligible) if a is not None)
+    for i, amount in enumerate(eligible):
+        if amount is None:
+            share = Decimal('0')
+        elif i == last:
+            share = remaining
+        else:
+            share = (total * amount / eligible_total).quantize(CENT, ROUND_HALF_UP)
+        remaining -= share
+        per_line.append(share)
+    return total, per_line
+
+
+def redeem(coupon):
+    """Atomically count one use of ``coupon``; raises CouponError once it is used up."""
+    updated = Coupon.objects.filter(
+        Q(max_uses__isnull=True) | Q(used_count__lt=F('max_uses')),
+        pk=coupon.id, is_active=True,
+    ).update(used_count=F('used_count') + 1)
+    if not updated:
+        if coupon.max_uses is not None:
+            # Fail fast for the rest of this worker's burst until the cache refreshes.
+            coupon.used_count = coupon.max_uses
+        raise CouponError('Coupon has reached its usage limit.')
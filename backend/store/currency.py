@@ -0,0 +1,83 @@
+"""
+Currency conversion shared by payments, checkout and pricing.
+
+All ExchangeRate rows are kept in a small in-process map that is loaded with
+one query and rebuilt every ``EXCHANGE_RATE_CACHE_TTL`` seconds or when an
+ExchangeRate changes (signals.py), so converting costs no queries.
+Conversions stay in Decimal end to end and are rounded once, half-up, to the
+requested places.
+
+A pair without its own row falls back to the inverse of the opposite row,
+then to a cross rate through one intermediate currency (EUR → KES → USD).
+"""
+
+import threading
+import time
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+
+CENT = Decimal('0.01')
+ONE = Decimal('1')
+
+_lock = threading.Lock()
+_cache = {'expires': 0.0, 'rates': {}, 'rows': []}
+
+
+class CurrencyError(Exception):
+    """No rate is known for the pair."""
+
+
+def _load():
+    from .models import ExchangeRate
+
+    rows = list(ExchangeRate.objects.order_by('from_currency', 'to_currency'))
+    return rows, {(row.from_currency.upper(), row.to_currency.upper()): row.rate for row in rows}
+
+
+def _snapshot():
+    now = time.monotonic()
+    if _cache['expires'] <= now:
+        with _lock:
+            if _cache['expires'] <= now:
+                _cache['rows'], _cache['rates'] = _load()
+                _cache['expires'] = now + getattr(settings, 'EXCHANGE_RATE_CACHE_TTL', 300)
+    return _cache
+
+
+def invalidate():
+    _cache['expires'] = 0.0
+
+
+def rows():
+    """Cached ExchangeRate rows, for ExchangeRateView."""
+    return _snapshot()['rows']
+
+
+def _direct(rates, source, target):
+    if (source, target) in rates:
+        return rates[source, target]
+    if rates.get((target, source)):
+        return ONE / rates[target, source]
+    return None
+
+
+def rate(source, target):
+    """Units of ``target`` per unit of ``source``; raises CurrencyError if unknown."""
+    source, target = source.upper(), target.upper()
+    if source == target:
+        return ONE
+    rates = _snapshot()['rates']
+    direct = _direct(rates, source, target)
+    if direct is not None:
+        return direct
+    for via in sorted({c for pair in rates for c in pair} - {source, target}):
+        first, second = _direct(rates, source, via), _direct(rates, via, target)
+        if first is not None and second is not None:
+            return first * second
+    raise CurrencyError(f'No exchange rate from {source} to {target}.')
+
+
+def convert(amount, source, target, places=CENT):
+    """``amount`` in ``source`` expressed in ``target``, rounded half-up to ``places``."""
+    return (Decimal(amount) * rate(source, target)).quantize(places, ROUND_HALF_UP)
@@ -0,0 +1,117 @@
+"""
+Payment status change notifications for the watch endpoint
+(``PaymentStatusWatchView``: SSE or long-poll).
+
+A shopper waiting on a payment subscribes a ``Watcher`` for their order and
+sleeps until it is woken. Watchers are woken in two ways:
+
+* ``publish(order_id, ...)`` — called in-process wherever payment state
+  changes (callback inbox, payment jobs, PayPal capture). Instant, but it only
+  reaches watchers in the same process.
+* the poller — one daemon thread per process, running only while someone is
+  watching. Every ``PAYMENT_STATUS_POLL_INTERVAL`` seconds it reads the change
+  stamps of *all* watched orders in one query and wakes the watchers whose
+  stamp moved. This covers changes made by other processes (the callback
+  worker, other web workers). N shoppers waiting cost one query per interval
+  instead of N polls per interval.
+
+A woken watcher re-reads the order; spurious wake-ups are harmless.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+
+logger = logging.getLogger('store')
+
+_lock = threading.Lock()
+_watchers = defaultdict(set)    # order id -> {Watcher}
+_poller = {'thread': None}
+
+
+class Watcher:
+    """One waiting request. ``stamp`` is the order's change stamp as that request last saw it."""
+
+    def __init__(self, order_id, stamp):
+        self.order_id = order_id
+        self.stamp = stamp
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def wake(self):
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout):
+        """Sleep until woken or ``timeout``; returns True if woken."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+
+def subscribe(order_id, stamp):
+    watcher = Watcher(order_id, stamp)
+    with _lock:
+        _watchers[order_id].add(watcher)
+        if _poller['thread'] is None:
+            _poller['thread'] = threading.Thread(target=_poll_forever, name='payment-status-poller', daemon=True)
+            _poller['thread'].start()
+    return watcher
+
+
+def unsubscribe(watcher):
+    with _lock:
+        watchers = _watchers.get(watcher.order_id)
+        if watchers is not None:
+            watchers.discard(watcher)
+            if not watchers:
+                del _watchers[watcher.order_id]
+
+
+def publish(*order_ids):
+    """Wake everyone in this process watching any of ``order_ids``."""
+    with _lock:
+        woken = [w for order_id in order_ids for w in _watchers.get(order_id, ())]
+    for watcher in woken:
+        watcher.wake()
+
+
+def poll_once():
+    """Wake watchers whose order changed since they last looked; returns how many were woken."""
+    from .payments import status_queryset
+
+    with _lock:
+        watched = {order_id: list(watchers) for order_id, watchers in _watchers.items()}
+    if not watched:
+        return 0
+    stamps = {
+        order_id: (updated_at, job_updated_at)
+        for order_id, updated_at, job_updated_at in status_queryset()
+        .filter(id__in=watched).values_list('id', 'updated_at', 'payment_job_updated_at')
+    }
+    woken = [w for order_id, watchers in watched.items() for w in watchers if w.stamp != stamps.get(order_id)]
+    for watcher in woken:
+        watcher.wake()
+    return len(woken)
+
+
+def _poll_forever():
+    while True:
+        time.sleep(settings.PAYMENT_STATUS_POLL_INTERVAL)
+        with _lock:
+            if not _watchers:
+                _poller['thread'] = None
+                break
+        close_old_connections()
+        try:
+            poll_once()
+        except DatabaseError:
+            logger.exception('Payment status poll failed')
+    connection.close()
@@ -0,0 +1,225 @@
+"""
+Local stand-ins for the Safaricom Daraja and PayPal APIs, for benchmarks and
+tests. One server answers both gateways, so point ``MPESA_BASE_URL`` and
+``PAYPAL_BASE_URL`` at ``StubGateway.url``.
+
+Implemented endpoints (happy path only):
+
+* ``GET  /oauth/v1/generate``                    M-Pesa OAuth
+* ``POST /mpesa/stkpush/v1/processrequest``      STK push
+* ``POST /mpesa/stkpushquery/v1/query``          STK push status query
+* ``POST /v1/oauth2/token``                      PayPal OAuth
+* ``POST /v2/checkout/orders``                   PayPal create order
+* ``GET  /v2/checkout/orders/<id>``              PayPal order details
+* ``POST /v2/checkout/orders/<id>/capture``      PayPal capture
+
+``stk_results`` (CheckoutRequestID -> ResultCode) decides what the STK query
+reports; a push without an entry is still "being processed".
+``paypal_orders`` (order id -> status) holds the PayPal orders the stub knows
+about: created ones start ``CREATED``, set ``APPROVED`` to play the buyer.
+
+Knobs, all off by default:
+
+* ``latency`` — seconds slept before every non-OAuth response, standing in
+  for the real gateways' round trip.
+* ``error_rate`` — share of non-OAuth calls answered ``503``.
+* ``callbacks`` — after each STK push, POST the result to the push's
+  ``CallBackURL`` ``callback_delay`` seconds later, like Safaricom once the
+  shopper answers the prompt. ``failure_rate`` of them are cancellations
+  (ResultCode 1032); the STK query reports the same result.
+* ``auto_approve`` — PayPal orders start ``APPROVED``, as if the buyer had
+  clicked through the approval page.
+
+``manage.py run_stub_gateway`` serves one from the command line.
+"""
+
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('store')
+
+CAPTURE_PATH = re.compile(r'^/v2/checkout/orders/(?P<id>[^/]+)/capture$')
+ORDER_PATH = re.compile(r'^/v2/checkout/orders/(?P<id>[^/]+)$')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024       # the default backlog of 5 drops connections under load
+
+
+class StubGateway:
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, error_rate=0.0, callbacks=False, callback_delay=1.0,
+                 failure_rate=0.0, auto_approve=False):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.callbacks = callbacks
+        self.callback_delay = callback_delay
+        self.failure_rate = failure_rate
+        self.auto_approve = auto_approve
+        self.hits = {}
+        self.stk_results = {}
+        self.paypal_orders = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub._handle(self, 'GET')
+
+            def do_POST(self):
+                stub._handle(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server((host, port), Handler)
+        self.url = f'http://{host}:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ── Routing ──────────────────────────────────────────────────────────────
+
+    def _next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def _count(self, name):
+        with self._lock:
+            self.hits[name] = self.hits.get(name, 0) + 1
+
+    def _handle(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        raw = handler.rfile.read(length) if length else b''
+        body = json.loads(raw) if 'json' in handler.headers.get('Content-Type', '') and raw else {}
+        path = handler.path.split('?')[0]
+
+        if path in ('/oauth/v1/generate', '/v1/oauth2/token'):
+            self._count('oauth')
+            return self._send(handler, 200, {'access_token': f'stub-token-{self._next_id()}', 'expires_in': '3599'})
+
+        time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self._count('errors')
+            return self._send(handler, 503, {'errorCode': '503.001.01', 'errorMessage': 'Service unavailable (stub)'})
+        if method == 'POST' and path == '/mpesa/stkpush/v1/processrequest':
+            self._count('stkpush')
+            n = self._next_id()
+            checkout_id = f'ws_CO_stub_{n}'
+            self._send(handler, 200, {
+                'MerchantRequestID': f'stub-merchant-{n}',
+                'CheckoutRequestID': checkout_id,
+                'ResponseCode': '0',
+                'ResponseDescription': 'Success. Request accepted for processing',
+                'CustomerMessage': 'Success. Request accepted for processing',
+                'AccountReference': body.get('AccountReference', ''),
+            })
+            if self.callbacks and body.get('CallBackURL'):
+                timer = threading.Timer(self.callback_delay, self._call_back,
+                                        (body['CallBackURL'], f'stub-merchant-{n}', checkout_id, body.get('Amount', 1)))
+                timer.daemon = True
+                timer.start()
+            return
+        if method == 'POST' and path == '/mpesa/stkpushquery/v1/query':
+            self._count('stkquery')
+            checkout_id = body.get('CheckoutRequestID', '')
+            if checkout_id not in self.stk_results:
+                return self._send(handler, 500, {
+                    'requestId': f'stub-{self._next_id()}',
+                    'errorCode': '500.001.1001',
+                    'errorMessage': 'The transaction is being processed',
+                })
+            result_code = str(self.stk_results[checkout_id])
+            return self._send(handler, 200, {
+                'ResponseCode': '0',
+                'ResponseDescription': 'The service request has been accepted successsfully',
+                'MerchantRequestID': f'stub-merchant-{checkout_id}',
+                'CheckoutRequestID': checkout_id,
+                'ResultCode': result_code,
+                'ResultDesc': 'The service request is processed successfully.' if result_code == '0'
+                else 'Request cancelled by user',
+            })
+        if method == 'POST' and path == '/v2/checkout/orders':
+            self._count('orders.create')
+            order_id = f'STUB{self._next_id():012d}'
+            self.paypal_orders[order_id] = 'APPROVED' if self.auto_approve else 'CREATED'
+            return self._send(handler, 201, {
+                'id': order_id,
+                'status': 'CREATED',
+                'links': [{'rel': 'approve', 'href': f'{self.url}/checkoutnow?token={order_id}'}],
+            })
+        match = ORDER_PATH.match(path)
+        if method == 'GET' and match:
+            self._count('orders.get')
+            status = self.paypal_orders.get(match['id'])
+            if status is None:
+                return self._send(handler, 404, {'name': 'RESOURCE_NOT_FOUND', 'message': 'Order not found'})
+            order = {'id': match['id'], 'status': status}
+            if status == 'COMPLETED':
+                order['purchase_units'] = [{'payments': {'captures': [{'id': f"CAP-{match['id']}"}]}}]
+            return self._send(handler, 200, order)
+        match = CAPTURE_PATH.match(path)
+        if method == 'POST' and match:
+            self._count('orders.capture')
+            self.paypal_orders[match['id']] = 'COMPLETED'
+            return self._send(handler, 201, {
+                'id': match['id'],
+                'status': 'COMPLETED',
+                'purchase_units': [{'payments': {'captures': [{'id': f"CAP-{match['id']}"}]}}],
+            })
+        self._send(handler, 404, {'error': f'No stub for {method} {path}'})
+
+    def _call_back(self, url, merchant_request_id, checkout_id, amount):
+        result_code = 1032 if self.failure_rate and random.random() < self.failure_rate else 0
+        self.stk_results[checkout_id] = result_code
+        stk = {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_id,
+            'ResultCode': result_code,
+            'ResultDesc': 'The service request is processed successfully.' if result_code == 0
+            else 'Request cancelled by user',
+        }
+        if result_code == 0:
+            stk['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': amount},
+                {'Name': 'MpesaReceiptNumber', 'Value': f'STUB{self._next_id():06d}'},
+            ]}
+        request = urllib.request.Request(url, data=json.dumps({'Body': {'stkCallback': stk}}).encode(),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+            self._count('callbacks')
+        except OSError as e:
+            self._count('callback_errors')
+            logger.warning(f'Stub callback to {url} failed: {e}')
+
+    @staticmethod
+    def _send(handler, status, payload):
+        body = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
@@ -0,0 +1,519 @@
+"""
+Payment gateway plumbing shared by the M-Pesa and PayPal views.
+
+HTTP clients
+------------
+``mpesa_client`` and ``paypal_client`` keep one pooled keep-alive
+``requests.Session`` per worker process, so calls reuse TCP/TLS connections
+instead of handshaking every time. Connect and read timeouts are separate
+(``GATEWAY_CONNECT_TIMEOUT`` / ``GATEWAY_READ_TIMEOUT``). Calls that are safe
+to repeat (GETs, token requests, PayPal calls carrying a ``PayPal-Request-Id``)
+are retried on connection errors and 502/503/504 with jittered exponential
+backoff; an STK push is never retried. Every call is timed into a
+per-endpoint latency histogram (``latency_snapshot()``).
+``async_paypal_client`` does the same over httpx for the async PayPal
+capture view.
+
+OAuth tokens
+------------
+``mpesa_tokens`` and ``paypal_tokens`` hand out client-credentials tokens and
+only go back to the gateway shortly before ``expires_in`` runs out
+(``GATEWAY_TOKEN_REFRESH_MARGIN``). A token is looked up in this order:
+
+1. the manager's in-process copy (no I/O at all);
+2. the Django cache, so every worker process shares one token;
+3. the gateway — single-flight: threads in this process wait on a lock and
+   other processes wait on a short cache lock while one caller refreshes.
+"""
+
+import asyncio
+import base64
+import bisect
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+import weakref
+from datetime import datetime
+
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from django.conf import settings
+from django.core.cache import cache
+
+from .currency import convert
+
+logger = logging.getLogger('store')
+
+
+class GatewayError(Exception):
+    """
+    A payment gateway could not be reached or returned something unusable.
+    ``retryable`` is True when sending the call again cannot duplicate it:
+    the call is idempotent, or it certainly never reached the gateway.
+    """
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _never_sent(exc):
+    """True if a requests/httpx error happened before any byte reached the gateway."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+# ── Latency histograms ────────────────────────────────────────────────────────
+
+class LatencyHistogram:
+    BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)     # last bucket is +Inf
+        self.total_ms = 0.0
+        self.errors = 0
+
+    def observe(self, ms, error=False):
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.total_ms += ms
+        self.errors += error
+
+    def snapshot(self):
+        calls = sum(self.counts)
+        labels = [f'<={b}ms' for b in self.BUCKETS_MS] + ['+Inf']
+        return {
+            'calls': calls,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / calls, 1) if calls else 0,
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def _observe(endpoint, ms, error):
+    with _histograms_lock:
+        _histograms.setdefault(endpoint, LatencyHistogram()).observe(ms, error)
+
+
+def latency_snapshot():
+    """Per-endpoint latency histograms for this worker process."""
+    with _histograms_lock:
+        return {endpoint: h.snapshot() for endpoint, h in sorted(_histograms.items())}
+
+
+def log_latency():
+    """Log one line per endpoint from latency_snapshot() (``run_jobs`` does so periodically)."""
+    for endpoint, h in latency_snapshot().items():
+        logger.info(f"Gateway latency {endpoint}: {h['calls']} calls, {h['errors']} errors, avg {h['avg_ms']}ms, "
+                    + ' '.join(f'{label}={n}' for label, n in h['buckets'].items() if n))
+
+
+# ── Pooled HTTP clients ───────────────────────────────────────────────────────
+
+RETRY_STATUSES = (502, 503, 504)
+
+
+class GatewayClient:
+    """Keep-alive HTTP client for one gateway; one pooled session per worker process."""
+
+    def __init__(self, name, base_url):
+        self.name = name
+        self._base_url = base_url       # () -> base URL, read from settings at call time
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    pool_size = getattr(settings, 'GATEWAY_POOL_SIZE', 10)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+                    session = requests.Session()
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def _timeout(self):
+        return (
+            getattr(settings, 'GATEWAY_CONNECT_TIMEOUT', 3.05),
+            getattr(settings, 'GATEWAY_READ_TIMEOUT', 30),
+        )
+
+    def _backoff(self, attempt):
+        base = getattr(settings, 'GATEWAY_RETRY_BACKOFF', 0.25)
+        return base * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _plan(self, method, path, endpoint, idempotent):
+        """Return ``(histogram name, url, idempotent, attempts)`` for a call."""
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        attempts = 1 + (getattr(settings, 'GATEWAY_MAX_RETRIES', 2) if idempotent else 0)
+        return f'{self.name}:{endpoint or path}', f'{self._base_url()}{path}', idempotent, attempts
+
+    def request(self, method, path, endpoint=None, idempotent=None, **kwargs):
+        """
+        Send a request to ``path`` on this gateway. ``endpoint`` names the
+        histogram (defaults to the path). ``idempotent`` defaults to True
+        for GET/HEAD only. Raises GatewayError if no response could be had.
+        """
+        endpoint, url, idempotent, attempts = self._plan(method, path, endpoint, idempotent)
+        kwargs.setdefault('timeout', self._timeout())
+
+        for attempt in range(attempts):
+            started = time.perf_counter()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                _observe(endpoint, (time.perf_counter() - started) * 1000, error=True)
+                if attempt + 1 >= attempts:
+                    raise GatewayError(f'{self.name} {endpoint} failed: {e}', idempotent or _never_sent(e))
+            else:
+                retry = r.status_code in RETRY_STATUSES and attempt + 1 < attempts
+                _observe(endpoint, (time.perf_counter() - started) * 1000, error=r.status_code >= 500)
+                if not retry:
+                    return r
+            logger.info(f'Retrying {endpoint} (attempt {attempt + 2}/{attempts})')
+            time.sleep(self._backoff(attempt))
+
+    def authorized(self, tokens, method, path, **kwargs):
+        """Like request(), with a bearer token; a 401 refreshes the token and tries once more."""
+        headers = kwargs.pop('headers', {})
+        for retry in (False, True):
+            r = self.request(method, path, headers={**headers, 'Authorization': f'Bearer {tokens.get_token()}'}, **kwargs)
+            if r.status_code != 401 or retry:
+                return r
+            tokens.invalidate()
+
+
+class AsyncGatewayClient(GatewayClient):
+    """
+    httpx counterpart of GatewayClient for the async views. An AsyncClient is
+    bound to the event loop it was created on, so one is kept per loop.
+    """
+
+    def __init__(self, name, base_url):
+        super().__init__(name, base_url)
+        self._clients = weakref.WeakKeyDictionary()     # event loop -> httpx.AsyncClient
+
+    @property
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            import httpx
+
+            connect, read = self._timeout()
+            pool_size = getattr(settings, 'GATEWAY_POOL_SIZE', 10)
+            client = self._clients[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=pool_size * 10, max_keepalive_connections=pool_size),
+            )
+        return client
+
+    async def request(self, method, path, endpoint=None, idempotent=None, **kwargs):
+        import httpx
+
+        endpoint, url, idempotent, attempts = self._plan(method, path, endpoint, idempotent)
+        for attempt in range(attempts):
+            started = time.perf_counter()
+            try:
+                r = await self.client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                _observe(endpoint, (time.perf_counter() - started) * 1000, error=True)
+                if attempt + 1 >= attempts:
+                    raise GatewayError(f'{self.name} {endpoint} failed: {e}', idempotent or _never_sent(e))
+            else:
+                retry = r.status_code in RETRY_STATUSES and attempt + 1 < attempts
+                _observe(endpoint, (time.perf_counter() - started) * 1000, error=r.status_code >= 500)
+                if not retry:
+                    return r
+            logger.info(f'Retrying {endpoint} (attempt {attempt + 2}/{attempts})')
+            await asyncio.sleep(self._backoff(attempt))
+
+    async def authorized(self, tokens, method, path, **kwargs):
+        headers = kwargs.pop('headers', {})
+        for retry in (False, True):
+            # The token is almost always in memory; a refresh runs on the pooled sync client in a thread.
+            token = await sync_to_async(tokens.get_token, thread_sensitive=False)()
+            r = await self.request(method, path, headers={**headers, 'Authorization': f'Bearer {token}'}, **kwargs)
+            if r.status_code != 401 or retry:
+                return r
+            tokens.invalidate()
+
+
+mpesa_client = GatewayClient('mpesa', lambda: settings.MPESA_BASE_URL)
+paypal_client = GatewayClient('paypal', lambda: settings.PAYPAL_BASE_URL)
+async_paypal_client = AsyncGatewayClient('paypal', lambda: settings.PAYPAL_BASE_URL)
+
+
+class TokenManager:
+    lock_timeout = 10       # seconds another process may spend refreshing before we give up waiting
+
+    def __init__(self, name, fetch, identity):
+        self.name = name
+        self._fetch = fetch             # () -> (access_token, expires_in_seconds)
+        self._identity = identity       # () -> (base_url, client_id); a new value means a new token
+        self._lock = threading.Lock()
+        self._key = None
+        self._token = None
+        self._expires_at = 0.0          # wall-clock, comparable across processes
+
+    # ── helpers ───────────────────────────────────────────────────────────────
+
+    def _cache_key(self):
+        base, client_id = self._identity()
+        digest = hashlib.sha1(f'{base}|{client_id}'.encode()).hexdigest()[:12]
+        return f'gateway-token:{self.name}:{digest}'
+
+    def _margin(self):
+        return getattr(settings, 'GATEWAY_TOKEN_REFRESH_MARGIN', 60)
+
+    def _fresh(self, expires_at):
+        return time.time() < expires_at - self._margin()
+
+    def _remember(self, key, token, expires_at):
+        self._key, self._token, self._expires_at = key, token, expires_at
+
+    def _from_cache(self, key):
+        cached = cache.get(key)
+        if cached and self._fresh(cached[1]):
+            self._remember(key, *cached)
+            return cached[0]
+        return None
+
+    # ── public API ────────────────────────────────────────────────────────────
+
+    def get_token(self):
+        key = self._cache_key()
+        token = self._token
+        if token and self._key == key and self._fresh(self._expires_at):
+            return token
+        with self._lock:
+            if self._token and self._key == key and self._fresh(self._expires_at):
+                return self._token
+            token = self._from_cache(key)
+            if token:
+                return token
+
+            lock_key = f'{key}:refreshing'
+            owner = uuid.uuid4().hex
+            deadline = time.monotonic() + self.lock_timeout
+            while not cache.add(lock_key, owner, timeout=self.lock_timeout):
+                # Another process is refreshing: wait for it to publish the token.
+                time.sleep(0.05)
+                token = self._from_cache(key)
+                if token:
+                    return token
+                if time.monotonic() > deadline:
+                    break       # refresh without the lock; it stays the other process's to release
+            try:
+                token = self._from_cache(key)   # published while we queued for the lock
+                if token:
+                    return token
+                token, expires_in = self._fetch()
+                expires_at = time.time() + expires_in
+                cache.set(key, (token, expires_at), timeout=max(int(expires_in - self._margin()), 1))
+                self._remember(key, token, expires_at)
+                logger.info(f'{self.name} OAuth token refreshed (expires in {expires_in}s)')
+                return token
+            finally:
+                if cache.get(lock_key) == owner:
+                    cache.delete(lock_key)
+
+    def invalidate(self):
+        """Drop the token everywhere, e.g. after the gateway rejects it with 401."""
+        with self._lock:
+            self._remember(None, None, 0.0)
+            cache.delete(self._cache_key())
+
+
+# ── Token fetchers ────────────────────────────────────────────────────────────
+
+def _basic_auth(client_id, client_secret):
+    return base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+
+
+def _parse_token(name, r):
+    if not r.text.strip():
+        raise GatewayError(f'Empty {name} OAuth response (HTTP {r.status_code}).')
+    data = r.json()
+    token = data.get('access_token')
+    if not token:
+        raise GatewayError(f'No access_token in {name} OAuth response: {data}')
+    return token, int(data.get('expires_in') or 0)
+
+
+def _fetch_mpesa_token():
+    consumer_key = settings.MPESA_CONSUMER_KEY
+    consumer_secret = settings.MPESA_CONSUMER_SECRET
+    if not consumer_key or not consumer_secret:
+        raise GatewayError('M-Pesa credentials not configured.')
+    r = mpesa_client.request(
+        'GET', '/oauth/v1/generate?grant_type=client_credentials', endpoint='oauth',
+        headers={"Authorization": f"Basic {_basic_auth(consumer_key, consumer_secret)}"},
+    )
+    try:
+        r.raise_for_status()
+        return _parse_token('M-Pesa', r)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        raise GatewayError(f'M-Pesa OAuth failed: {e}')
+
+
+def _fetch_paypal_token():
+    r = paypal_client.request(
+        'POST', '/v1/oauth2/token', endpoint='oauth', idempotent=True,
+        headers={
+            "Authorization": f"Basic {_basic_auth(settings.PAYPAL_CLIENT_ID, settings.PAYPAL_CLIENT_SECRET)}",
+            "Content-Type": "application/x-www-form-urlencoded",
+        },
+        data="grant_type=client_credentials",
+    )
+    try:
+        r.raise_for_status()
+        return _parse_token('PayPal', r)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        raise GatewayError(f'PayPal OAuth failed: {e}')
+
+
+mpesa_tokens = TokenManager(
+    'M-Pesa', _fetch_mpesa_token, lambda: (settings.MPESA_BASE_URL, settings.MPESA_CONSUMER_KEY),
+)
+paypal_tokens = TokenManager(
+    'PayPal', _fetch_paypal_token, lambda: (settings.PAYPAL_BASE_URL, settings.PAYPAL_CLIENT_ID),
+)
+
+
+# ── Gateway operations ────────────────────────────────────────────────────────
+
+def _json(r, what):
+    try:
+        return r.json()
+    except ValueError:
+        raise GatewayError(f'{what} returned a non-JSON response (HTTP {r.status_code}).')
+
+
+def mpesa_password(timestamp):
+    return base64.b64encode(
+        f"{settings.MPESA_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}".encode()
+    ).decode()
+
+
+def _stk_payload(order, phone, amount):
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    return {
+        "BusinessShortCode": settings.MPESA_SHORTCODE,
+        "Password": mpesa_password(timestamp),
+        "Timestamp": timestamp,
+        "TransactionType": "CustomerPayBillOnline",
+        "Amount": amount,
+        "PartyA": phone,
+        "PartyB": settings.MPESA_SHORTCODE,
+        "PhoneNumber": phone,
+        "CallBackURL": settings.MPESA_CALLBACK_URL,
+        "AccountReference": order.order_number,
+        "TransactionDesc": f"Payment for {order.order_number}",
+    }
+
+
+def paypal_order_payload(order):
+    """PayPal order body for ``order``; returns ``(payload, currency)`` (KES orders are charged in USD)."""
+    currency = 'USD'
+    amount = convert(order.total, order.currency, currency)
+    return {
+        "intent": "CAPTURE",
+        "purchase_units": [{
+            "reference_id": order.order_number,
+            "amount": {"currency_code": currency, "value": str(amount)},
+            "description": f"Order {order.order_number}",
+        }],
+        "application_context": {
+            "return_url": f"{settings.FRONTEND_URL}/checkout/success?order={order.id}",
+            "cancel_url": f"{settings.FRONTEND_URL}/checkout/cancel?order={order.id}",
+        }
+    }, currency
+
+
+def mpesa_stk_push(order, phone, amount):
+    """Send an STK prompt for ``order``; returns the Daraja response body."""
+    r = mpesa_client.authorized(
+        mpesa_tokens, 'POST', '/mpesa/stkpush/v1/processrequest', endpoint='stkpush',
+        json=_stk_payload(order, phone, amount),
+    )
+    if r.status_code in RETRY_STATUSES:
+        # Safaricom's edge answered, so the push may already have reached the
+        # phone: sending it again could prompt the shopper twice.
+        raise GatewayError(f'M-Pesa is temporarily unavailable (HTTP {r.status_code}); the push was not retried.')
+    return _json(r, 'M-Pesa STK push')
+
+
+def mpesa_stk_query(checkout_request_id):
+    """
+    Ask Daraja how an STK push ended; returns the response body. While the
+    shopper has not answered the body is an error (``errorCode``
+    ``500.001.1001``) rather than a ``ResultCode``.
+    """
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    r = mpesa_client.authorized(
+        mpesa_tokens, 'POST', '/mpesa/stkpushquery/v1/query', endpoint='stkquery', idempotent=True,
+        json={
+            "BusinessShortCode": settings.MPESA_SHORTCODE,
+            "Password": mpesa_password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        },
+    )
+    return _json(r, 'M-Pesa STK query')
+
+
+def paypal_create_order(payload, request_id):
+    """Create a PayPal order; returns ``(status_code, body)``. Safe to retry thanks to ``request_id``."""
+    r = paypal_client.authorized(
+        paypal_tokens, 'POST', '/v2/checkout/orders', endpoint='orders.create', idempotent=True,
+        json=payload, headers={"PayPal-Request-Id": request_id},
+    )
+    return r.status_code, _json(r, 'PayPal order creation')
+
+
+def paypal_capture(paypal_order_id, request_id):
+    """Capture an approved PayPal order; returns ``(status_code, body)``."""
+    r = paypal_client.authorized(
+        paypal_tokens, 'POST', f'/v2/checkout/orders/{paypal_order_id}/capture', endpoint='orders.capture',
+        idempotent=True, headers={"Content-Type": "application/json", "PayPal-Request-Id": request_id},
+    )
+    return r.status_code, _json(r, 'PayPal capture')
+
+
+def paypal_get_order(paypal_order_id):
+    """Fetch a PayPal order; returns ``(status_code, body)``."""
+    r = paypal_client.authorized(paypal_tokens, 'GET', f'/v2/checkout/orders/{paypal_order_id}', endpoint='orders.get')
+    return r.status_code, _json(r, 'PayPal order lookup')
+
+
+# The PayPal capture for the async views (async_views.py).
+
+async def async_paypal_capture(paypal_order_id, request_id):
+    r = await async_paypal_client.authorized(
+        paypal_tokens, 'POST', f'/v2/checkout/orders/{paypal_order_id}/capture', endpoint='orders.capture',
+        idempotent=True, headers={"Content-Type": "application/json", "PayPal-Request-Id": request_id},
+    )
+    return r.status_code, _json(r, 'PayPal capture')
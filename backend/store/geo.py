@@ -0,0 +1,198 @@
+"""
+Pickup geography served from memory: nearest stations from a grid index,
+and the whole geography as one prebuilt JSON bundle.
+
+Nearest stations
+----------------
+
+Active stations that have coordinates, in active counties, are bucketed into
+``PICKUP_GRID_DEGREES`` cells. Each one is kept with its serialized
+PickupStationSerializer payload, so a lookup touches neither the database
+nor a serializer.
+
+``nearest()`` scans rings of cells outwards from the query point. It stops
+once it has k stations and the next ring can't hold anything closer, then
+ranks the candidates by haversine distance. For a few thousand stations that
+is tens of microseconds.
+
+The index is rebuilt every ``PICKUP_INDEX_TTL`` seconds, or when a station,
+county or country changes (signals.py).
+
+Bundle
+------
+``bundle()`` is every active country, county and pickup station as one JSON
+document, for /api/geography/bundle/. It is built once, along with a gzip
+copy and a version hash used as the ETag, and rebuilt on the same schedule
+as the index.
+"""
+
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+_lock = threading.Lock()
+_cache = {'expires': 0.0, 'index': None}
+_bundle = {'expires': 0.0, 'value': None}
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _distance(hit):
+    return hit[0]
+
+
+class GridIndex:
+    """``(lat, lng, payload)`` points bucketed into ``cell``-degree squares."""
+
+    def __init__(self, points, cell=0.25):
+        self.cell = cell
+        self.cells = defaultdict(list)
+        for lat, lng, payload in points:
+            rlat = math.radians(lat)
+            self.cells[self._key(lat, lng)].append((rlat, math.radians(lng), math.cos(rlat), payload))
+        self.size = sum(len(bucket) for bucket in self.cells.values())
+        keys = self.cells.keys()
+        self.bounds = (
+            (min(r for r, _ in keys), max(r for r, _ in keys), min(c for _, c in keys), max(c for _, c in keys))
+            if keys else None
+        )
+
+    def _key(self, lat, lng):
+        return math.floor(lat / self.cell), math.floor(lng / self.cell)
+
+    def _ring(self, row, col, r):
+        if r == 0:
+            yield row, col
+            return
+        for c in range(col - r, col + r + 1):
+            yield row - r, c
+            yield row + r, c
+        for rr in range(row - r + 1, row + r):
+            yield rr, col - r
+            yield rr, col + r
+
+    def _max_ring(self, row, col):
+        low_row, high_row, low_col, high_col = self.bounds
+        return max(abs(row - low_row), abs(row - high_row), abs(col - low_col), abs(col - high_col))
+
+    def _ring_floor_km(self, lat, r):
+        """No point in ring ``r`` or beyond is closer than this."""
+        if r <= 1:
+            return 0.0
+        widest = min(89.9, abs(lat) + (r + 1) * self.cell)
+        return (r - 1) * self.cell * KM_PER_DEGREE * math.cos(math.radians(widest))
+
+    def nearest(self, lat, lng, k):
+        """The ``k`` nearest points as ``(distance_km, payload)``, closest first."""
+        if not self.size or k <= 0:
+            return []
+        row, col = self._key(lat, lng)
+        rlat, rlng = math.radians(lat), math.radians(lng)
+        cos_lat, sin, asin, sqrt = math.cos(rlat), math.sin, math.asin, math.sqrt
+        cells, found = self.cells, []
+        for r in range(self._max_ring(row, col) + 1):
+            for key in self._ring(row, col, r):
+                for point_lat, point_lng, point_cos, payload in cells.get(key, ()):
+                    # Haversine, inlined: this loop is the whole cost of a lookup.
+                    a = sin((point_lat - rlat) / 2) ** 2 + cos_lat * point_cos * sin((point_lng - rlng) / 2) ** 2
+                    found.append((2 * EARTH_RADIUS_KM * asin(sqrt(a)), payload))
+            if len(found) >= k:
+                best = heapq.nsmallest(k, found, key=_distance)
+                if best[-1][0] <= self._ring_floor_km(lat, r + 1):
+                    return best
+        return heapq.nsmallest(k, found, key=_distance)
+
+
+def _build():
+    from .models import PickupStation
+    from .serializers import PickupStationSerializer
+
+    stations = (
+        PickupStation.objects.filter(
+            is_active=True, county__is_active=True, latitude__isnull=False, longitude__isnull=False,
+        ).select_related('county__country')
+    )
+    points = []
+    for station in stations:
+        payload = dict(PickupStationSerializer(station).data)
+        payload.update(county=station.county.name, country_code=station.county.country.code)
+        points.append((float(station.latitude), float(station.longitude), payload))
+    return GridIndex(points, cell=getattr(settings, 'PICKUP_GRID_DEGREES', 0.25))
+
+
+def index():
+    now = time.monotonic()
+    if _cache['expires'] <= now:
+        with _lock:
+            if _cache['expires'] <= now:
+                _cache['index'] = _build()
+                _cache['expires'] = now + getattr(settings, 'PICKUP_INDEX_TTL', 300)
+    return _cache['index']
+
+
+def invalidate():
+    _cache['expires'] = 0.0
+    _bundle['expires'] = 0.0
+
+
+def nearest(lat, lng, k):
+    """Up to ``k`` active stations nearest to (lat, lng), each with ``distance_km``."""
+    return [{**payload, 'distance_km': round(distance, 2)} for distance, payload in index().nearest(lat, lng, k)]
+
+
+# ── Bundle ────────────────────────────────────────────────────────────────────
+
+def _dumps(document):
+    return json.dumps(document, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+
+
+class Bundle:
+    def __init__(self, document):
+        self.version = hashlib.sha256(_dumps(document)).hexdigest()[:16]
+        self.body = _dumps({'version': self.version, **document})
+        self.gzipped = gzip.compress(self.body, compresslevel=9, mtime=0)
+
+
+def _build_bundle():
+    from .models import Country, County, PickupStation
+    from .serializers import CountrySerializer, PickupStationSerializer
+
+    countries = Country.objects.filter(is_active=True).order_by('name')
+    counties = County.objects.filter(is_active=True, country__is_active=True).order_by('name')
+    stations = (
+        PickupStation.objects.filter(is_active=True, county__is_active=True, county__country__is_active=True)
+        .order_by('county__name', 'name')
+    )
+    document = {
+        'countries': CountrySerializer(countries, many=True).data,
+        'counties': list(counties.values('id', 'name', 'slug', 'country_id')),
+        'stations': [
+            {**PickupStationSerializer(station).data, 'county_id': station.county_id} for station in stations
+        ],
+    }
+    return Bundle(document)
+
+
+def bundle():
+    now = time.monotonic()
+    if _bundle['expires'] <= now:
+        with _lock:
+            if _bundle['expires'] <= now:
+                _bundle['value'] = _build_bundle()
+                _bundle['expires'] = now + getattr(settings, 'PICKUP_INDEX_TTL', 300)
+    return _bundle['value']
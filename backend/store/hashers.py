@@ -0,0 +1,17 @@
+"""
+Password hashing with a configurable cost.
+
+``PBKDF2PasswordHasher`` is Django's ``pbkdf2_sha256`` hasher, but its
+iteration count comes from ``PASSWORD_HASH_ITERATIONS``. Existing hashes keep
+verifying, and ``check_password`` rehashes them at the configured cost on
+the next successful login, whichever way the setting moved.
+"""
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
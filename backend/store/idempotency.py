@@ -0,0 +1,150 @@
+"""
+``Idempotency-Key`` support for POST endpoints that must not run twice
+(order creation, STK push, PayPal order creation).
+
+The first request with a given key claims it by inserting an ``in_flight``
+IdempotencyKey row — the (user, key) unique index makes that the only lookup
+on the happy path. When the view returns, its response is stored on the row:
+
+* a retry with the same key and body gets the stored response replayed;
+* a retry while the first request is still running gets ``409``;
+* reusing a key for a different request body gets ``422``.
+
+Server errors (5xx and exceptions) release the key so the client can retry.
+Expired rows are removed by ``manage.py purge_idempotency_keys``.
+``async_idempotent`` does the same for the async payment views.
+"""
+
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+
+def _fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+IN_PROGRESS = {'error': 'A request with this Idempotency-Key is already in progress.'}, 409, None
+
+
+def _claim(request, key, request_hash):
+    """
+    Return ``(record, None)`` if this request owns the key, else
+    ``(None, (body, status, headers))`` describing the response to send.
+    """
+    now = timezone.now()
+    lock_until = now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                user=request.user, key=key, request_hash=request_hash, expires_at=lock_until,
+            ), None
+    except IntegrityError:
+        pass
+
+    record = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+    if record is None or record.expires_at <= now:
+        # Expired (or purged under us): take it over as a fresh claim.
+        taken = IdempotencyKey.objects.filter(user=request.user, key=key, expires_at__lte=now).update(
+            status='in_flight', request_hash=request_hash, response_status=None,
+            response_body=None, expires_at=lock_until,
+        )
+        if taken:
+            return IdempotencyKey.objects.get(user=request.user, key=key), None
+        return None, IN_PROGRESS
+    if record.request_hash != request_hash:
+        return None, ({'error': 'Idempotency-Key was already used for a different request.'}, 422, None)
+    if record.status == 'in_flight':
+        return None, IN_PROGRESS
+    return None, (record.response_body, record.response_status, {'Idempotent-Replayed': 'true'})
+
+
+def _complete(record, status, body):
+    IdempotencyKey.objects.filter(pk=record.pk).update(
+        status='completed',
+        response_status=status,
+        response_body=body,
+        expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+    )
+
+
+def idempotent(view_method):
+    """Decorate an APIView/ViewSet handler to honour the ``Idempotency-Key`` header."""
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key or not request.user.is_authenticated:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response({'error': f'{HEADER} must be at most 255 characters.'}, status=400)
+
+        record, early = _claim(request, key, _fingerprint(request))
+        if early is not None:
+            body, status, headers = early
+            return Response(body, status=status, headers=headers)
+
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+        if response.status_code >= 500:
+            record.delete()
+            return response
+
+        _complete(record, response.status_code, response.data)
+        return response
+
+    return wrapper
+
+
+def async_idempotent(view_method):
+    """``idempotent`` for async views that return a JsonResponse (see async_views.py)."""
+
+    @functools.wraps(view_method)
+    async def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key or not request.user.is_authenticated:
+            return await view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return JsonResponse({'error': f'{HEADER} must be at most 255 characters.'}, status=400)
+
+        record, early = await sync_to_async(_claim)(request, key, _fingerprint(request))
+        if early is not None:
+            body, status, headers = early
+            return JsonResponse(body, status=status, headers=headers, safe=False)
+
+        try:
+            response = await view_method(self, request, *args, **kwargs)
+        except Exception:
+            await record.adelete()
+            raise
+        if response.status_code >= 500:
+            await record.adelete()
+            return response
+
+        await sync_to_async(_complete)(record, response.status_code, json.loads(response.content))
+        return response
+
+    return wrapper
+
+
+def purge_expired():
+    """Delete expired keys; returns the number removed."""
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
@@ -0,0 +1,127 @@
+"""
+Identifier generation: time-ordered UUID primary keys and sequence-backed
+order numbers / ASINs.
+
+``uuid7()`` puts a millisecond timestamp in the high bits so new rows land at
+the right-hand edge of the primary-key index instead of at random pages.
+
+``next_value(name)`` hands out unique, increasing integers that are safe
+across worker processes:
+
+* PostgreSQL — a native sequence (``store_seq_<name>``, created in migration
+  0003) that steps by ``BLOCK_SIZE``; each process takes a whole block per
+  ``nextval()`` and serves it from memory. ``nextval()`` is never rolled back,
+  so a block can't be handed out twice.
+* Other backends — a row in ``IdSequence`` bumped with an UPDATE. Outside a
+  transaction a whole block is reserved at once; inside one only a single
+  value is taken, so a rollback can't leave this process holding numbers the
+  database has forgotten about. That single-value UPDATE also holds the row
+  lock until the caller commits, so hot paths (checkout) take their number
+  before opening a transaction.
+"""
+
+import os
+import secrets
+import threading
+import time
+import uuid
+
+from django.db import connections, router, transaction
+from django.db.models import F
+
+SEQUENCES = ('order_number', 'asin')
+BLOCK_SIZE = 50         # baked into the PostgreSQL sequences' INCREMENT BY — change both together
+ASIN_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+_lock = threading.Lock()
+_blocks = {}            # name -> [next, end)
+_state = {'pid': None, 'last_ms': 0, 'counter': 0}
+
+
+# ── UUIDv7 ────────────────────────────────────────────────────────────────────
+
+def uuid7():
+    """RFC 9562 UUIDv7, monotonic within this process (12-bit sub-millisecond counter)."""
+    with _lock:
+        ms = time.time_ns() // 1_000_000
+        if ms <= _state['last_ms']:
+            _state['counter'] += 1
+            if _state['counter'] > 0xFFF:      # counter exhausted: borrow the next millisecond
+                _state['last_ms'] += 1
+                _state['counter'] = 0
+            ms = _state['last_ms']
+        else:
+            _state['last_ms'] = ms
+            _state['counter'] = secrets.randbits(11)   # random start leaves headroom to count up
+        counter = _state['counter']
+    value = (ms & 0xFFFF_FFFF_FFFF) << 80
+    value |= 0x7 << 76
+    value |= counter << 64
+    value |= 0b10 << 62
+    value |= secrets.randbits(62)
+    return uuid.UUID(int=value)
+
+
+# ── Sequences ─────────────────────────────────────────────────────────────────
+
+def sequence_name(name):
+    return f'store_seq_{name}'
+
+
+def _allocate(name, connection):
+    """Reserve ``[start, end)`` for ``name`` in the database."""
+    from .models import IdSequence
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT nextval(%s)', [sequence_name(name)])
+            start = cursor.fetchone()[0]
+        return start, start + BLOCK_SIZE
+
+    size = 1 if connection.in_atomic_block else BLOCK_SIZE
+    with transaction.atomic(using=connection.alias):
+        rows = IdSequence.objects.using(connection.alias).filter(name=name)
+        if not rows.update(next_value=F('next_value') + size):
+            IdSequence.objects.using(connection.alias).get_or_create(name=name)
+            rows.update(next_value=F('next_value') + size)
+        end = rows.values_list('next_value', flat=True).get()
+    return end - size, end
+
+
+def next_value(name):
+    """Return the next value of sequence ``name`` (one of ``SEQUENCES``)."""
+    from .models import IdSequence
+
+    connection = connections[router.db_for_write(IdSequence)]
+    with _lock:
+        if _state['pid'] != os.getpid():    # forked worker: blocks belong to the parent
+            _blocks.clear()
+            _state['pid'] = os.getpid()
+        block = _blocks.get(name)
+        if block is None or block[0] >= block[1]:
+            block = _blocks[name] = list(_allocate(name, connection))
+        value = block[0]
+        block[0] += 1
+    return value
+
+
+def reset():
+    """Forget any cached blocks (tests and benchmarks)."""
+    with _lock:
+        _blocks.clear()
+
+
+# ── Public formats ────────────────────────────────────────────────────────────
+
+def new_order_number():
+    # 12 digits never collide with the legacy random 10-digit numbers.
+    return f"AMZ-{next_value('order_number'):012d}"
+
+
+def new_asin():
+    # 'B1' prefix keeps these apart from the legacy random 'B0' ASINs.
+    n, chars = next_value('asin'), []
+    for _ in range(8):
+        n, r = divmod(n, 36)
+        chars.append(ASIN_ALPHABET[r])
+    return 'B1' + ''.join(reversed(chars))
@@ -0,0 +1,188 @@
+"""
+Database-backed background jobs — no broker, just the BackgroundJob table.
+
+``enqueue(kind, payload)`` stores a job; ``manage.py run_jobs`` claims
+runnable jobs in batches and runs them on a local thread pool. A claimed job
+is leased for ``JOB_LEASE_SECONDS``; if its worker dies the lease runs out and
+another worker picks it up.
+
+Handlers are registered with ``@handler('kind')`` and receive the job. What
+they return is stored as ``job.result``. If they raise, the job is retried
+with jittered exponential backoff (``JOB_RETRY_BACKOFF``, capped at
+``JOB_RETRY_MAX_BACKOFF``) until ``max_attempts`` is used up. Then it moves
+to the ``dead`` (dead-letter) state with the error kept in ``last_error``.
+Raising ``PermanentJobError`` skips the retries.
+
+Long handlers call ``report_progress(job, done, total)`` as they go. That
+records the progress and renews the lease. It raises ``JobCancelled`` once
+the job has been cancelled (``cancel()``), and the job stops there.
+"""
+
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import events
+from .models import BackgroundJob
+
+logger = logging.getLogger('store')
+
+_handlers = {}
+
+
+class PermanentJobError(Exception):
+    """Retrying cannot help; the job goes straight to ``dead``."""
+
+
+class JobCancelled(Exception):
+    """The job was cancelled (or lost its lease) while running."""
+
+
+def handler(kind):
+    """Register the decorated function as the handler for jobs of ``kind``."""
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, payload=None, *, user=None, order=None, max_attempts=None, delay=0):
+    return BackgroundJob.objects.create(
+        kind=kind,
+        payload=payload or {},
+        user=user,
+        order=order,
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def _runnable(now):
+    return Q(status='queued', run_after__lte=now) | Q(status='running', locked_until__lt=now)
+
+
+def claim(limit):
+    """Lease up to ``limit`` runnable jobs to the caller; returns them marked ``running``."""
+    if limit <= 0:
+        return []
+    now = timezone.now()
+    leased = {'status': 'running', 'locked_until': now + timedelta(seconds=settings.JOB_LEASE_SECONDS)}
+    connection = connections[router.db_for_write(BackgroundJob)]
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            jobs = list(
+                BackgroundJob.objects.select_for_update(skip_locked=True)
+                .filter(_runnable(now)).order_by('run_after')[:limit]
+            )
+            BackgroundJob.objects.filter(id__in=[j.id for j in jobs]).update(attempts=F('attempts') + 1, **leased)
+    else:
+        # No SKIP LOCKED: claim each row with an UPDATE guarded on the state we read,
+        # so when two workers race for a job exactly one of them gets it.
+        jobs = []
+        for job in BackgroundJob.objects.filter(_runnable(now)).order_by('run_after')[:limit]:
+            if BackgroundJob.objects.filter(
+                id=job.id, status=job.status, attempts=job.attempts, locked_until=job.locked_until,
+            ).update(attempts=F('attempts') + 1, **leased):
+                jobs.append(job)
+
+    for job in jobs:
+        job.attempts += 1
+        job.status, job.locked_until = leased['status'], leased['locked_until']
+    return jobs
+
+
+def cancel(queryset):
+    """Cancel the queued and running jobs in ``queryset``; returns how many were cancelled."""
+    return queryset.filter(status__in=['queued', 'running']).update(
+        status='cancelled', locked_until=None, updated_at=timezone.now(),
+    )
+
+
+def report_progress(job, done, total=None):
+    """Record a running job's progress and renew its lease; raises JobCancelled if it is no longer ours."""
+    now = timezone.now()
+    changes = {'done': done, 'locked_until': now + timedelta(seconds=settings.JOB_LEASE_SECONDS), 'updated_at': now}
+    if total is not None:
+        changes['total'] = total
+    if not BackgroundJob.objects.filter(id=job.id, status='running', locked_until=job.locked_until).update(**changes):
+        raise JobCancelled(f'Job {job.id} was cancelled.')
+    job.done, job.locked_until = done, changes['locked_until']
+    if total is not None:
+        job.total = total
+
+
+def _backoff(attempts):
+    delay = min(settings.JOB_RETRY_BACKOFF * 2 ** (attempts - 1), settings.JOB_RETRY_MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def run(job):
+    """Run a claimed job and record the outcome; returns the job's new status."""
+    try:
+        func = _handlers.get(job.kind)
+        if func is None:
+            raise PermanentJobError(f'No handler registered for {job.kind!r}.')
+        result = func(job)
+    except JobCancelled:
+        logger.info(f'Job {job.kind} {job.id} stopped after {job.done}/{job.total}: cancelled')
+        job.refresh_from_db(fields=['status'])
+        return job.status
+    except Exception as e:
+        if isinstance(e, PermanentJobError) or job.attempts >= job.max_attempts:
+            logger.error(f'Job {job.kind} {job.id} is dead after {job.attempts} attempt(s): {e}')
+            changes = {'status': 'dead'}
+        else:
+            logger.warning(f'Job {job.kind} {job.id} failed (attempt {job.attempts}/{job.max_attempts}): {e}')
+            changes = {'status': 'queued', 'run_after': timezone.now() + timedelta(seconds=_backoff(job.attempts))}
+        changes.update(last_error=str(e) or e.__class__.__name__, locked_until=None)
+    else:
+        changes = {'status': 'succeeded', 'result': result, 'locked_until': None, 'last_error': ''}
+
+    # Only record the outcome if our lease still stands.
+    BackgroundJob.objects.filter(id=job.id, status='running', locked_until=job.locked_until).update(
+        updated_at=timezone.now(), **changes,
+    )
+    for field, value in changes.items():
+        setattr(job, field, value)
+    if job.order_id:
+        events.publish(job.order_id)
+    return job.status
+
+
+def run_pending(limit=100):
+    """Claim and run runnable jobs inline until none are left (tests and ``run_jobs --once``)."""
+    done = 0
+    while done < limit:
+        jobs = claim(min(10, limit - done))
+        if not jobs:
+            break
+        for job in jobs:
+            run(job)
+        done += len(jobs)
+    return done
+
+
+def progress(job):
+    """Public view of a job for status endpoints."""
+    data = {
+        'job_id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+    }
+    if job.status == 'queued' and job.attempts:
+        data['retry_at'] = job.run_after
+    if job.status == 'succeeded':
+        data['result'] = job.result
+    if job.status == 'dead':
+        data['error'] = job.last_error
+    if job.total is not None:
+        data.update(done=job.done, total=job.total)
+    return data
@@ -0,0 +1,132 @@
+"""
+Benchmark the order changelist on a large generated Order table.
+
+Inserts ``--rows`` orders (5,000,000 by default) and runs ANALYZE. It then
+times changelist pages and searches with OrderAdmin configured two ways:
+
+* now: estimated counts, index-backed search, and a date list_filter;
+* before: two exact counts per page, date_hierarchy, and
+  leading-wildcard search.
+
+Counts are cleared from the cache before every request, so each timing is a
+cold load. The generated orders are deleted afterwards unless ``--keep``.
+
+Five million orders take several minutes to insert and a few GB on disk, so
+run this against a scratch database.
+
+Usage:
+    python manage.py bench_admin_changelist
+    python manage.py bench_admin_changelist --rows 500000 --repeat 5 --keep
+"""
+
+import random
+import statistics
+import time
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.test import Client, override_settings
+
+from store.admin import OrderAdmin
+from store.models import Order
+
+PREFIX = 'BENCH-'
+FIRST = ['Jane', 'John', 'Wanjiru', 'Otieno', 'Achieng', 'Kamau', 'Njeri', 'Mwangi', 'Amina', 'Brian', 'Faith', 'Kevin']
+LAST = ['Kamau', 'Otieno', 'Wanjiku', 'Mutua', 'Odhiambo', 'Kiprop', 'Njoroge', 'Hassan', 'Cheruiyot', 'Mwende']
+STATUSES = [s for s, _ in Order.STATUS_CHOICES]
+METHODS = ['mpesa'] * 6 + ['paypal'] * 2 + ['card', 'cod']
+ALNUM = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+BEFORE = {
+    'paginator': Paginator,
+    'show_full_result_count': True,
+    'date_hierarchy': 'created_at',
+    'list_filter': ('status', 'payment_status', 'payment_method', 'delivery_type', 'currency'),
+    'search_fields': ('order_number', 'full_name', 'email', 'phone', 'mpesa_transaction_id', 'paypal_order_id'),
+    'get_search_results': admin.ModelAdmin.get_search_results,
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the order admin changelist on a large generated Order table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5_000_000, help='Orders to generate (default: 5000000)')
+        parser.add_argument('--batch', type=int, default=10000, help='Orders per INSERT batch (default: 10000)')
+        parser.add_argument('--repeat', type=int, default=3, help='Requests per case (default: 3)')
+        parser.add_argument('--keep', action='store_true', help="Don't delete the generated orders")
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        sample = self._generate(rng, options['rows'], options['batch'])
+        admin_user = User.objects.create_superuser(f'{PREFIX}admin', f'{PREFIX}admin@example.com', None)
+        try:
+            client = Client()
+            client.force_login(admin_user)
+            cases = [
+                ('first page', {}),
+                ('filtered by status', {'status__exact': 'delivered'}),
+                ('order number', {'q': sample.order_number}),
+                ('phone', {'q': sample.phone}),
+                ('email', {'q': sample.email.upper()}),
+                ('M-Pesa receipt', {'q': sample.mpesa_transaction_id or 'QX00000000'}),
+                ('name prefix', {'q': sample.full_name.split()[0][:4]}),
+            ]
+            self.stdout.write(f"\n  {'':<22}{'before':>12}{'now':>12}")
+            with override_settings(ALLOWED_HOSTS=['*']):
+                for label, params in cases:
+                    with mock.patch.multiple(OrderAdmin, **BEFORE):
+                        before = self._time(client, params, options['repeat'])
+                    now = self._time(client, params, options['repeat'])
+                    self.stdout.write(f'  {label:<22}{before * 1000:>10.0f}ms{now * 1000:>10.0f}ms'
+                                      f'{before / now:>8.0f}x')
+        finally:
+            admin_user.delete()
+            if not options['keep']:
+                self._delete(options['batch'])
+
+    def _generate(self, rng, rows, batch):
+        existing = Order.objects.filter(order_number__startswith=PREFIX).count()
+        started = time.perf_counter()
+        for start in range(existing, rows, batch):
+            orders = []
+            for i in range(start, min(start + batch, rows)):
+                first, last, method = rng.choice(FIRST), rng.choice(LAST), rng.choice(METHODS)
+                orders.append(Order(
+                    order_number=f'{PREFIX}{i:012d}', full_name=f'{first} {last}',
+                    email=f'{first}.{last}{i}@example.com'.lower(), phone=f'07{rng.randrange(10 ** 8):08d}',
+                    status=rng.choice(STATUSES), payment_method=method, subtotal=1000, total=1160,
+                    mpesa_transaction_id=''.join(rng.choices(ALNUM, k=10)) if method == 'mpesa' else '',
+                    paypal_order_id=''.join(rng.choices(ALNUM, k=17)) if method == 'paypal' else '',
+                ))
+            with transaction.atomic():
+                Order.objects.bulk_create(orders)
+            if start // batch % 50 == 0:
+                self.stdout.write(f'  {start + len(orders):,} orders...')
+        if rows > existing:
+            self.stdout.write(f'Inserted {rows - existing:,} orders in {time.perf_counter() - started:.0f}s')
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write(self.style.HTTP_INFO(f'{Order.objects.count():,} orders'))
+        return Order.objects.filter(order_number__startswith=PREFIX).order_by('-order_number').first()
+
+    def _time(self, client, params, repeat):
+        times = []
+        for _ in range(repeat):
+            cache.clear()
+            started = time.perf_counter()
+            response = client.get('/admin/store/order/', params)
+            times.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                raise RuntimeError(f'changelist {params} -> {response.status_code}')
+        return statistics.median(times)
+
+    def _delete(self, batch):
+        orders = Order.objects.filter(order_number__startswith=PREFIX)
+        while pks := list(orders.order_by('pk').values_list('pk', flat=True)[:batch]):
+            Order.objects.filter(pk__in=pks).delete()
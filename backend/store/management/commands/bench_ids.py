@@ -0,0 +1,61 @@
+"""
+Benchmark order inserts with the legacy identifiers (UUID4 primary key +
+random order number) against the current ones (UUIDv7 + sequence-backed
+order number). Benchmark rows are deleted afterwards.
+
+Usage:
+    python manage.py bench_ids
+    python manage.py bench_ids --rows 100000 --batch 1000
+"""
+
+import random
+import string
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from store.identifiers import new_order_number, uuid7
+from store.models import Order
+
+BENCH_NAME = '__bench_ids__'
+
+
+def legacy_ids():
+    return uuid.uuid4(), 'AMZ-' + ''.join(random.choices(string.digits, k=10))
+
+
+def current_ids():
+    return uuid7(), new_order_number()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark Order inserts with legacy vs time-ordered identifiers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000, help='Rows to insert per scheme (default: 20000)')
+        parser.add_argument('--batch', type=int, default=500, help='bulk_create batch size (default: 500)')
+
+    def handle(self, *args, **options):
+        rows, batch = options['rows'], options['batch']
+        self.stdout.write(self.style.HTTP_INFO(f'Inserting {rows:,} orders per scheme in batches of {batch}...\n'))
+        try:
+            for label, make_ids in (('legacy  (uuid4 + random)', legacy_ids), ('current (uuid7 + sequence)', current_ids)):
+                elapsed = self._run(make_ids, rows, batch)
+                self.stdout.write(f'  {label:28} {elapsed:8.2f}s  {rows / elapsed:10,.0f} rows/s')
+        finally:
+            Order.objects.filter(full_name=BENCH_NAME).delete()
+
+    def _run(self, make_ids, rows, batch):
+        started = time.perf_counter()
+        for offset in range(0, rows, batch):
+            orders = []
+            for _ in range(min(batch, rows - offset)):
+                pk, number = make_ids()
+                orders.append(Order(
+                    id=pk, order_number=number, full_name=BENCH_NAME, email='bench@example.com',
+                    phone='0700000000', subtotal=Decimal('1'), total=Decimal('1'),
+                ))
+            Order.objects.bulk_create(orders)
+        return time.perf_counter() - started
@@ -0,0 +1,101 @@
+"""
+Benchmark the login path: the email lookup, then whole logins at a few
+password hashing costs.
+
+Creates ``--users`` throwaway accounts. It first compares the old
+``email = ...`` lookup, which scans auth_user, with ``users_with_email()``,
+which uses the LOWER(email) index. It then posts ``--logins`` logins to
+LoginView from ``--workers`` threads at every ``--iterations`` cost, plus the
+same number with unknown emails (a credential-stuffing miss). The accounts
+are deleted afterwards.
+
+Usage:
+    python manage.py bench_login
+    python manage.py bench_login --users 200000 --logins 400 --workers 8 --iterations 1000000,600000,260000
+"""
+
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.test import RequestFactory, override_settings
+
+from store import views
+from store.backends import users_with_email
+
+PREFIX = '__bench_login_'
+PASSWORD = 'bench-pass-123'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark email lookup and login throughput at several hashing costs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50000, help='Accounts to create (default: 50000)')
+        parser.add_argument('--lookups', type=int, default=200, help='Email lookups per variant (default: 200)')
+        parser.add_argument('--logins', type=int, default=100, help='Logins per cost (default: 100)')
+        parser.add_argument('--workers', type=int, default=4, help='Login threads (default: 4)')
+        parser.add_argument('--iterations', default=str(settings.PASSWORD_HASH_ITERATIONS),
+                            help='Comma-separated PBKDF2 costs (default: PASSWORD_HASH_ITERATIONS)')
+
+    def handle(self, *args, **options):
+        self.factory = RequestFactory()
+        n = options['users']
+        emails = [f'{PREFIX}{i}@Example.com' for i in range(n)]
+        User.objects.bulk_create(
+            [User(username=f'{PREFIX}{i}', email=email) for i, email in enumerate(emails)], batch_size=5000,
+        )
+        try:
+            self.stdout.write(self.style.HTTP_INFO(f'{n} accounts\n'))
+            sample = random.sample(emails, min(options['lookups'], n))
+            self._time_lookups('email = ... (scan)', lambda e: User.objects.filter(email=e).first(), sample)
+            self._time_lookups('users_with_email (index)', lambda e: users_with_email(e.upper()).first(), sample)
+
+            self.stdout.write(f"\n  {'cost':>9}{'login':>9}{'p50':>10}{'p95':>10}{'logins/s':>11}")
+            for cost in (int(c) for c in options['iterations'].split(',')):
+                with override_settings(PASSWORD_HASH_ITERATIONS=cost, THROTTLE_ENABLED=False):
+                    User.objects.filter(username__startswith=PREFIX).update(password=make_password(PASSWORD))
+                    logins = random.sample(emails, min(options['logins'], n))
+                    misses = [f'{PREFIX}missing_{i}@example.com' for i in range(len(logins))]
+                    for label, batch, expect in (('ok', logins, 200), ('unknown', misses, 401)):
+                        self._time_logins(cost, label, batch, expect, options['workers'])
+        finally:
+            User.objects.filter(username__startswith=PREFIX).delete()
+
+    def _time_lookups(self, label, lookup, sample):
+        times = []
+        for email in sample:
+            started = time.perf_counter()
+            lookup(email)
+            times.append(time.perf_counter() - started)
+        self.stdout.write(f'  {label:<28} median {statistics.median(times) * 1000:8.2f}ms per lookup')
+
+    def _time_logins(self, cost, label, batch, expect, workers):
+        view = views.LoginView.as_view()
+
+        def login(email):
+            close_old_connections()
+            request = self.factory.post('/api/auth/login/', {'email': email, 'password': PASSWORD},
+                                        content_type='application/json')
+            started = time.perf_counter()
+            status = view(request).status_code
+            elapsed = time.perf_counter() - started
+            connection.close()
+            if status != expect:
+                raise RuntimeError(f'login {email} -> {status}, expected {expect}')
+            return elapsed
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            times = sorted(pool.map(login, batch))
+        wall = time.perf_counter() - started
+        p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+        self.stdout.write(
+            f'  {cost:>9}{label:>9}{statistics.median(times) * 1000:>8.0f}ms{p95 * 1000:>8.0f}ms{len(times) / wall:>11.1f}'
+        )
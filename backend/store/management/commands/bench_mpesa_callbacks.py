@@ -0,0 +1,118 @@
+"""
+Benchmark M-Pesa callback ingestion and application.
+
+Creates ``--count`` pending M-Pesa payments, posts their callbacks to
+MpesaCallbackView (plus ``--duplicates`` repeat deliveries) from
+``--threads`` threads, then applies the inbox. Half the inbox is applied one
+callback per transaction, which approximates the old inline handler, and half
+in batches of ``--batch``. Benchmark rows are deleted afterwards.
+
+Usage:
+    python manage.py bench_mpesa_callbacks
+    python manage.py bench_mpesa_callbacks --count 5000 --threads 8 --batch 500
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+
+from store import callbacks, views
+from store.identifiers import new_order_number
+from store.models import MpesaCallback, MpesaTransaction, Order
+
+BENCH_USER = '__bench_callbacks__'
+
+
+def callback_body(checkout_request_id, n):
+    result_code = 0 if n % 5 else 1032          # one in five cancelled by the user
+    return {'Body': {'stkCallback': {
+        'MerchantRequestID': f'bench-{n}',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'ok' if result_code == 0 else 'Request cancelled by user',
+        'CallbackMetadata': {'Item': [
+            {'Name': 'Amount', 'Value': 1},
+            {'Name': 'MpesaReceiptNumber', 'Value': f'BENCH{n:07d}'},
+        ]},
+    }}}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark M-Pesa callback ingestion (callbacks/s) and batch application'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=2000, help='Payments to call back (default: 2000)')
+        parser.add_argument('--duplicates', type=float, default=0.2, help='Share of repeat deliveries (default: 0.2)')
+        parser.add_argument('--threads', type=int, default=4, help='Threads posting callbacks (default: 4)')
+        parser.add_argument('--batch', type=int, default=200, help='Callbacks per apply transaction (default: 200)')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        user = User.objects.create_user(BENCH_USER, f'{BENCH_USER}@example.com', 'bench')
+        try:
+            ids = self._setup(user, count)
+            bodies = [callback_body(checkout_id, n) for n, checkout_id in enumerate(ids)]
+            bodies += random.sample(bodies, int(count * options['duplicates']))
+            random.shuffle(bodies)
+
+            elapsed = self._ingest(bodies, options['threads'])
+            stored = MpesaCallback.objects.filter(checkout_request_id__in=ids).count()
+            self.stdout.write(
+                f'  ingest                      {elapsed:7.2f}s  {len(bodies) / elapsed:9,.0f} callbacks/s  '
+                f'({len(bodies):,} posted, {stored:,} stored)'
+            )
+
+            half = stored // 2
+            started = time.perf_counter()
+            for _ in range(half):
+                callbacks.apply_pending(1)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'  apply, 1 per transaction    {elapsed:7.2f}s  {half / elapsed:9,.0f} callbacks/s')
+
+            started = time.perf_counter()
+            applied = callbacks.apply_all(options['batch'])
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"  apply, {options['batch']} per transaction  {elapsed:7.2f}s  {applied / elapsed:9,.0f} callbacks/s"
+            )
+            paid = Order.objects.filter(user=user, payment_status='paid').count()
+            self.stdout.write(f'  {paid:,} orders paid, {count - paid:,} cancelled')
+        finally:
+            MpesaCallback.objects.filter(checkout_request_id__startswith='ws_CO_bench_').delete()
+            Order.objects.filter(user__username=BENCH_USER).delete()
+            User.objects.filter(username=BENCH_USER).delete()
+
+    def _setup(self, user, count):
+        orders = Order.objects.bulk_create([
+            Order(user=user, order_number=new_order_number(), full_name=BENCH_USER, email=user.email,
+                  phone='0700000000', currency='KES', subtotal=Decimal('1'), total=Decimal('1'),
+                  status='payment_pending')
+            for _ in range(count)
+        ], batch_size=500)
+        txs = [
+            MpesaTransaction(order=order, checkout_request_id=f'ws_CO_bench_{n}', amount=1, phone='254700000000')
+            for n, order in enumerate(orders)
+        ]
+        MpesaTransaction.objects.bulk_create(txs, batch_size=500)
+        return [tx.checkout_request_id for tx in txs]
+
+    def _ingest(self, bodies, threads):
+        view = views.MpesaCallbackView.as_view()
+        factory = RequestFactory()
+
+        def post(body):
+            try:
+                view(factory.post('/api/payments/mpesa/callback/', body, content_type='application/json'))
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(post, bodies))
+        return time.perf_counter() - started
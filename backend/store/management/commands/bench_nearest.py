@@ -0,0 +1,71 @@
+"""
+Benchmark nearest-station lookups on the grid index (store/geo.py) against a
+brute-force scan, in memory with random stations and queries over Kenya.
+Every grid answer is checked against the brute-force one.
+
+Usage:
+    python manage.py bench_nearest
+    python manage.py bench_nearest --stations 20000 --queries 5000 --k 10 --cell 0.1
+"""
+
+import heapq
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from store.geo import GridIndex, haversine_km
+
+KENYA = ((-4.7, 5.0), (33.9, 41.9))
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the nearest pickup station grid index against brute force'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stations', type=int, default=5000, help='Random stations (default: 5000)')
+        parser.add_argument('--queries', type=int, default=2000, help='Random lookups (default: 2000)')
+        parser.add_argument('--k', type=int, default=5, help='Stations per lookup (default: 5)')
+        parser.add_argument('--cell', type=float, default=settings.PICKUP_GRID_DEGREES,
+                            help=f'Grid cell in degrees (default: {settings.PICKUP_GRID_DEGREES})')
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        (low_lat, high_lat), (low_lng, high_lng) = KENYA
+
+        def point():
+            return rng.uniform(low_lat, high_lat), rng.uniform(low_lng, high_lng)
+
+        stations = [(*point(), {'id': i}) for i in range(options['stations'])]
+        queries = [point() for _ in range(options['queries'])]
+        k = options['k']
+
+        started = time.perf_counter()
+        grid = GridIndex(stations, cell=options['cell'])
+        built = time.perf_counter() - started
+
+        started = time.perf_counter()
+        answers = [grid.nearest(lat, lng, k) for lat, lng in queries]
+        grid_time = (time.perf_counter() - started) / len(queries)
+
+        started = time.perf_counter()
+        expected = [
+            heapq.nsmallest(k, ((haversine_km(lat, lng, s_lat, s_lng), p) for s_lat, s_lng, p in stations),
+                            key=lambda hit: hit[0])
+            for lat, lng in queries
+        ]
+        brute_time = (time.perf_counter() - started) / len(queries)
+
+        for got, want in zip(answers, expected):
+            if [round(d, 9) for d, _ in got] != [round(d, 9) for d, _ in want]:
+                raise CommandError('Grid and brute force disagree.')
+
+        self.stdout.write(self.style.HTTP_INFO(
+            f"{options['stations']} stations in {len(grid.cells)} cells of {options['cell']}°, "
+            f"{len(queries)} lookups of k={k}\n"
+        ))
+        self.stdout.write(f'  index built in {built * 1000:.1f}ms')
+        self.stdout.write(f'  grid         {grid_time * 1e6:10.1f}us per lookup')
+        self.stdout.write(f'  brute force  {brute_time * 1e6:10.1f}us per lookup')
+        self.stdout.write(self.style.SUCCESS(f'  {brute_time / grid_time:.0f}x faster, same answers'))
@@ -0,0 +1,129 @@
+"""
+Load-test the sync and async PayPal capture views against a local stub
+gateway with a fixed number of workers. (STK pushes and PayPal order creation
+are queued as jobs in both modes, so the capture is the payment view that
+still waits on the gateway in the request.)
+
+Each sync worker is a thread that handles one request at a time, like a
+gunicorn sync worker; each async worker is an event loop that keeps up to
+``--concurrency`` requests in flight, like a uvicorn worker. With gateway
+latency L, sync throughput is capped near ``workers / L`` while async keeps
+scaling with the number of requests in flight.
+
+Usage:
+    python manage.py bench_payment_views
+    python manage.py bench_payment_views --requests 500 --workers 2 --latency 1.0
+"""
+
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import AsyncRequestFactory, RequestFactory, override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from store import async_views, views
+from store.gateway_stubs import StubGateway
+from store.models import Order
+
+BENCH_USER = '__bench_payments__'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark sync vs async payment views against a stub gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Captures per mode (default: 200)')
+        parser.add_argument('--workers', type=int, default=4, help='Workers per mode (default: 4)')
+        parser.add_argument('--concurrency', type=int, default=100,
+                            help='Requests in flight per async worker (default: 100)')
+        parser.add_argument('--latency', type=float, default=0.5, help='Stub gateway latency in seconds (default: 0.5)')
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(BENCH_USER, f'{BENCH_USER}@example.com', 'bench')
+        try:
+            order = Order.objects.create(
+                user=user, full_name=BENCH_USER, email=user.email, phone='0700000000',
+                currency='KES', subtotal=Decimal('100'), total=Decimal('100'),
+            )
+            self.auth = f'Bearer {RefreshToken.for_user(user).access_token}'
+            self.body = {'order_id': str(order.id), 'paypal_order_id': 'BENCH-PAYPAL'}
+
+            with StubGateway(latency=options['latency']) as stub, override_settings(
+                PAYPAL_BASE_URL=stub.url, PAYPAL_CLIENT_ID='bench', PAYPAL_CLIENT_SECRET='bench',
+                THROTTLE_ENABLED=False,
+            ):
+                self.stdout.write(self.style.HTTP_INFO(
+                    f"{options['requests']} PayPal captures, {options['workers']} worker(s), "
+                    f"gateway latency {options['latency'] * 1000:.0f}ms\n"
+                ))
+                for label, run in (('sync  (thread per request)', self._sync), ('async (event loop)', self._async)):
+                    elapsed, latencies, failures = run(options)
+                    self._report(label, options['requests'], elapsed, latencies, failures)
+        finally:
+            Order.objects.filter(user__username=BENCH_USER).delete()
+            User.objects.filter(username=BENCH_USER).delete()
+
+    def _report(self, label, total, elapsed, latencies, failures):
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        self.stdout.write(
+            f'  {label:28} {elapsed:7.2f}s  {total / elapsed:8.1f} req/s  '
+            f'p50 {statistics.median(latencies) * 1000 if latencies else 0:7.0f}ms  '
+            f'p95 {p95 * 1000:7.0f}ms  failures {failures}'
+        )
+
+    # ── Sync: one request per worker thread at a time ───────────────────────
+
+    def _sync(self, options):
+        view = views.PayPalCaptureView.as_view()
+        factory = RequestFactory()
+
+        def call(_):
+            request = factory.post('/api/payments/paypal/capture/', self.body, content_type='application/json',
+                                   headers={'Authorization': self.auth})
+            started = time.perf_counter()
+            status = view(request).status_code
+            return time.perf_counter() - started, status
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            results = list(pool.map(call, range(options['requests'])))
+        return time.perf_counter() - started, [t for t, _ in results], sum(s != 200 for _, s in results)
+
+    # ── Async: each worker is an event loop with many requests in flight ────
+
+    def _async(self, options):
+        view = async_views.PayPalCaptureView.as_view()
+        factory = AsyncRequestFactory()
+        results, lock = [], threading.Lock()
+
+        async def worker(count):
+            limit = asyncio.Semaphore(options['concurrency'])
+
+            async def call():
+                async with limit:
+                    request = factory.post('/api/payments/paypal/capture/', self.body,
+                                           content_type='application/json', headers={'Authorization': self.auth})
+                    started = time.perf_counter()
+                    status = (await view(request)).status_code
+                    return time.perf_counter() - started, status
+
+            done = await asyncio.gather(*(call() for _ in range(count)))
+            with lock:
+                results.extend(done)
+
+        workers, total = options['workers'], options['requests']
+        shares = [total // workers + (i < total % workers) for i in range(workers)]
+        started = time.perf_counter()
+        threads = [threading.Thread(target=asyncio.run, args=(worker(n),)) for n in shares]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - started, [t for t, _ in results], sum(s != 200 for _, s in results)
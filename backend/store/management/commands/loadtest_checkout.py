@@ -0,0 +1,259 @@
+"""
+End-to-end checkout load test: register → cart → order → pay → paid.
+
+Each virtual shopper registers, adds the load-test product to their cart,
+places an order and pays for it by M-Pesa (STK push, then waits for the
+callback through the watch endpoint) or PayPal (create, wait for the job,
+capture). ``--concurrency`` shoppers run at once. The report gives the
+p50/p95/p99 latency of every step and end-to-end orders paid per second.
+
+By default everything runs in this process against a stub gateway
+(store/gateway_stubs.py): a threaded WSGI server for the API, job worker
+threads in place of ``run_jobs`` and a callback thread in place of
+``process_mpesa_callbacks``. With ``--base-url`` it drives a server you
+started yourself instead. Point that one at ``run_stub_gateway``, run its
+workers alongside and start it with ``THROTTLE_ENABLED=0``, since every
+shopper comes from one IP.
+
+Shoppers, their orders and the load-test product are deleted afterwards
+(in-process mode only; use ``--keep`` to look at them).
+
+Usage:
+    python manage.py loadtest_checkout
+    python manage.py loadtest_checkout --shoppers 500 --concurrency 32 --latency 0.3 --error-rate 0.02
+    python manage.py loadtest_checkout --base-url http://127.0.0.1:8000 --method paypal
+"""
+
+import itertools
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import requests
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.db import close_old_connections, connection
+from django.test import override_settings
+
+from store import callbacks, jobs
+from store.gateway_stubs import StubGateway
+from store.models import Category, Order, Product, ProductVariant
+
+PREFIX = '__load_'
+STEPS = ('register', 'cart', 'order', 'pay', 'settle', 'total')
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+class Command(BaseCommand):
+    help = 'Load-test checkout end to end and report step latencies and orders/s'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shoppers', type=int, default=100, help='Virtual shoppers (default: 100)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Shoppers at once (default: 8)')
+        parser.add_argument('--method', choices=['mpesa', 'paypal', 'mixed'], default='mixed',
+                            help='How shoppers pay (default: mixed)')
+        parser.add_argument('--base-url', help='Drive this server instead of an in-process one')
+        parser.add_argument('--product', help='Product id to buy with --base-url (needs stock)')
+        parser.add_argument('--settle-timeout', type=float, default=60, help='Seconds to wait for payment (default: 60)')
+        parser.add_argument('--latency', type=float, default=0.1, help='In-process stub latency (default: 0.1)')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='In-process stub 503 rate (default: 0)')
+        parser.add_argument('--failure-rate', type=float, default=0.0,
+                            help='In-process stub share of cancelled STK pushes (default: 0)')
+        parser.add_argument('--callback-delay', type=float, default=0.5,
+                            help='In-process stub seconds before calling back (default: 0.5)')
+        parser.add_argument('--job-threads', type=int, default=4, help='In-process job worker threads (default: 4)')
+        parser.add_argument('--keep', action='store_true', help="Don't delete what the run created")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.run_id = uuid.uuid4().hex[:6]
+        if options['base_url']:
+            if not options['product']:
+                raise CommandError('--base-url needs --product <product id> with stock to buy.')
+            self.base_url = options['base_url'].rstrip('/')
+            self.product_id, self.variant_id = options['product'], None
+            return self._run()
+        self._serve_and_run()
+
+    # ── In-process environment ───────────────────────────────────────────────
+
+    def _serve_and_run(self):
+        options = self.options
+        category = Category.objects.create(name=f'{PREFIX}{self.run_id}', slug=f'{PREFIX}{self.run_id}')
+        product = Product.objects.create(name=f'{PREFIX}{self.run_id}', category=category,
+                                         price_usd=Decimal('10.00'), price_kes=Decimal('1300.00'))
+        variant = ProductVariant.objects.create(product=product, name='Default', stock=10 ** 6)
+        self.product_id, self.variant_id = str(product.id), variant.id
+
+        server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler, allow_reuse_address=False)
+        server.daemon_threads = True
+        server.set_app(get_internal_wsgi_application())
+        self.base_url = f'http://127.0.0.1:{server.server_port}'
+        stop = threading.Event()
+        stub = StubGateway(latency=options['latency'], error_rate=options['error_rate'], callbacks=True,
+                           callback_delay=options['callback_delay'], failure_rate=options['failure_rate'],
+                           auto_approve=True)
+        threads = [threading.Thread(target=server.serve_forever, daemon=True)]
+        threads += [threading.Thread(target=self._work, args=(stop, jobs.run_pending), daemon=True)
+                    for _ in range(options['job_threads'])]
+        threads.append(threading.Thread(target=self._work, args=(stop, callbacks.apply_all), daemon=True))
+        try:
+            with stub, override_settings(
+                MPESA_BASE_URL=stub.url, MPESA_CONSUMER_KEY='load', MPESA_CONSUMER_SECRET='load',
+                PAYPAL_BASE_URL=stub.url, PAYPAL_CLIENT_ID='load', PAYPAL_CLIENT_SECRET='load',
+                MPESA_CALLBACK_URL=f'{self.base_url}/api/payments/mpesa/callback/', THROTTLE_ENABLED=False,
+            ):
+                for t in threads:
+                    t.start()
+                self._run()
+                self.stdout.write(f'  stub gateway hits: {dict(sorted(stub.hits.items()))}')
+        finally:
+            stop.set()
+            server.shutdown()
+            server.server_close()
+            for t in threads[1:]:
+                t.join()
+            if not options['keep']:
+                Order.objects.filter(user__username__startswith=f'{PREFIX}{self.run_id}').delete()
+                User.objects.filter(username__startswith=f'{PREFIX}{self.run_id}').delete()
+                product.delete()
+                category.delete()
+
+    @staticmethod
+    def _work(stop, drain):
+        """Worker thread: run ``drain()`` until told to stop, napping when there's nothing to do."""
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                if not drain():
+                    stop.wait(0.05)
+        finally:
+            connection.close()
+
+    # ── Virtual shoppers ─────────────────────────────────────────────────────
+
+    def _run(self):
+        options = self.options
+        methods = {'mpesa': ['mpesa'], 'paypal': ['paypal'], 'mixed': ['mpesa', 'paypal']}[options['method']]
+        plan = list(zip(range(options['shoppers']), itertools.cycle(methods)))
+        self.timings, self.outcomes, self.lock = defaultdict(list), Counter(), threading.Lock()
+        self.stdout.write(self.style.HTTP_INFO(
+            f"{options['shoppers']} shoppers, {options['concurrency']} at a time, paying by {options['method']} "
+            f'against {self.base_url}\n'
+        ))
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            list(pool.map(self._shopper, plan))
+        self._report(time.perf_counter() - started)
+
+    def _shopper(self, job):
+        n, method = job
+        session = requests.Session()
+        marks = {'start': time.perf_counter()}
+        try:
+            outcome = self._checkout(session, n, method, marks)
+        except (requests.RequestException, LoadTestError) as e:
+            outcome = f'error: {e}'
+        finally:
+            session.close()
+        with self.lock:
+            self.outcomes[outcome] += 1
+            if outcome == 'paid':
+                previous = marks['start']
+                for step in STEPS[:-1]:
+                    self.timings[step].append(marks[step] - previous)
+                    previous = marks[step]
+                self.timings['total'].append(marks['settle'] - marks['start'])
+
+    def _call(self, session, method, path, expect, **kwargs):
+        r = session.request(method, f'{self.base_url}/api{path}', timeout=60, **kwargs)
+        if r.status_code not in expect:
+            raise LoadTestError(f'{method} {path} -> {r.status_code} {r.text[:120]}')
+        return r.json()
+
+    def _checkout(self, session, n, method, marks):
+        username = f'{PREFIX}{self.run_id}_{n}'
+        tokens = self._call(session, 'POST', '/auth/register/', (201,), json={
+            'username': username, 'email': f'{username}@example.com', 'first_name': 'Load', 'last_name': 'Test',
+            'password': 'load-test-pass', 'password2': 'load-test-pass',
+        })['tokens']
+        session.headers['Authorization'] = f"Bearer {tokens['access']}"
+        marks['register'] = time.perf_counter()
+
+        self._call(session, 'POST', '/cart/', (200, 201),
+                   json={'product_id': self.product_id, 'variant_id': self.variant_id, 'quantity': 1})
+        marks['cart'] = time.perf_counter()
+
+        order = self._call(session, 'POST', '/orders/', (201,), json={
+            'full_name': 'Load Test', 'email': f'{username}@example.com', 'phone': '0712345678',
+            'payment_method': method, 'currency': 'KES' if method == 'mpesa' else 'USD', 'delivery_type': 'home',
+        })
+        marks['order'] = time.perf_counter()
+
+        if method == 'mpesa':
+            self._call(session, 'POST', '/payments/mpesa/stk-push/', (200, 202),
+                       json={'phone': '0712345678', 'order_id': order['id']})
+            marks['pay'] = time.perf_counter()
+            outcome = self._wait_for_payment(session, order['id'])
+        else:
+            queued = self._call(session, 'POST', '/payments/paypal/create/', (200, 202), json={'order_id': order['id']})
+            marks['pay'] = time.perf_counter()
+            created = self._wait_for_job(session, queued) if 'job_id' in queued else queued
+            captured = self._call(session, 'POST', '/payments/paypal/capture/', (200, 400),
+                                  json={'order_id': order['id'], 'paypal_order_id': created['paypal_order_id']})
+            outcome = 'paid' if captured.get('status') == 'success' else 'failed'
+        marks['settle'] = time.perf_counter()
+        return outcome
+
+    def _wait_for_payment(self, session, order_id):
+        deadline = time.perf_counter() + self.options['settle_timeout']
+        version = None
+        while time.perf_counter() < deadline:
+            status = self._call(session, 'GET', f'/payments/status/{order_id}/watch/', (200,),
+                                params={'since': version, 'timeout': 25} if version else {})
+            version = status['version']
+            if status['payment_status'] in ('paid', 'failed'):
+                return status['payment_status']
+            if (status['job'] or {}).get('status') == 'dead':
+                return 'push failed'
+        return 'timed out'
+
+    def _wait_for_job(self, session, queued):
+        deadline = time.perf_counter() + self.options['settle_timeout']
+        while time.perf_counter() < deadline:
+            job = self._call(session, 'GET', f"/payments/jobs/{queued['job_id']}/", (200,))
+            if job['status'] == 'succeeded':
+                return job['result']
+            if job['status'] == 'dead':
+                raise LoadTestError(f"PayPal order creation failed: {job.get('error')}")
+            time.sleep(0.1)
+        raise LoadTestError('PayPal order creation timed out')
+
+    # ── Report ───────────────────────────────────────────────────────────────
+
+    def _report(self, elapsed):
+        self.stdout.write(f"  {'step':<10}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for step in STEPS:
+            values = sorted(self.timings[step])
+            self.stdout.write(
+                f'  {step:<10}{len(values):>7}' + ''.join(f'{percentile(values, p) * 1000:>8.0f}ms' for p in (0.5, 0.95, 0.99))
+            )
+        paid = self.outcomes['paid']
+        self.stdout.write(f'  outcomes: {dict(self.outcomes.most_common())}')
+        self.stdout.write(self.style.SUCCESS(f'  {paid} orders paid in {elapsed:.1f}s: {paid / elapsed:.1f} orders/s'))
+
+
+class LoadTestError(Exception):
+    pass
@@ -0,0 +1,37 @@
+"""
+Apply stored M-Pesa callbacks (see store/callbacks.py).
+
+Usage:
+    python manage.py process_mpesa_callbacks                  # drain the inbox once (cron)
+    python manage.py process_mpesa_callbacks --loop           # keep draining, polling every second
+    python manage.py process_mpesa_callbacks --loop --interval 0.2 --batch 500
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from store.callbacks import apply_all
+
+
+class Command(BaseCommand):
+    help = 'Apply M-Pesa callbacks from the inbox in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling until interrupted')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls with --loop (default: 1)')
+        parser.add_argument('--batch', type=int, default=settings.MPESA_CALLBACK_BATCH_SIZE,
+                            help=f'Callbacks per transaction (default: {settings.MPESA_CALLBACK_BATCH_SIZE})')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = apply_all(options['batch'])
+            if processed or not options['loop']:
+                self.stdout.write(f'Processed {processed} callback(s).')
+            if not options['loop']:
+                return
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,18 @@
+"""
+Delete expired Idempotency-Key records.
+
+Usage:
+    python manage.py purge_idempotency_keys      # run from cron, e.g. hourly
+"""
+
+from django.core.management.base import BaseCommand
+
+from store.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Delete expired Idempotency-Key records'
+
+    def handle(self, *args, **options):
+        deleted = purge_expired()
+        self.stdout.write(self.style.SUCCESS(f'Purged {deleted} expired idempotency key(s).'))
@@ -0,0 +1,43 @@
+"""
+Re-check payments stuck in pending with the gateways (see store/reconcile.py).
+
+Usage:
+    python manage.py reconcile_payments                       # pending for over PAYMENT_RECONCILE_AFTER minutes
+    python manage.py reconcile_payments --older-than 60 --concurrency 16
+    python manage.py reconcile_payments --limit 500 --batch 50
+
+Safe to run from cron alongside the workers: every update is guarded on the
+transaction still being pending.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from store.reconcile import reconcile
+
+COLUMNS = ('checked', 'paid', 'failed', 'pending', 'errors')
+
+
+class Command(BaseCommand):
+    help = 'Reconcile stale pending M-Pesa and PayPal payments with the gateways'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.PAYMENT_RECONCILE_AFTER,
+                            help=f'Minutes a payment must have been pending (default: {settings.PAYMENT_RECONCILE_AFTER})')
+        parser.add_argument('--concurrency', type=int, default=8, help='Gateway calls in flight (default: 8)')
+        parser.add_argument('--batch', type=int, default=100, help='Results applied per transaction (default: 100)')
+        parser.add_argument('--limit', type=int, default=None, help='Check at most this many per gateway')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        report = reconcile(options['older_than'], options['concurrency'], options['batch'], options['limit'])
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(f"{'gateway':<10}" + ''.join(f'{c:>9}' for c in COLUMNS))
+        for gateway, counts in report.items():
+            self.stdout.write(f'{gateway:<10}' + ''.join(f'{counts[c]:>9}' for c in COLUMNS))
+        checked = sum(counts['checked'] for counts in report.values())
+        style = self.style.WARNING if any(counts['errors'] for counts in report.values()) else self.style.SUCCESS
+        self.stdout.write(style(f'Reconciled {checked} payment(s) in {elapsed:.1f}s.'))
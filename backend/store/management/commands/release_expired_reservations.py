@@ -0,0 +1,34 @@
+"""
+Release stock reservations whose payment window has lapsed.
+
+Usage:
+    python manage.py release_expired_reservations                 # one sweep (cron)
+    python manage.py release_expired_reservations --loop          # sweep every 60s
+    python manage.py release_expired_reservations --loop --interval 15
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.reservations import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Release stock reservations past STOCK_RESERVATION_TTL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep sweeping until interrupted')
+        parser.add_argument('--interval', type=int, default=60, help='Seconds between sweeps with --loop (default: 60)')
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired()
+            if released or not options['loop']:
+                self.stdout.write(f'Released {released} expired reservation(s).')
+            if not options['loop']:
+                return
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,63 @@
+"""
+Requeue stored M-Pesa callbacks, or import raw ones, so the inbox worker
+applies them (again). Applying is idempotent: a callback that already took
+effect is recorded as a duplicate.
+
+Usage:
+    python manage.py replay_mpesa_callbacks --checkout-request-id ws_CO_123 --apply
+    python manage.py replay_mpesa_callbacks --outcome unknown --since 2026-01-31T00:00
+    python manage.py replay_mpesa_callbacks --file callbacks.jsonl    # one raw callback body per line
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from store import callbacks
+from store.models import MpesaCallback
+
+
+class Command(BaseCommand):
+    help = 'Requeue or import M-Pesa callbacks for the inbox worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkout-request-id', action='append', default=[], help='Requeue this callback (repeatable)')
+        parser.add_argument('--outcome', choices=['applied', 'duplicate', 'unknown'], help='Requeue callbacks with this outcome')
+        parser.add_argument('--since', help='Only callbacks received at or after this ISO timestamp')
+        parser.add_argument('--file', help='Import raw callback bodies from a JSON-lines file')
+        parser.add_argument('--apply', action='store_true', help='Apply the inbox now instead of leaving it to the worker')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            self._import(options['file'])
+        elif options['checkout_request_id'] or options['outcome'] or options['since']:
+            self._requeue(options)
+        else:
+            raise CommandError('Give --checkout-request-id, --outcome, --since or --file.')
+        if options['apply']:
+            self.stdout.write(f'Applied {callbacks.apply_all()} callback(s).')
+
+    def _requeue(self, options):
+        rows = MpesaCallback.objects.filter(processed_at__isnull=False)
+        if options['checkout_request_id']:
+            rows = rows.filter(checkout_request_id__in=options['checkout_request_id'])
+        if options['outcome']:
+            rows = rows.filter(outcome=options['outcome'])
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"Invalid --since timestamp: {options['since']}")
+            rows = rows.filter(received_at__gte=since)
+        self.stdout.write(f"Requeued {rows.update(processed_at=None, outcome='')} callback(s).")
+
+    def _import(self, path):
+        before = MpesaCallback.objects.count()
+        with open(path) as f:
+            for line_no, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        callbacks.record(json.loads(line))
+                    except ValueError as e:
+                        raise CommandError(f'{path}:{line_no}: {e}')
+        self.stdout.write(f'Imported {MpesaCallback.objects.count() - before} new callback(s).')
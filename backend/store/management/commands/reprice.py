@@ -0,0 +1,35 @@
+"""
+Recompute KES prices from USD prices at the current exchange rate (see store/pricing.py).
+
+Usage:
+    python manage.py reprice                      # current USD→KES rate, KES_PRICE_ROUNDING
+    python manage.py reprice --rate 131.25 --rounding 10
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from store.currency import CurrencyError
+from store.pricing import reprice
+
+
+class Command(BaseCommand):
+    help = 'Reprice KES prices of all products and variants from their USD prices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', help='USD→KES rate to use (default: the ExchangeRate table)')
+        parser.add_argument('--rounding', default=settings.KES_PRICE_ROUNDING,
+                            help=f'Round KES prices to a multiple of this (default: {settings.KES_PRICE_ROUNDING})')
+        parser.add_argument('--chunk-size', type=int, default=settings.REPRICE_CHUNK_SIZE,
+                            help=f'Rows per UPDATE (default: {settings.REPRICE_CHUNK_SIZE})')
+
+    def handle(self, *args, **options):
+        try:
+            run = reprice(rate=options['rate'], step=options['rounding'], chunk_size=options['chunk_size'])
+        except CurrencyError as e:
+            raise CommandError(f'{e} Add a USD→KES ExchangeRate or pass --rate.')
+        elapsed = (run.finished_at - run.started_at).total_seconds()
+        self.stdout.write(self.style.SUCCESS(
+            f'Repriced {run.products_updated} product(s) and {run.variants_updated} variant(s) at {run.rate} '
+            f'(rounded to {run.rounding}) in {elapsed:.1f}s; {run.products_locked} locked product(s) left as is.'
+        ))
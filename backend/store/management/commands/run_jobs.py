@@ -0,0 +1,67 @@
+"""
+Run background jobs (payment initiation etc.) on a local thread pool.
+
+Usage:
+    python manage.py run_jobs                     # run until interrupted
+    python manage.py run_jobs --threads 8
+    python manage.py run_jobs --once              # drain what is runnable now, then exit (cron)
+
+Start as many of these as you like; jobs are leased so each runs once.
+Every ``GATEWAY_LATENCY_LOG_INTERVAL`` seconds, and on exit, the worker logs
+its gateway latency histograms (gateways.log_latency()).
+"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from store import gateways, jobs
+
+
+def _run(job):
+    close_old_connections()
+    try:
+        return jobs.run(job)
+    finally:
+        connection.close()      # pool threads come and go; don't leak their connections
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=settings.JOB_WORKER_THREADS,
+                            help=f'Jobs to run at once (default: {settings.JOB_WORKER_THREADS})')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds between polls when idle (default: 1)')
+        parser.add_argument('--once', action='store_true', help='Exit once nothing is runnable')
+
+    def handle(self, *args, **options):
+        threads, outcomes = options['threads'], {}
+        self.stdout.write(f'Running jobs on {threads} thread(s)...')
+        inflight = set()
+        next_log = time.monotonic() + settings.GATEWAY_LATENCY_LOG_INTERVAL
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            try:
+                while True:
+                    if time.monotonic() >= next_log:
+                        gateways.log_latency()
+                        next_log = time.monotonic() + settings.GATEWAY_LATENCY_LOG_INTERVAL
+                    claimed = jobs.claim(threads - len(inflight))
+                    inflight.update(pool.submit(_run, job) for job in claimed)
+                    if not inflight:
+                        if options['once']:
+                            break
+                        time.sleep(options['poll'])
+                        continue
+                    done, inflight = wait(inflight, timeout=options['poll'], return_when=FIRST_COMPLETED)
+                    for future in done:
+                        status = future.result()
+                        outcomes[status] = outcomes.get(status, 0) + 1
+            except KeyboardInterrupt:
+                self.stdout.write('Stopping; waiting for running jobs to finish...')
+        gateways.log_latency()
+        summary = ', '.join(f'{n} {status}' for status, n in sorted(outcomes.items())) or 'nothing to do'
+        self.stdout.write(self.style.SUCCESS(f'Jobs: {summary}.'))
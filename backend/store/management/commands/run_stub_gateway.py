@@ -0,0 +1,50 @@
+"""
+Serve a local M-Pesa + PayPal stand-in (store/gateway_stubs.py) until interrupted.
+
+Point the API at it to load-test without the sandboxes:
+
+    python manage.py run_stub_gateway --port 9000 --latency 0.3 --error-rate 0.02 --failure-rate 0.1
+    MPESA_BASE_URL=http://127.0.0.1:9000 PAYPAL_BASE_URL=http://127.0.0.1:9000 \
+        MPESA_CONSUMER_KEY=stub MPESA_CONSUMER_SECRET=stub PAYPAL_CLIENT_ID=stub PAYPAL_CLIENT_SECRET=stub \
+        MPESA_CALLBACK_URL=http://127.0.0.1:8000/api/payments/mpesa/callback/ THROTTLE_ENABLED=0 \
+        python manage.py runserver
+
+STK pushes are called back automatically (turn off with ``--no-callbacks``)
+and PayPal orders come back already approved by the "buyer".
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.gateway_stubs import StubGateway
+
+
+class Command(BaseCommand):
+    help = 'Run local stand-ins for the Safaricom and PayPal APIs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=9000, help='Port (default: 9000)')
+        parser.add_argument('--latency', type=float, default=0.2, help='Seconds per gateway call (default: 0.2)')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls answered 503 (default: 0)')
+        parser.add_argument('--callback-delay', type=float, default=2.0,
+                            help='Seconds before an STK push is called back (default: 2)')
+        parser.add_argument('--failure-rate', type=float, default=0.0,
+                            help='Share of STK pushes the "shopper" cancels (default: 0)')
+        parser.add_argument('--no-callbacks', action='store_true', help='Never call back; leave pushes pending')
+
+    def handle(self, *args, **options):
+        stub = StubGateway(
+            latency=options['latency'], host=options['host'], port=options['port'],
+            error_rate=options['error_rate'], callbacks=not options['no_callbacks'],
+            callback_delay=options['callback_delay'], failure_rate=options['failure_rate'], auto_approve=True,
+        )
+        with stub:
+            self.stdout.write(self.style.SUCCESS(f'Stub gateway listening on {stub.url} (Ctrl-C to stop)'))
+            try:
+                while True:
+                    time.sleep(60)
+                    self.stdout.write(f'hits: {stub.hits}')
+            except KeyboardInterrupt:
+                self.stdout.write(f'hits: {stub.hits}')
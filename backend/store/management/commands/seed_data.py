@@ -21,6 +21,7 @@ from django.utils.text import slugify
 
 
 # ── Adjust this import path to match your app name ────────────────────────────
+from store.currency import convert
 from store.models import (
     Country, County, PickupStation,
     Category, Brand, Product, ProductVariant, ProductImage,
@@ -305,9 +306,8 @@ class Command(BaseCommand):
 
             price_usd = Decimal(str(tpl['price_usd']))
             sale_usd  = Decimal(str(tpl.get('sale_price_usd', 0))) or None
-            kes_rate  = Decimal('129.50')
-            price_kes = (price_usd * kes_rate).quantize(Decimal('1'))
-            sale_kes  = (sale_usd * kes_rate).quantize(Decimal('1')) if sale_usd else None
+            price_kes = convert(price_usd, 'USD', 'KES', places=Decimal('1'))
+            sale_kes  = convert(sale_usd, 'USD', 'KES', places=Decimal('1')) if sale_usd else None
 
             product = Product(
                 name=tpl['name'],
@@ -347,7 +347,7 @@ class Command(BaseCommand):
 
             # Variants
             for v_data in tpl.get('variants', []):
-                v_price_kes = (Decimal(str(v_data.get('price_usd', price_usd))) * kes_rate).quantize(Decimal('1'))
+                v_price_kes = convert(Decimal(str(v_data.get('price_usd', price_usd))), 'USD', 'KES', places=Decimal('1'))
                 ProductVariant.objects.create(
                     product=product,
                     name=v_data['name'],
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:46
+
+import store.identifiers
+from django.db import migrations, models
+
+
+def create_sequences(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        IdSequence = apps.get_model('store', 'IdSequence')
+        for name in store.identifiers.SEQUENCES:
+            IdSequence.objects.using(schema_editor.connection.alias).get_or_create(name=name)
+        return
+    for name in store.identifiers.SEQUENCES:
+        schema_editor.execute(
+            f'CREATE SEQUENCE IF NOT EXISTS {store.identifiers.sequence_name(name)} '
+            f'INCREMENT BY {store.identifiers.BLOCK_SIZE} START WITH 1'
+        )
+
+
+def drop_sequences(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in store.identifiers.SEQUENCES:
+        schema_editor.execute(f'DROP SEQUENCE IF EXISTS {store.identifiers.sequence_name(name)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('next_value', models.BigIntegerField(default=1)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='id',
+            field=models.UUIDField(default=store.identifiers.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='id',
+            field=models.UUIDField(default=store.identifiers.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.RunPython(create_sequences, drop_sequences),
+    ]
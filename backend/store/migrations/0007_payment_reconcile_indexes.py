@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_mpesa_callback_inbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['status', 'created_at'], name='mpesa_tx_stale_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paypaltransaction',
+            index=models.Index(fields=['status', 'created_at'], name='paypal_tx_stale_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_payment_reconcile_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='kes_price_locked',
+            field=models.BooleanField(default=False, help_text='Keep the KES prices (and variant KES prices) as entered when repricing'),
+        ),
+        migrations.CreateModel(
+            name='RepricingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rate', models.DecimalField(decimal_places=6, max_digits=14)),
+                ('rounding', models.DecimalField(decimal_places=2, help_text='KES prices rounded to a multiple of this', max_digits=10)),
+                ('scope', models.CharField(default='all products', max_length=200)),
+                ('products_updated', models.PositiveIntegerField(default=0)),
+                ('variants_updated', models.PositiveIntegerField(default=0)),
+                ('products_locked', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('started_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+INDEX = 'auth_user_email_ci_uniq'
+
+
+def check_duplicates(apps, schema_editor):
+    from django.db.models import Count
+    from django.db.models.functions import Lower
+
+    User = apps.get_model('auth', 'User')
+    duplicates = list(
+        User.objects.filter(email__gt='').values(email_ci=Lower('email'))
+        .annotate(n=Count('id')).filter(n__gt=1).values_list('email_ci', flat=True)[:20]
+    )
+    if duplicates:
+        raise RuntimeError(
+            f'Emails used by more than one account (ignoring case): {", ".join(duplicates)}. '
+            f'Give each account its own email, then migrate again.'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('store', '0008_repricing'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.RunSQL(
+            f"CREATE UNIQUE INDEX {INDEX} ON auth_user (LOWER(email)) WHERE email > ''",
+            f'DROP INDEX {INDEX}',
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_user_email_ci_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryZone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('is_default', models.BooleanField(default=False, help_text='Used for counties outside every other zone')),
+                ('eta_min_days', models.PositiveSmallIntegerField(default=1)),
+                ('eta_max_days', models.PositiveSmallIntegerField(default=3)),
+                ('free_over_kes', models.DecimalField(blank=True, decimal_places=2, help_text='Orders at or over this subtotal ship free (KES)', max_digits=12, null=True)),
+                ('free_over_usd', models.DecimalField(blank=True, decimal_places=2, help_text='Orders at or over this subtotal ship free (USD)', max_digits=10, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('counties', models.ManyToManyField(blank=True, related_name='delivery_zones', to='store.county')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DeliveryRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivery_type', models.CharField(choices=[('home', 'Home Delivery'), ('pickup', 'Pickup Station')], default='home', max_length=10)),
+                ('max_weight_kg', models.DecimalField(blank=True, decimal_places=3, help_text='Blank for no upper limit', max_digits=8, null=True)),
+                ('fee_kes', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('fee_usd', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('zone', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rates', to='store.deliveryzone')),
+            ],
+            options={
+                'ordering': ['zone', 'delivery_type', 'max_weight_kg'],
+            },
+        ),
+    ]
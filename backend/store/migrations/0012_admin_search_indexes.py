@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Case-insensitive prefix / exact search (``^field`` and ``=field`` in
+# search_fields). Django compiles those to ``col LIKE 'x%'`` on SQLite, which
+# a NOCASE index serves, and to ``UPPER(col::text) LIKE UPPER('x%')`` on
+# PostgreSQL, which needs a matching expression index.
+CI_INDEXES = [
+    ('order_full_name_ci', 'store_order', 'full_name'),
+    ('order_email_ci', 'store_order', 'email'),
+    ('product_name_ci', 'store_product', 'name'),
+    ('review_title_ci', 'store_review', 'title'),
+]
+
+
+def create_ci_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for name, table, column in CI_INDEXES:
+        if vendor == 'sqlite':
+            schema_editor.execute(f'CREATE INDEX {name} ON {table} ({column} COLLATE NOCASE)')
+        elif vendor == 'postgresql':
+            schema_editor.execute(f'CREATE INDEX {name} ON {table} (UPPER({column}::text) text_pattern_ops)')
+
+
+def drop_ci_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        for name, _, _ in CI_INDEXES:
+            schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_job_progress'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at'], name='order_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['phone'], name='order_phone_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['mpesa_transaction_id'], name='order_mpesa_receipt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['paypal_order_id'], name='order_paypal_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['created_at'], name='product_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recentlyviewed',
+            index=models.Index(fields=['viewed_at'], name='recently_viewed_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['helpful_votes', 'created_at'], name='review_ranking_idx'),
+        ),
+        migrations.RunPython(create_ci_indexes, drop_ci_indexes),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:13
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def drop_duplicate_session_views(apps, schema_editor):
+    # Anonymous views were never unique per (session, product); keep the newest row of each.
+    RecentlyViewed = apps.get_model('store', 'RecentlyViewed')
+    duplicated = (RecentlyViewed.objects.filter(session_key__isnull=False)
+                  .values('session_key', 'product').annotate(n=Count('pk'), keep=Max('pk')).filter(n__gt=1))
+    for row in duplicated:
+        (RecentlyViewed.objects.filter(session_key=row['session_key'], product=row['product'])
+         .exclude(pk=row['keep']).delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_admin_search_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recentlyviewed',
+            name='viewed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(drop_duplicate_session_views, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='recentlyviewed',
+            constraint=models.UniqueConstraint(fields=('session_key', 'product'), name='recently_viewed_session_product_uniq'),
+        ),
+    ]
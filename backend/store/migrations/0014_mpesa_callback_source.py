@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_recently_viewed_write_behind'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='mpesacallback',
+            name='mpesa_callback_once',
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='source',
+            field=models.CharField(choices=[('callback', 'Safaricom Callback'), ('stkpushquery', 'STK Push Query')], default='callback', max_length=20),
+        ),
+        migrations.AddConstraint(
+            model_name='mpesacallback',
+            constraint=models.UniqueConstraint(condition=models.Q(('source', 'callback')), fields=('checkout_request_id', 'result_code'), name='mpesa_callback_once'),
+        ),
+    ]
@@ -1,9 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils.text import slugify
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
 import uuid
 
+from .currency import CurrencyError, convert
+from .identifiers import new_asin, new_order_number, uuid7
+
 
 # ─── Geography ────────────────────────────────────────────────────────────────
 
@@ -69,6 +74,50 @@ class PickupStation(models.Model):
         return f"{self.name} ({self.county.name})"
 
 
+# ─── Delivery ─────────────────────────────────────────────────────────────────
+
+class DeliveryZone(models.Model):
+    """
+    Counties that share delivery rates and transit times (store/shipping.py).
+    Counties outside every zone use the ``is_default`` zone, if any.
+    """
+    name = models.CharField(max_length=100)
+    counties = models.ManyToManyField(County, blank=True, related_name='delivery_zones')
+    is_default = models.BooleanField(default=False, help_text='Used for counties outside every other zone')
+    eta_min_days = models.PositiveSmallIntegerField(default=1)
+    eta_max_days = models.PositiveSmallIntegerField(default=3)
+    free_over_kes = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True,
+                                        help_text='Orders at or over this subtotal ship free (KES)')
+    free_over_usd = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True,
+                                        help_text='Orders at or over this subtotal ship free (USD)')
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class DeliveryRate(models.Model):
+    """Fee for one delivery type up to a cart weight within a zone; the lightest matching tier applies."""
+    DELIVERY_CHOICES = [('home', 'Home Delivery'), ('pickup', 'Pickup Station')]
+
+    zone = models.ForeignKey(DeliveryZone, on_delete=models.CASCADE, related_name='rates')
+    delivery_type = models.CharField(max_length=10, choices=DELIVERY_CHOICES, default='home')
+    max_weight_kg = models.DecimalField(max_digits=8, decimal_places=3, null=True, blank=True,
+                                        help_text='Blank for no upper limit')
+    fee_kes = models.DecimalField(max_digits=10, decimal_places=2)
+    fee_usd = models.DecimalField(max_digits=8, decimal_places=2)
+
+    class Meta:
+        ordering = ['zone', 'delivery_type', 'max_weight_kg']
+
+    def __str__(self):
+        limit = f'≤ {self.max_weight_kg} kg' if self.max_weight_kg is not None else 'any weight'
+        return f'{self.zone} – {self.get_delivery_type_display()} {limit}'
+
+
 # ─── Catalogue ────────────────────────────────────────────────────────────────
 
 class Category(models.Model):
@@ -135,7 +184,7 @@ class Product(models.Model):
         ('used_acceptable', 'Used – Acceptable'),
     ]
 
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
     name = models.CharField(max_length=255)
     slug = models.SlugField(unique=True, blank=True, max_length=300)
     sku = models.CharField(max_length=100, unique=True, blank=True)
@@ -152,6 +201,9 @@ class Product(models.Model):
     sale_price_usd = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
     price_kes = models.DecimalField(max_digits=14, decimal_places=2, default=0)
     sale_price_kes = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+    kes_price_locked = models.BooleanField(
+        default=False, help_text='Keep the KES prices (and variant KES prices) as entered when repricing',
+    )
 
     # Flags
     is_active = models.BooleanField(default=True)
@@ -177,16 +229,18 @@ class Product(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['created_at'], name='product_created_idx')]
 
     def save(self, *args, **kwargs):
+        # The tail of the id is random; the head of a UUIDv7 is a timestamp
+        # shared by everything created in the same minute.
         if not self.slug:
             base = slugify(self.name)
-            self.slug = f"{base}-{str(self.id)[:8]}"
+            self.slug = f"{base}-{self.id.hex[-8:]}"
         if not self.sku:
-            self.sku = f"AMZ-{str(self.id)[:8].upper()}"
+            self.sku = f"AMZ-{self.id.hex[-8:].upper()}"
         if not self.asin:
-            import random, string
-            self.asin = 'B0' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+            self.asin = new_asin()
         super().save(*args, **kwargs)
 
     @property
@@ -195,7 +249,14 @@ class Product(models.Model):
 
     @property
     def effective_price_kes(self):
-        return self.sale_price_kes or self.price_kes
+        # Products priced in USD only are sold in KES at the current rate.
+        price = self.sale_price_kes or self.price_kes
+        if not price and self.effective_price_usd:
+            try:
+                return convert(self.effective_price_usd, 'USD', 'KES')
+            except CurrencyError:
+                pass
+        return price
 
     @property
     def discount_percent(self):
@@ -330,6 +391,7 @@ class Review(models.Model):
     class Meta:
         unique_together = ['product', 'user']
         ordering = ['-helpful_votes', '-created_at']
+        indexes = [models.Index(fields=['helpful_votes', 'created_at'], name='review_ranking_idx')]
 
     def __str__(self):
         return f"{self.user.username} – {self.rating}★ on {self.product.name}"
@@ -480,7 +542,7 @@ class Order(models.Model):
     CURRENCY_CHOICES = [('USD', 'USD'), ('KES', 'KES')]
     DELIVERY_CHOICES = [('home', 'Home Delivery'), ('pickup', 'Pickup Station')]
 
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
     order_number = models.CharField(max_length=25, unique=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='orders')
 
@@ -526,12 +588,17 @@ class Order(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], name='order_created_idx'),
+            # Exact-match admin search (OrderAdmin.get_search_results)
+            models.Index(fields=['phone'], name='order_phone_idx'),
+            models.Index(fields=['mpesa_transaction_id'], name='order_mpesa_receipt_idx'),
+            models.Index(fields=['paypal_order_id'], name='order_paypal_id_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.order_number:
-            import random, string
-            prefix = 'AMZ'
-            self.order_number = prefix + '-' + ''.join(random.choices(string.digits, k=10))
+            self.order_number = new_order_number()
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -558,6 +625,26 @@ class OrderItem(models.Model):
         return f"{self.quantity}× {self.product_name}"
 
 
+class StockReservation(models.Model):
+    """Variant quantity held for an order while its payment is pending (see store/reservations.py)."""
+    STATUS_CHOICES = [('active', 'Active'), ('committed', 'Committed'), ('released', 'Released')]
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['variant', 'status', 'expires_at'], name='reservation_available_idx'),
+            models.Index(fields=['status', 'expires_at'], name='reservation_sweep_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity}× {self.variant} for {self.order} ({self.status})"
+
+
 # ─── Payments ─────────────────────────────────────────────────────────────────
 
 class MpesaTransaction(models.Model):
@@ -574,10 +661,40 @@ class MpesaTransaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'], name='mpesa_tx_stale_idx')]   # reconcile_payments
+
     def __str__(self):
         return f"M-Pesa {self.checkout_request_id} – {self.status}"
 
 
+class MpesaCallback(models.Model):
+    """Raw STK callback as received, applied later in batches (see store/callbacks.py)."""
+    OUTCOME_CHOICES = [('applied', 'Applied'), ('duplicate', 'Duplicate'), ('unknown', 'Unknown Transaction')]
+    SOURCE_CHOICES = [('callback', 'Safaricom Callback'), ('stkpushquery', 'STK Push Query')]
+    checkout_request_id = models.CharField(max_length=200)
+    result_code = models.CharField(max_length=10)
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='callback')
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    outcome = models.CharField(max_length=10, choices=OUTCOME_CHOICES, blank=True)
+
+    class Meta:
+        constraints = [
+            # Query results (reconcile.py) carry no receipt, so they don't shadow the real callback.
+            models.UniqueConstraint(fields=['checkout_request_id', 'result_code'], name='mpesa_callback_once',
+                                    condition=models.Q(source='callback')),
+        ]
+        indexes = [
+            models.Index(fields=['received_at'], name='mpesa_callback_pending_idx',
+                         condition=models.Q(processed_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f"Callback {self.checkout_request_id} ({self.result_code})"
+
+
 class PayPalTransaction(models.Model):
     STATUS_CHOICES = [('created', 'Created'), ('approved', 'Approved'), ('completed', 'Completed'), ('failed', 'Failed')]
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='paypal_transactions')
@@ -590,6 +707,9 @@ class PayPalTransaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'], name='paypal_tx_stale_idx')]  # reconcile_payments
+
     def __str__(self):
         return f"PayPal {self.paypal_order_id} – {self.status}"
 
@@ -627,11 +747,15 @@ class RecentlyViewed(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='recently_viewed')
     session_key = models.CharField(max_length=40, null=True, blank=True)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
-    viewed_at = models.DateTimeField(auto_now=True)
+    viewed_at = models.DateTimeField(default=timezone.now)     # set by tracking.record(), not on save
 
     class Meta:
         ordering = ['-viewed_at']
+        indexes = [models.Index(fields=['viewed_at'], name='recently_viewed_at_idx')]
         unique_together = ['user', 'product']
+        constraints = [
+            models.UniqueConstraint(fields=['session_key', 'product'], name='recently_viewed_session_product_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.product.name} – viewed"
@@ -667,4 +791,88 @@ class ExchangeRate(models.Model):
         unique_together = ['from_currency', 'to_currency']
 
     def __str__(self):
-        return f"1 {self.from_currency} = {self.rate} {self.to_currency}"
\ No newline at end of file
+        return f"1 {self.from_currency} = {self.rate} {self.to_currency}"
+
+
+class RepricingRun(models.Model):
+    """One recomputation of KES prices from USD prices (see store/pricing.py)."""
+    rate = models.DecimalField(max_digits=14, decimal_places=6)
+    rounding = models.DecimalField(max_digits=10, decimal_places=2, help_text='KES prices rounded to a multiple of this')
+    scope = models.CharField(max_length=200, default='all products')
+    products_updated = models.PositiveIntegerField(default=0)
+    variants_updated = models.PositiveIntegerField(default=0)
+    products_locked = models.PositiveIntegerField(default=0)
+    started_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"Repricing at {self.rate} ({self.started_at:%Y-%m-%d %H:%M})"
+
+
+# ─── Identifiers ──────────────────────────────────────────────────────────────
+
+class IdSequence(models.Model):
+    """Counter behind order numbers/ASINs on databases without native sequences (see store/identifiers.py)."""
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField(default=1)
+
+    def __str__(self):
+        return f"{self.name} → {self.next_value}"
+
+
+# ─── Request Idempotency ──────────────────────────────────────────────────────
+
+class IdempotencyKey(models.Model):
+    """Stored outcome of a POST sent with an ``Idempotency-Key`` header (see store/idempotency.py)."""
+    STATUS_CHOICES = [('in_flight', 'In Flight'), ('completed', 'Completed')]
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='in_flight')
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ['user', 'key']
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
+
+
+# ─── Background Jobs ──────────────────────────────────────────────────────────
+
+class BackgroundJob(models.Model):
+    """A unit of work run by ``manage.py run_jobs`` (see store/jobs.py)."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('dead', 'Dead'),
+        ('cancelled', 'Cancelled'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    last_error = models.TextField(blank=True)
+    done = models.PositiveIntegerField(default=0)  # progress, for jobs that report it
+    total = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['status', 'run_after'], name='job_ready_idx')]
+
+    def __str__(self):
+        return f"{self.kind} {self.id} ({self.status})"
@@ -0,0 +1,70 @@
+"""
+Changelist pagination for large tables.
+
+Django's changelist paginator runs an exact ``COUNT(*)`` on every page load,
+which takes seconds on a multi-million-row table. ``EstimatedCountPaginator``
+counts differently:
+
+* An unfiltered changelist uses the planner's row estimate for the table,
+  once it is over ``ADMIN_ESTIMATED_COUNT_OVER`` rows. That is pg_class on
+  PostgreSQL, and sqlite_stat1 on SQLite once ANALYZE has run.
+* Anything else is counted exactly, and the count is cached for
+  ``ADMIN_COUNT_CACHE_SECONDS`` per query, so paging through results and
+  reloading don't count again.
+
+Past the estimate, the last page can be short or empty; nothing else
+depends on the count being exact.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils.functional import cached_property
+
+
+def table_estimate(model, using='default'):
+    """The database's estimate of ``model``'s row count, or None if it has none."""
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql, params = 'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table]
+    elif connection.vendor == 'sqlite':
+        # Each of the table's rows starts with its row count.
+        sql, params = 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table]
+    else:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+    except DatabaseError:       # sqlite_stat1 only exists once ANALYZE has run
+        return None
+    if row is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    return estimate if estimate >= 0 else None     # -1: never analyzed (PostgreSQL 14+)
+
+
+def estimated_count(queryset):
+    """A fast row count for ``queryset``: estimated when unfiltered and large, else exact and cached."""
+    query = queryset.query
+    if not query.where and not query.distinct and not query.combinator:
+        estimate = table_estimate(queryset.model, queryset.db)
+        if estimate is not None and estimate >= settings.ADMIN_ESTIMATED_COUNT_OVER:
+            return estimate
+    sql, params = query.sql_with_params()
+    key = 'admin-count:' + hashlib.sha256(f'{queryset.db}|{sql}|{params!r}'.encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, settings.ADMIN_COUNT_CACHE_SECONDS)
+    return count
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return estimated_count(self.object_list)
@@ -0,0 +1,163 @@
+"""
+Payment initiation jobs.
+
+``MpesaSTKPushView`` and ``PayPalCreateOrderView`` (sync and async) only
+enqueue these and answer ``202`` with the job id (``accepted()``), so a slow gateway never holds an API worker.
+A ``run_jobs`` worker then talks to the gateway. The shopper follows
+progress through ``MpesaStatusView`` or ``JobStatusView``.
+
+A gateway error is retried only when resending cannot duplicate the payment.
+PayPal calls carry a per-job ``PayPal-Request-Id``, so they are always safe
+to retry. An STK push is retried only if it never reached Safaricom.
+Otherwise the shopper could get a second prompt on their phone. For the same
+reason, any failure after Safaricom accepted a push, such as a database error
+while recording it, fails the job for good.
+
+A PayPal capture the shopper's return runs in the request
+(``PayPalCaptureView``). If PayPal refuses it, ``paypal_capture_failed()``
+fails the payment and releases the held stock, as a failed M-Pesa callback
+does.
+"""
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Max, Q
+from django.urls import reverse
+from django.utils import timezone
+
+from . import callbacks, events, gateways, jobs, reservations
+from .currency import convert
+from .gateways import GatewayError
+from .jobs import PermanentJobError
+from .models import MpesaTransaction, Order, PayPalTransaction
+
+MPESA_STK_PUSH = 'mpesa.stk_push'
+PAYPAL_CREATE_ORDER = 'paypal.create_order'
+PAYMENT_JOBS = (MPESA_STK_PUSH, PAYPAL_CREATE_ORDER)
+
+
+def _gateway_call(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except GatewayError as e:
+        if e.retryable:
+            raise
+        raise PermanentJobError(str(e))
+
+
+def mpesa_amount(order):
+    """What to charge over M-Pesa: the order total in whole Kenyan shillings."""
+    return int(convert(order.total, order.currency, 'KES', places=Decimal('1')))
+
+
+@jobs.handler(MPESA_STK_PUSH)
+def stk_push(job):
+    order, phone = job.order, job.payload['phone']
+    amount = mpesa_amount(order)
+    data = _gateway_call(gateways.mpesa_stk_push, order, phone, amount)
+    if data.get('ResponseCode') != '0':
+        raise PermanentJobError(data.get('errorMessage') or data.get('ResponseDescription') or 'Failed to initiate payment')
+
+    # Safaricom has accepted the push: from here on a retry would put a
+    # second prompt on the shopper's phone, so any failure is final.
+    try:
+        return _record_stk_push(order, phone, amount, data)
+    except Exception as e:
+        raise PermanentJobError(
+            f"STK push {data.get('CheckoutRequestID')} was sent but could not be recorded: {e}"
+        ) from e
+
+
+def _record_stk_push(order, phone, amount, data):
+    checkout_id = data['CheckoutRequestID']
+    with transaction.atomic():
+        MpesaTransaction.objects.create(
+            order=order,
+            checkout_request_id=checkout_id,
+            merchant_request_id=data.get('MerchantRequestID', ''),
+            amount=amount,
+            phone=phone,
+        )
+        order.mpesa_checkout_request_id = checkout_id
+        order.mpesa_phone = phone
+        order.status = 'payment_pending'
+        if order.payment_status == 'failed':        # a new attempt after a cancelled prompt
+            order.payment_status = 'pending'
+        order.save()
+    callbacks.requeue_unknown(checkout_id)     # in case Safaricom called back before we got here
+    return {'message': 'STK push sent. Check your phone.', 'checkout_request_id': checkout_id}
+
+
+@jobs.handler(PAYPAL_CREATE_ORDER)
+def paypal_create_order(job):
+    order = job.order
+    payload, currency = gateways.paypal_order_payload(order)
+    status_code, data = _gateway_call(gateways.paypal_create_order, payload, request_id=f'job-{job.id}')
+    if status_code != 201:
+        raise PermanentJobError(data.get('message') or 'PayPal order creation failed')
+
+    paypal_order_id = data['id']
+    approval_url = next(
+        (link['href'] for link in data.get('links', []) if link['rel'] == 'approve'), None
+    )
+    # A retried job gets the same PayPal order back (same request id).
+    PayPalTransaction.objects.update_or_create(
+        paypal_order_id=paypal_order_id,
+        defaults={'order': order, 'amount': order.total, 'currency': currency, 'raw_response': data},
+    )
+    order.paypal_order_id = paypal_order_id
+    order.status = 'payment_pending'
+    order.save()
+    return {'paypal_order_id': paypal_order_id, 'approval_url': approval_url}
+
+
+def paypal_capture_failed(order, paypal_order_id, data):
+    """PayPal refused the capture: fail the payment, unless already paid, and give the held stock back."""
+    with transaction.atomic():
+        PayPalTransaction.objects.filter(paypal_order_id=paypal_order_id, status__in=['created', 'approved']).update(
+            status='failed', raw_response=data, updated_at=timezone.now(),
+        )
+        if Order.objects.filter(pk=order.pk).exclude(payment_status='paid').update(
+                payment_status='failed', updated_at=timezone.now()):
+            reservations.release(order)
+    events.publish(order.id)
+
+
+def accepted(request, job, message):
+    """Body of the 202 a payment view sends for ``job``; poll ``status_url`` (or the order's M-Pesa status)."""
+    return {
+        'message': message,
+        'job_id': str(job.id),
+        'status': job.status,
+        'status_url': request.build_absolute_uri(reverse('job_status', args=[job.id])),
+    }
+
+
+# ── Status ────────────────────────────────────────────────────────────────────
+
+def status_queryset():
+    """Orders annotated with when their payment jobs last changed — with updated_at, the change stamp."""
+    return Order.objects.annotate(
+        payment_job_updated_at=Max('jobs__updated_at', filter=Q(jobs__kind__in=PAYMENT_JOBS)),
+    )
+
+
+def status_stamp(order):
+    """Change stamp of an order fetched through status_queryset() (see events.py)."""
+    return order.updated_at, order.payment_job_updated_at
+
+
+def payment_status(order):
+    job = order.jobs.filter(kind__in=PAYMENT_JOBS).order_by('-created_at').first()
+    return {
+        'payment_status': order.payment_status,
+        'order_status': order.status,
+        'job': jobs.progress(job) if job else None,
+    }
+
+
+def is_settled(status):
+    """Nothing more will happen without the shopper acting: stop watching."""
+    job = status['job'] or {}
+    return status['payment_status'] != 'pending' or job.get('status') == 'dead'
@@ -0,0 +1,96 @@
+"""
+Bulk repricing of KES prices from USD prices.
+
+When the USD → KES rate moves, ``reprice()`` (``manage.py reprice`` and the
+product admin action) recomputes every stored KES price at the current rate:
+
+* The work is set-based: one ``UPDATE ... SET price_kes = ROUND(price_usd *
+  rate / step) * step`` per range of ``REPRICE_CHUNK_SIZE`` primary keys.
+  No rows are loaded into Python, and each range commits on its own, so
+  rows are only locked briefly.
+* Prices are rounded to the nearest multiple of ``KES_PRICE_ROUNDING``
+  shillings.
+* A product with ``kes_price_locked`` keeps its KES prices, and its
+  variants' KES prices, as entered.
+* A variant without its own USD price keeps its KES override, if any. The
+  product price is used for it anyway.
+* A missing USD sale price clears the KES sale price.
+
+Each run is recorded as a RepricingRun.
+"""
+
+import logging
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Value
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from .currency import rate as exchange_rate
+from .models import Product, ProductVariant, RepricingRun
+
+logger = logging.getLogger('store')
+
+
+def _kes(field, rate, step):
+    """``field`` (a USD price column) in KES, rounded to ``step``; NULL stays NULL."""
+    kes = ExpressionWrapper(F(field) * Value(rate) / Value(step), output_field=DecimalField())
+    return ExpressionWrapper(Round(kes) * Value(step), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def _chunked_update(queryset, chunk_size, **changes):
+    """
+    Apply ``changes`` to ``queryset`` one primary-key range at a time; returns
+    rows updated. Ranges are cut from the whole table's pk index (one
+    boundary key per chunk), so ``queryset``'s filters are only evaluated by
+    the UPDATEs themselves.
+    """
+    keys = queryset.model._base_manager.order_by('pk').values_list('pk', flat=True)
+    updated, last = 0, None
+    while True:
+        window = queryset if last is None else queryset.filter(pk__gt=last)
+        boundary = list((keys if last is None else keys.filter(pk__gt=last))[chunk_size - 1:chunk_size])
+        if boundary:
+            window = window.filter(pk__lte=boundary[0])
+        with transaction.atomic():
+            updated += window.update(**changes)
+        if not boundary:
+            return updated
+        last = boundary[0]
+
+
+def reprice(products=None, rate=None, step=None, user=None, scope='all products', chunk_size=None):
+    """
+    Recompute KES prices of ``products`` (a Product queryset; all by default)
+    and their variants at ``rate`` (the current USD → KES rate by default).
+    Returns the finished RepricingRun.
+    """
+    rate = Decimal(str(rate)) if rate is not None else exchange_rate('USD', 'KES')
+    step = Decimal(str(step if step is not None else settings.KES_PRICE_ROUNDING))
+    chunk_size = chunk_size or settings.REPRICE_CHUNK_SIZE
+    products = Product.objects.all() if products is None else products
+
+    run = RepricingRun.objects.create(rate=rate, rounding=step, scope=scope, started_by=user)
+    run.products_locked = products.filter(kes_price_locked=True).count()
+    unlocked = products.filter(kes_price_locked=False)
+    run.products_updated = _chunked_update(
+        unlocked, chunk_size,
+        price_kes=_kes('price_usd', rate, step), sale_price_kes=_kes('sale_price_usd', rate, step),
+    )
+    variants = ProductVariant.objects.filter(price_usd__isnull=False)
+    if products.query.where:
+        variants = variants.filter(product__in=unlocked.values('pk'))
+    else:
+        # Whole catalogue: exclude the (few) locked products by id rather than
+        # re-running a subquery over every product in each chunk's UPDATE.
+        variants = variants.exclude(product__in=list(products.filter(kes_price_locked=True).values_list('pk', flat=True)))
+    run.variants_updated = _chunked_update(
+        variants, chunk_size,
+        price_kes=_kes('price_usd', rate, step), sale_price_kes=_kes('sale_price_usd', rate, step),
+    )
+    run.finished_at = timezone.now()
+    run.save()
+    logger.info(f'Repriced {run.products_updated} products / {run.variants_updated} variants at {rate}')
+    return run
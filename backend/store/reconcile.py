@@ -0,0 +1,190 @@
+"""
+Reconciliation of payments stuck in pending.
+
+A lost M-Pesa callback leaves its MpesaTransaction ``pending`` forever, and a
+PayPal order the shopper approved but never got back from stays unpaid.
+``reconcile()`` (run by ``manage.py reconcile_payments``) picks up the
+transactions still pending after ``PAYMENT_RECONCILE_AFTER`` minutes, asks
+the gateways how they ended, and applies the answers in batches.
+
+* The index on (status, created_at) keeps the scan cheap however large the
+  transaction tables grow.
+* Gateway calls run on a bounded thread pool. Workers only talk HTTP; every
+  database write happens on the calling thread, one transaction per batch.
+* An STK query result is written to the callback inbox as if Safaricom had
+  called back (``source`` ``stkpushquery``), then applied by
+  ``callbacks.apply_all()`` for those transactions only. It obeys the same
+  rules. It carries no receipt, so a late real callback for a success still
+  records the receipt; one for a failure is a duplicate.
+* A PayPal order the buyer ``APPROVED`` is captured with the same
+  ``PayPal-Request-Id`` the capture view uses, so the two can't both charge.
+  A ``COMPLETED`` order is marked paid. A ``VOIDED`` or unknown (expired)
+  order is marked failed and its stock released.
+
+Anything still in flight is left alone and counted as ``pending``.
+"""
+
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import callbacks, events, gateways, reservations
+from .gateways import GatewayError
+from .models import MpesaTransaction, Order, PayPalTransaction
+
+logger = logging.getLogger('store')
+
+MPESA_IN_FLIGHT = '500.001.1001'       # "The transaction is being processed"
+PAYPAL_OPEN = ('created', 'approved')
+
+
+def stale(model, statuses, older_than=None, limit=None):
+    """Transactions of ``model`` in ``statuses`` created more than ``older_than`` minutes ago, oldest first."""
+    older_than = settings.PAYMENT_RECONCILE_AFTER if older_than is None else older_than
+    qs = model.objects.filter(
+        status__in=statuses, created_at__lt=timezone.now() - timedelta(minutes=older_than),
+    ).order_by('created_at')
+    return qs[:limit] if limit else qs
+
+
+# ── Gateway checks (worker threads: HTTP only) ────────────────────────────────
+
+def check_mpesa(checkout_request_id):
+    """Return ``(verdict, callback body or None)``; verdict is pending/checked/error."""
+    try:
+        data = gateways.mpesa_stk_query(checkout_request_id)
+    except GatewayError as e:
+        return 'error', str(e)
+    if data.get('errorCode') == MPESA_IN_FLIGHT:
+        return 'pending', None
+    if 'ResultCode' not in data:
+        return 'error', data.get('errorMessage') or str(data)
+    return 'checked', {'Body': {'stkCallback': {
+        'MerchantRequestID': data.get('MerchantRequestID', ''),
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': data['ResultCode'],
+        'ResultDesc': data.get('ResultDesc', ''),
+    }}, 'source': 'stkpushquery'}
+
+
+def _capture_id(data):
+    return data['purchase_units'][0]['payments']['captures'][0]['id']
+
+
+def check_paypal(paypal_order_id):
+    """Return ``(verdict, detail)``; verdict is pending/completed/failed/error."""
+    try:
+        status_code, data = gateways.paypal_get_order(paypal_order_id)
+        if status_code == 404:
+            return 'failed', data
+        if status_code != 200:
+            return 'error', data.get('message') or f'HTTP {status_code}'
+        if data.get('status') == 'APPROVED':
+            _, data = gateways.paypal_capture(paypal_order_id, request_id=f'capture-{paypal_order_id}')
+    except GatewayError as e:
+        return 'error', str(e)
+    status = data.get('status')
+    if status == 'COMPLETED':
+        return 'completed', data
+    if status == 'VOIDED':
+        return 'failed', data
+    return 'pending', data
+
+
+# ── Applying results (calling thread) ─────────────────────────────────────────
+
+def apply_mpesa(bodies):
+    """Queue STK query results in the callback inbox and apply them; returns (paid, failed)."""
+    rows = callbacks.record_many(bodies, source='stkpushquery')
+    ids = [row.checkout_request_id for row in rows]
+    callbacks.apply_all(checkout_request_ids=ids)
+    outcome = Counter(MpesaTransaction.objects.filter(checkout_request_id__in=ids).values_list('status', flat=True))
+    return outcome['success'], outcome['failed']
+
+
+def apply_paypal(results):
+    """Apply ``{paypal_order_id: (verdict, body)}`` in one transaction; returns (orders paid, orders failed)."""
+    now = timezone.now()
+    with transaction.atomic():
+        txs = list(
+            PayPalTransaction.objects.select_for_update().select_related('order')
+            .filter(paypal_order_id__in=results, status__in=PAYPAL_OPEN).order_by('id')
+        )
+        orders = {}
+        for tx in txs:
+            # One instance per order, so a failed sibling can't undo a capture.
+            tx.order = order = orders.setdefault(tx.order_id, tx.order)
+            verdict, data = results[tx.paypal_order_id]
+            tx.raw_response = data
+            tx.updated_at = now
+            if verdict == 'completed':
+                tx.status = 'completed'
+                tx.capture_id = _capture_id(data)
+                order.payment_status = 'paid'
+                order.status = 'confirmed'
+                order.paypal_capture_id = tx.capture_id
+            else:
+                tx.status = 'failed'
+                if order.payment_status != 'paid':
+                    order.payment_status = 'failed'
+            order.updated_at = now
+
+        paid = list({tx.order_id: tx.order for tx in txs if tx.status == 'completed'}.values())
+        failed = [order for order in orders.values() if order.payment_status == 'failed']
+        PayPalTransaction.objects.bulk_update(txs, ['status', 'capture_id', 'raw_response', 'updated_at'])
+        Order.objects.bulk_update(paid, ['payment_status', 'status', 'paypal_capture_id', 'updated_at'])
+        Order.objects.bulk_update(failed, ['payment_status', 'updated_at'])
+        for order in paid:
+            reservations.commit(order)
+        if failed:
+            reservations.release(*failed)
+        order_ids = [tx.order_id for tx in txs]
+        transaction.on_commit(lambda: events.publish(*order_ids))
+    return len(paid), len(failed)
+
+
+# ── Driver ────────────────────────────────────────────────────────────────────
+
+def _run(keys, check, apply, report, concurrency, batch_size):
+    """Check ``keys`` on ``concurrency`` threads, applying the settled ones every ``batch_size`` results."""
+    settled = {}
+
+    def flush():
+        if settled:
+            paid, failed = apply(settled)
+            report['paid'] += paid
+            report['failed'] += failed
+            settled.clear()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for key, (verdict, detail) in zip(keys, pool.map(check, keys)):
+            report['checked'] += 1
+            if verdict == 'error':
+                report['errors'] += 1
+                logger.warning(f'Reconcile {key}: {detail}')
+            elif verdict == 'pending':
+                report['pending'] += 1
+            else:
+                settled[key] = (verdict, detail)
+                if len(settled) >= batch_size:
+                    flush()
+        flush()
+    return report
+
+
+def reconcile(older_than=None, concurrency=8, batch_size=100, limit=None):
+    """Reconcile stale M-Pesa and PayPal payments; returns ``{gateway: Counter}`` of outcomes."""
+    mpesa_ids = list(stale(MpesaTransaction, ['pending'], older_than, limit)
+                     .values_list('checkout_request_id', flat=True))
+    paypal_ids = list(stale(PayPalTransaction, PAYPAL_OPEN, older_than, limit)
+                      .values_list('paypal_order_id', flat=True))
+    return {
+        'mpesa': _run(mpesa_ids, check_mpesa, lambda settled: apply_mpesa([body for _, body in settled.values()]),
+                      Counter(), concurrency, batch_size),
+        'paypal': _run(paypal_ids, check_paypal, apply_paypal, Counter(), concurrency, batch_size),
+    }
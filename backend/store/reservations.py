@@ -0,0 +1,135 @@
+"""
+Stock reservations for orders whose payment is still pending.
+
+An M-Pesa or PayPal order holds its quantities in StockReservation rows
+instead of taking them off ``ProductVariant.stock`` straight away. What a
+shopper can buy is ``stock - active reservations``; the reservations are
+
+* committed (stock decremented) when the payment succeeds,
+* released when the payment fails, or
+* released by the sweeper (``manage.py release_expired_reservations``)
+  once ``STOCK_RESERVATION_TTL`` has passed.
+
+Reservations that have expired but not yet been swept already stop
+counting, so availability never depends on the sweeper having run.
+"""
+
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, Sum, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import ProductVariant, StockReservation
+
+logger = logging.getLogger('store')
+
+
+class InsufficientStock(Exception):
+    """Raised by lock_available() with a message that is safe to show to the shopper."""
+
+
+def reserved_quantities(variant_ids, now=None):
+    """Map variant id → quantity held by unexpired reservations (one indexed aggregate)."""
+    now = now or timezone.now()
+    rows = (
+        StockReservation.objects
+        .filter(variant_id__in=variant_ids, status='active', expires_at__gt=now)
+        .values('variant_id')
+        .annotate(held=Sum('quantity'))
+    )
+    return {row['variant_id']: row['held'] for row in rows}
+
+
+def available_quantities(variant_ids):
+    """Map variant id → stock a new order can still take."""
+    held = reserved_quantities(variant_ids)
+    return {
+        variant_id: max(stock - held.get(variant_id, 0), 0)
+        for variant_id, stock in ProductVariant.objects.filter(id__in=variant_ids).values_list('id', 'stock')
+    }
+
+
+def lock_available(wanted):
+    """
+    Lock the variants in ``wanted`` (variant id → quantity) in primary-key
+    order and check each one can cover its quantity. Must run inside a
+    transaction.
+    """
+    variants = list(ProductVariant.objects.select_for_update().filter(id__in=wanted).order_by('id'))
+    # Read the reservations only once the rows are locked, so holds made by
+    # checkouts we were queued behind are counted.
+    held = reserved_quantities(list(wanted))
+    for variant in variants:
+        available = variant.stock - held.get(variant.id, 0)
+        if not variant.is_active:
+            raise InsufficientStock(f'"{variant.name}" is no longer available.')
+        if available < wanted[variant.id]:
+            raise InsufficientStock(f'Only {max(available, 0)} left of "{variant.name}".')
+
+
+def _decrement(wanted, floor_at_zero=False):
+    """Take ``wanted`` quantities off stock in one UPDATE; returns rows updated."""
+    whens = []
+    guard = Q()
+    for variant_id, quantity in wanted.items():
+        new_stock = F('stock') - quantity
+        whens.append(When(id=variant_id, then=Greatest(new_stock, Value(0)) if floor_at_zero else new_stock))
+        guard |= Q(id=variant_id) if floor_at_zero else Q(id=variant_id, stock__gte=quantity)
+    return ProductVariant.objects.filter(guard).update(stock=Case(
+        *whens, default=F('stock'), output_field=PositiveIntegerField(),
+    ))
+
+
+def take(wanted):
+    """Decrement stock immediately (orders paid on delivery). Call after lock_available()."""
+    if _decrement(wanted) != len(wanted):
+        raise InsufficientStock('Some items in your cart just sold out.')
+
+
+def hold(order, wanted):
+    """Reserve ``wanted`` for ``order`` until the payment resolves or the TTL passes."""
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    StockReservation.objects.bulk_create([
+        StockReservation(order=order, variant_id=variant_id, quantity=quantity, expires_at=expires_at)
+        for variant_id, quantity in wanted.items()
+    ])
+
+
+def commit(order):
+    """
+    Payment succeeded: turn the order's reservations into a stock decrement.
+    Reservations that expired before the payment landed are committed too —
+    the customer has paid — with stock floored at zero.
+    """
+    with transaction.atomic():
+        reservations = list(
+            StockReservation.objects.select_for_update()
+            .filter(order=order, status__in=['active', 'released'])
+            .order_by('variant_id')
+        )
+        if not reservations:
+            return 0
+        wanted = defaultdict(int)
+        for r in reservations:
+            wanted[r.variant_id] += r.quantity
+            if r.status == 'released':
+                logger.warning(f'Order {order.order_number} paid after its reservation on variant {r.variant_id} lapsed')
+        list(ProductVariant.objects.select_for_update().filter(id__in=wanted).order_by('id').values_list('id'))
+        _decrement(wanted, floor_at_zero=True)
+        StockReservation.objects.filter(id__in=[r.id for r in reservations]).update(status='committed')
+    return len(reservations)
+
+
+def release(*orders):
+    """Payment failed: give the orders' held quantities back."""
+    return StockReservation.objects.filter(order__in=orders, status='active').update(status='released')
+
+
+def release_expired():
+    """Sweep reservations past their TTL; returns how many were released."""
+    return StockReservation.objects.filter(status='active', expires_at__lte=timezone.now()).update(status='released')
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from .models import (
     Country, County, PickupStation,
     Category, Brand, Product, ProductVariant, ProductImage,
@@ -8,6 +9,7 @@ from .models import (
     UserProfile, Wishlist, RecentlyViewed, Coupon,
     MpesaTransaction, PayPalTransaction, ExchangeRate
 )
+from .backends import users_with_email
 
 
 # ─── Geography ────────────────────────────────────────────────────────────────
@@ -370,6 +372,24 @@ class OrderCreateSerializer(serializers.Serializer):
     mpesa_phone = serializers.CharField(required=False, allow_blank=True)
 
 
+class QuoteCartSerializer(serializers.Serializer):
+    subtotal = serializers.DecimalField(max_digits=14, decimal_places=2, min_value=0)
+    weight_kg = serializers.DecimalField(max_digits=10, decimal_places=3, min_value=0, default=0)
+
+
+class QuoteDestinationSerializer(serializers.Serializer):
+    delivery_type = serializers.ChoiceField(choices=['home', 'pickup'], default='home')
+    county_id = serializers.IntegerField(required=False, allow_null=True)
+    pickup_station_id = serializers.IntegerField(required=False, allow_null=True)
+
+
+class ShippingQuoteSerializer(serializers.Serializer):
+    """Batch quote request; ``carts`` defaults to the signed-in user's cart."""
+    currency = serializers.ChoiceField(choices=['USD', 'KES'], default='KES')
+    carts = QuoteCartSerializer(many=True, required=False)
+    destinations = QuoteDestinationSerializer(many=True, allow_empty=False)
+
+
 # ─── User & Auth ──────────────────────────────────────────────────────────────
 
 class UserProfileSerializer(serializers.ModelSerializer):
@@ -390,6 +410,9 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'date_joined']
 
 
+EMAIL_TAKEN = 'An account with this email already exists.'
+
+
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, min_length=8)
     password2 = serializers.CharField(write_only=True)
@@ -404,15 +427,23 @@ class RegisterSerializer(serializers.ModelSerializer):
     def validate(self, attrs):
         if attrs['password'] != attrs['password2']:
             raise serializers.ValidationError({'password': 'Passwords do not match.'})
-        if User.objects.filter(email=attrs['email']).exists():
-            raise serializers.ValidationError({'email': 'An account with this email already exists.'})
+        if users_with_email(attrs['email']).exists():
+            raise serializers.ValidationError({'email': EMAIL_TAKEN})
         return attrs
 
     def create(self, validated_data):
         phone = validated_data.pop('phone', '')
         validated_data.pop('password2')
         password = validated_data.pop('password')
-        user = User.objects.create_user(password=password, **validated_data)
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(password=password, **validated_data)
+        except IntegrityError:
+            # Lost a race with another sign-up for the same email or username.
+            field = 'email' if users_with_email(validated_data['email']).exists() else 'username'
+            raise serializers.ValidationError(
+                {field: EMAIL_TAKEN if field == 'email' else 'A user with that username already exists.'}
+            )
         UserProfile.objects.create(user=user, phone=phone)
         return user
 
@@ -0,0 +1,196 @@
+"""
+Delivery fee and ETA quotes.
+
+Rules live in DeliveryZone / DeliveryRate (admin-editable):
+
+* A destination belongs to the zone holding its county: the county chosen
+  for home delivery, or the pickup station's county. Counties outside every
+  zone fall back to the ``is_default`` zone.
+* Within a zone, the fee is that of the lightest rate tier for the delivery
+  type that takes the cart's weight. No tier means that delivery type isn't
+  offered there.
+* A pickup station with its own fee set charges that fee instead. A fee set
+  in one currency only is converted for quotes in the other.
+* Carts at or over the zone's ``free_over_*`` subtotal ship free.
+* The ETA is the zone's ``eta_min_days``..``eta_max_days`` from today.
+
+With no zones at all, every destination gets the flat
+``DELIVERY_DEFAULT_FEES`` and ``DELIVERY_DEFAULT_ETA_DAYS``, as before zones
+existed.
+
+The tables are compiled into plain dicts and sorted tier lists, loaded with
+four queries and rebuilt every ``SHIPPING_RULES_TTL`` seconds or when a rule,
+zone or station changes (signals.py). Quoting costs no queries, so
+``quote_many()`` can price every cart × destination pair of a batch request
+in one go.
+"""
+
+import bisect
+import datetime
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+
+from .currency import CurrencyError, convert
+
+Quote = namedtuple('Quote', 'fee currency free zone eta_min eta_max')
+
+_lock = threading.Lock()
+_cache = {'expires': 0.0, 'rules': None}
+_NO_LIMIT = Decimal('Infinity')
+_DELIVERY_LABELS = {'home': 'Home delivery', 'pickup': 'Pickup'}
+
+
+class ShippingError(Exception):
+    """The destination can't be quoted (no such station, or no delivery offered there)."""
+
+
+class _Zone:
+    def __init__(self, row):
+        self.name = row.name
+        self.eta = (row.eta_min_days, row.eta_max_days)
+        self.free_over = {'KES': row.free_over_kes, 'USD': row.free_over_usd}
+        self.tiers = {}  # delivery type -> (sorted max weights, [{'KES': fee, 'USD': fee}, ...])
+
+    def add_tier(self, delivery_type, max_weight, fees):
+        weights, tier_fees = self.tiers.setdefault(delivery_type, ([], []))
+        at = bisect.bisect_left(weights, max_weight)
+        weights.insert(at, max_weight)
+        tier_fees.insert(at, fees)
+
+    def fee(self, delivery_type, weight):
+        if delivery_type not in self.tiers:
+            raise ShippingError(f'{_DELIVERY_LABELS[delivery_type]} is not available in {self.name}.')
+        weights, fees = self.tiers[delivery_type]
+        at = bisect.bisect_left(weights, weight)
+        if at == len(weights):
+            raise ShippingError(f'{weight} kg is over the delivery limit for {self.name}.')
+        return fees[at]
+
+
+class _Rules:
+    def __init__(self, zones, rates, memberships, stations):
+        self.zones = {row.id: _Zone(row) for row in zones}
+        self.default = next((self.zones[row.id] for row in zones if row.is_default), None)
+        for rate in rates:
+            self.zones[rate.zone_id].add_tier(
+                rate.delivery_type,
+                rate.max_weight_kg if rate.max_weight_kg is not None else _NO_LIMIT,
+                {'KES': rate.fee_kes, 'USD': rate.fee_usd},
+            )
+        self.county_zone = {}
+        for county_id, zone_id in memberships:
+            self.county_zone.setdefault(county_id, self.zones[zone_id])
+        self.stations = {  # station id -> (county id, own fees or None)
+            pk: (county_id, {'KES': fee_kes, 'USD': fee_usd} if fee_kes or fee_usd else None)
+            for pk, county_id, fee_kes, fee_usd in stations
+        }
+
+
+def _load():
+    from .models import DeliveryRate, DeliveryZone, PickupStation
+
+    zones = list(DeliveryZone.objects.filter(is_active=True).order_by('id'))
+    rates = list(DeliveryRate.objects.filter(zone__is_active=True))
+    memberships = list(
+        DeliveryZone.counties.through.objects.filter(deliveryzone__is_active=True)
+        .order_by('deliveryzone_id').values_list('county_id', 'deliveryzone_id')
+    )
+    stations = list(
+        PickupStation.objects.filter(is_active=True)
+        .values_list('id', 'county_id', 'delivery_fee_kes', 'delivery_fee_usd')
+    )
+    return _Rules(zones, rates, memberships, stations)
+
+
+def rules():
+    now = time.monotonic()
+    if _cache['expires'] <= now:
+        with _lock:
+            if _cache['expires'] <= now:
+                _cache['rules'] = _load()
+                _cache['expires'] = now + getattr(settings, 'SHIPPING_RULES_TTL', 300)
+    return _cache['rules']
+
+
+def invalidate():
+    _cache['expires'] = 0.0
+
+
+def cart_totals(cart_items, currency):
+    """(subtotal in ``currency``, weight in kg) of CartItems with products loaded."""
+    subtotal, weight = Decimal('0'), Decimal('0')
+    for item in cart_items:
+        subtotal += item.subtotal_kes if currency == 'KES' else item.subtotal_usd
+        weight += item.product.weight_kg * item.quantity
+    return subtotal, weight
+
+
+def _eta(days, today):
+    return today + datetime.timedelta(days=days[0]), today + datetime.timedelta(days=days[1])
+
+
+def _station_fee(fees, currency):
+    if fees[currency]:
+        return fees[currency]
+    other = 'USD' if currency == 'KES' else 'KES'
+    try:
+        return convert(fees[other], other, currency)
+    except CurrencyError as e:
+        raise ShippingError(str(e))
+
+
+def quote(delivery_type, currency, subtotal, weight, county_id=None, station_id=None, today=None, compiled=None):
+    """Fee and ETA to deliver a cart worth ``subtotal`` weighing ``weight`` kg; raises ShippingError."""
+    compiled = compiled or rules()
+    today = today or timezone.localdate()
+    station_fees = None
+    if delivery_type == 'pickup':
+        if station_id not in compiled.stations:
+            raise ShippingError('Choose an active pickup station.')
+        county_id, station_fees = compiled.stations[station_id]
+
+    if not compiled.zones:
+        if station_fees is not None:
+            fee = _station_fee(station_fees, currency)
+        elif delivery_type == 'pickup':
+            fee = Decimal('0')
+        else:
+            fee = Decimal(settings.DELIVERY_DEFAULT_FEES[currency])
+        return Quote(fee, currency, not fee, None, *_eta(settings.DELIVERY_DEFAULT_ETA_DAYS, today))
+
+    zone = compiled.county_zone.get(county_id, compiled.default)
+    if zone is None:
+        raise ShippingError('Choose a county to deliver to.' if county_id is None else
+                            'We do not deliver to this county yet.')
+    if station_fees is not None:
+        fee = _station_fee(station_fees, currency)
+    else:
+        fee = zone.fee(delivery_type, weight)[currency]
+    threshold = zone.free_over[currency]
+    free = not fee or (threshold is not None and subtotal >= threshold)
+    return Quote(Decimal('0') if free else fee, currency, free, zone.name, *_eta(zone.eta, today))
+
+
+def quote_many(currency, carts, destinations):
+    """
+    Quote every (cart, destination) pair. ``carts`` are (subtotal, weight)
+    pairs; ``destinations`` are dicts with ``delivery_type`` and ``county_id``
+    or ``pickup_station_id``. Yields (cart index, destination index, Quote or
+    ShippingError).
+    """
+    compiled, today = rules(), timezone.localdate()
+    for c, (subtotal, weight) in enumerate(carts):
+        for d, destination in enumerate(destinations):
+            try:
+                yield c, d, quote(
+                    destination['delivery_type'], currency, subtotal, weight,
+                    county_id=destination.get('county_id'), station_id=destination.get('pickup_station_id'),
+                    today=today, compiled=compiled,
+                )
+            except ShippingError as e:
+                yield c, d, e
@@ -0,0 +1,49 @@
+"""
+Cache invalidation hooks. Connected from StoreConfig.ready().
+"""
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import authentication, coupons, currency, geo, shipping
+from .models import (
+    Category, Country, County, Coupon, DeliveryRate, DeliveryZone, ExchangeRate, PickupStation, UserProfile,
+)
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+@receiver([post_save, post_delete], sender=Category)
+@receiver(m2m_changed, sender=Coupon.categories.through)
+def invalidate_coupon_cache(sender, **kwargs):
+    coupons.invalidate()
+
+
+@receiver([post_save, post_delete], sender=ExchangeRate)
+def invalidate_exchange_rates(sender, **kwargs):
+    currency.invalidate()
+
+
+@receiver([post_save, post_delete], sender=PickupStation)
+@receiver([post_save, post_delete], sender=County)
+@receiver([post_save, post_delete], sender=Country)
+def invalidate_pickup_index(sender, **kwargs):
+    geo.invalidate()
+
+
+@receiver([post_save, post_delete], sender=DeliveryZone)
+@receiver([post_save, post_delete], sender=DeliveryRate)
+@receiver([post_save, post_delete], sender=PickupStation)
+@receiver(m2m_changed, sender=DeliveryZone.counties.through)
+def invalidate_shipping_rules(sender, **kwargs):
+    shipping.invalidate()
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_user_snapshot(sender, instance, **kwargs):
+    user_id = instance.pk if sender is User else instance.user_id
+    authentication.invalidate(user_id)
+    # Again once committed, in case a request re-cached the old row meanwhile.
+    transaction.on_commit(lambda: authentication.invalidate(user_id))
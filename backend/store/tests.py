@@ -1,3 +1,1659 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import importlib
+import importlib.util
+import json
+import random
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DatabaseError, IntegrityError, connection, transaction
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, resolve
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import (
+    admin, async_views, authentication, bulk, callbacks, coupons, currency, events, gateways, geo, identifiers, jobs, payments,
+    pricing, reservations, shipping, throttling, tracking,
+)
+from .backends import users_with_email
+from .gateway_stubs import StubGateway
+from .gateways import GatewayError, latency_snapshot, mpesa_client, mpesa_tokens, paypal_tokens
+from .idempotency import purge_expired
+from .models import (
+    BackgroundJob, Brand, Cart, CartItem, Category, Country, County, Coupon, DeliveryRate, DeliveryZone, ExchangeRate,
+    IdempotencyKey, IdSequence, MpesaCallback, MpesaTransaction, Order, OrderItem, PayPalTransaction, PickupStation,
+    Product, ProductImage, ProductVariant, RecentlyViewed, RepricingRun, StockReservation, UserProfile,
+)
+from .serializers import EMAIL_TAKEN
+
+
+def make_product(name='Galaxy A15', price_usd='100.00', price_kes='13000.00', stock=5, category=None):
+    category = category or Category.objects.get_or_create(name='Phones', slug='phones')[0]
+    product = Product.objects.create(
+        name=name, category=category, price_usd=Decimal(price_usd), price_kes=Decimal(price_kes),
+    )
+    variant = ProductVariant.objects.create(product=product, name='128GB Black', stock=stock)
+    return product, variant
+
+
+def make_shopper(username='shopper', product=None, variant=None, quantity=1):
+    user = User.objects.create_user(username=username, email=f'{username}@example.com', password='pass12345')
+    if product is not None:
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=product, variant=variant, quantity=quantity)
+    return user
+
+
+ORDER_PAYLOAD = {
+    'full_name': 'Jane Wanjiku',
+    'email': 'jane@example.com',
+    'phone': '0712345678',
+    'payment_method': 'mpesa',
+    'currency': 'KES',
+    'delivery_type': 'home',
+}
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.product, self.variant = make_product(stock=3)
+        ProductImage.objects.create(product=self.product, image='products/a.jpg', order=1)
+        ProductImage.objects.create(product=self.product, image='products/b.jpg', is_primary=True, order=2)
+        self.user = make_shopper(product=self.product, variant=self.variant, quantity=2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_checkout_creates_order_and_decrements_stock(self):
+        r = self.client.post('/api/orders/', {**ORDER_PAYLOAD, 'payment_method': 'cod'}, format='json')
+        self.assertEqual(r.status_code, 201, r.content)
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 1)
+        item = OrderItem.objects.get(order_id=r.data['id'])
+        self.assertEqual(item.quantity, 2)
+        self.assertEqual(item.price, Decimal('13000.00'))
+        self.assertTrue(item.image_url.endswith('products/b.jpg'))
+        self.assertFalse(CartItem.objects.filter(cart__user=self.user).exists())
+
+    def test_insufficient_stock_rolls_back(self):
+        CartItem.objects.filter(cart__user=self.user).update(quantity=4)
+        r = self.client.post('/api/orders/', ORDER_PAYLOAD, format='json')
+        self.assertEqual(r.status_code, 409)
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 3)
+        self.assertFalse(Order.objects.exists())
+        self.assertTrue(CartItem.objects.filter(cart__user=self.user).exists())
+
+    def test_checkout_query_count_is_independent_of_cart_size(self):
+        cart = Cart.objects.get(user=self.user)
+        for i in range(5):
+            product, variant = make_product(name=f'Phone {i}', stock=10)
+            CartItem.objects.create(cart=cart, product=product, variant=variant)
+        shipping.rules()  # loaded once per SHIPPING_RULES_TTL, not per checkout
+        with self.assertNumQueries(16):
+            r = self.client.post('/api/orders/', ORDER_PAYLOAD, format='json')
+        self.assertEqual(r.status_code, 201, r.content)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    def checkout_at_once(self, shoppers, payload=ORDER_PAYLOAD):
+        """POST an order for every shopper from its own thread, all released together; returns the statuses."""
+        barrier = threading.Barrier(len(shoppers))
+        statuses = []
+
+        def checkout(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                barrier.wait()
+                statuses.append(client.post('/api/orders/', payload, format='json').status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(u,)) for u in shoppers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return statuses
+
+    def test_parallel_checkouts_for_last_unit_sell_it_once(self):
+        product, variant = make_product(stock=1)
+        shoppers = [make_shopper(f'buyer{i}', product, variant) for i in range(8)]
+        statuses = self.checkout_at_once(shoppers)
+
+        self.assertEqual(reservations.available_quantities([variant.id]), {variant.id: 0})
+        self.assertEqual(statuses.count(201), 1)
+        self.assertEqual(statuses.count(409), len(shoppers) - 1)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_checkouts_draw_order_numbers_from_one_block(self):
+        identifiers.reset()
+        self.addCleanup(identifiers.reset)
+        product, variant = make_product(stock=10)
+        statuses = self.checkout_at_once([make_shopper(f'buyer{i}', product, variant) for i in range(4)])
+
+        self.assertEqual(statuses, [201] * 4)
+        numbers = sorted(Order.objects.values_list('order_number', flat=True))
+        self.assertEqual(numbers, [f'AMZ-{n:012d}' for n in range(1, 5)])
+        # One block reserved outside the checkouts, not one locked UPDATE inside each.
+        self.assertEqual(IdSequence.objects.get(name='order_number').next_value, 1 + identifiers.BLOCK_SIZE)
+
+    def test_flash_sale_burst_never_exceeds_max_uses(self):
+        coupons.invalidate()
+        self.addCleanup(coupons.invalidate)
+        now = timezone.now()
+        Coupon.objects.create(
+            code='FLASH10', discount_type='percent', discount_value=Decimal('10'), max_uses=3,
+            valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1),
+        )
+        product, variant = make_product(price_kes='1000.00', stock=20)
+        shoppers = [make_shopper(f'flash{i}', product, variant) for i in range(6)]
+        statuses = self.checkout_at_once(shoppers, {**ORDER_PAYLOAD, 'coupon_code': 'flash10'})
+
+        self.assertEqual(statuses.count(201), 3)
+        self.assertEqual(statuses.count(400), 3)
+        self.assertEqual(Coupon.objects.get().used_count, 3)
+        self.assertEqual(Order.objects.count(), 3)
+        self.assertEqual(Order.objects.first().discount, Decimal('100.00'))
+
+
+class CouponTests(TestCase):
+    def setUp(self):
+        coupons.invalidate()
+        self.phones = Category.objects.create(name='Phones', slug='phones')
+        self.android = Category.objects.create(name='Android', slug='android', parent=self.phones)
+        self.audio = Category.objects.create(name='Audio', slug='audio')
+        now = timezone.now()
+        self.coupon = Coupon.objects.create(
+            code='PHONES10', discount_type='percent', discount_value=Decimal('10'),
+            valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1),
+        )
+        self.coupon.categories.add(self.phones)
+
+    def checkout(self, username, category, price_kes='1000.00'):
+        product, variant = make_product(name=f'Item {username}', price_kes=price_kes, category=category)
+        client = APIClient()
+        client.force_authenticate(make_shopper(username, product, variant))
+        return client.post('/api/orders/', {**ORDER_PAYLOAD, 'coupon_code': 'phones10'}, format='json')
+
+    def test_discount_only_applies_to_lines_in_coupon_category_tree(self):
+        product, variant = make_product(name='Buds', price_kes='500.00', category=self.audio)
+        user = make_shopper('mixed', *make_product(name='Pixel', price_kes='2000.00', category=self.android))
+        CartItem.objects.create(cart=user.cart, product=product, variant=variant)
+        client = APIClient()
+        client.force_authenticate(user)
+        r = client.post('/api/coupons/validate/', {'code': 'PHONES10', 'currency': 'KES'}, format='json')
+        self.assertEqual(r.status_code, 200, r.content)
+        self.assertEqual(r.data['discount'], 200.0)
+
+    def test_coupon_outside_its_categories_is_rejected(self):
+        r = self.checkout('audiophile', self.audio)
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(Coupon.objects.get().used_count, 0)
+
+
+
+class CurrencyTests(TestCase):
+    def setUp(self):
+        ExchangeRate.objects.create(from_currency='USD', to_currency='KES', rate=Decimal('129.50'))
+        ExchangeRate.objects.create(from_currency='EUR', to_currency='KES', rate=Decimal('140.20'))
+        currency.invalidate()
+        self.addCleanup(currency.invalidate)        # the rows roll back; don't leave them cached
+
+    def test_rates_load_once_and_convert_exactly(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(currency.convert('10.01', 'USD', 'KES'), Decimal('1296.30'))
+            self.assertEqual(currency.convert('1295', 'KES', 'USD'), Decimal('10.00'))      # inverse
+            self.assertEqual(currency.convert('100', 'EUR', 'USD'), Decimal('108.26'))      # through KES
+            self.assertEqual(currency.convert('5', 'KES', 'KES'), Decimal('5.00'))
+        with self.assertRaises(currency.CurrencyError):
+            currency.rate('USD', 'GBP')
+
+    def test_saving_a_rate_refreshes_the_cache(self):
+        self.assertEqual(currency.rate('USD', 'KES'), Decimal('129.50'))
+        ExchangeRate.objects.filter(from_currency='USD').update(rate=Decimal('1'))
+        self.assertEqual(currency.rate('USD', 'KES'), Decimal('129.50'))               # cached
+        rate = ExchangeRate.objects.get(from_currency='USD')
+        rate.rate = Decimal('130')
+        rate.save()
+        self.assertEqual(currency.rate('USD', 'KES'), Decimal('130'))
+        with self.assertNumQueries(0):
+            r = APIClient().get('/api/exchange-rates/')
+        self.assertEqual(len(r.data), 2)
+
+    def test_payments_use_the_current_rate(self):
+        order = Order(order_number='X', currency='USD', total=Decimal('10.50'))
+        self.assertEqual(payments.mpesa_amount(order), 1360)          # 1359.75, rounded half-up
+        order.currency, order.total = 'KES', Decimal('1295.00')
+        payload, charged_in = gateways.paypal_order_payload(order)
+        self.assertEqual((payload['purchase_units'][0]['amount']['value'], charged_in), ('10.00', 'USD'))
+
+    def test_usd_only_products_are_priced_in_kes(self):
+        product, _ = make_product(price_kes='0')
+        self.assertEqual(product.effective_price_kes, Decimal('12950.00'))
+
+
+
+class RepricingTests(TestCase):
+    def setUp(self):
+        ExchangeRate.objects.create(from_currency='USD', to_currency='KES', rate=Decimal('131.37'))
+        currency.invalidate()
+        self.addCleanup(currency.invalidate)
+
+    def test_reprices_products_and_variants_in_chunks(self):
+        product, variant = make_product(price_usd='10.00')
+        Product.objects.filter(pk=product.pk).update(sale_price_usd=Decimal('9.99'), sale_price_kes=Decimal('1'))
+        ProductVariant.objects.filter(pk=variant.pk).update(price_usd=Decimal('12.00'))
+        kes_only = ProductVariant.objects.create(product=product, name='KES override', price_kes=Decimal('999'))
+        locked, locked_variant = make_product(name='Locked', price_usd='10.00', price_kes='1500.00')
+        Product.objects.filter(pk=locked.pk).update(kes_price_locked=True)
+        ProductVariant.objects.filter(pk=locked_variant.pk).update(price_usd=Decimal('12.00'), price_kes=Decimal('1600'))
+        for n in range(3):
+            make_product(name=f'Extra {n}', price_usd='1.00')
+
+        out = StringIO()
+        call_command('reprice', '--rounding', '10', '--chunk-size', '2', stdout=out)
+
+        product.refresh_from_db()
+        self.assertEqual((product.price_kes, product.sale_price_kes), (Decimal('1310'), Decimal('1310')))
+        variant.refresh_from_db()
+        self.assertEqual(variant.price_kes, Decimal('1580'))
+        kes_only.refresh_from_db()
+        self.assertEqual(kes_only.price_kes, Decimal('999'))
+        locked.refresh_from_db()
+        locked_variant.refresh_from_db()
+        self.assertEqual((locked.price_kes, locked_variant.price_kes), (Decimal('1500'), Decimal('1600')))
+        self.assertEqual(list(Product.objects.filter(name__startswith='Extra').values_list('price_kes', flat=True)),
+                         [Decimal('130')] * 3)
+
+        run = RepricingRun.objects.get()
+        self.assertEqual((run.products_updated, run.variants_updated, run.products_locked), (4, 1, 1))
+        self.assertEqual(run.rate, Decimal('131.37'))
+        self.assertIn('Repriced 4 product(s) and 1 variant(s)', out.getvalue())
+
+    def test_clears_kes_sale_price_without_usd_sale_price(self):
+        product, _ = make_product()
+        Product.objects.filter(pk=product.pk).update(sale_price_kes=Decimal('100'))
+        pricing.reprice(rate='130')
+        product.refresh_from_db()
+        self.assertEqual((product.price_kes, product.sale_price_kes), (Decimal('13000'), None))
+
+
+class AdminChangelistTests(TestCase):
+    """Each changelist runs the same queries at 100 and 1000 rows, all on one page."""
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('root', 'root@example.com', 'pass12345'))
+        self.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        self.category = Category.objects.create(name='Phones', slug='phones')
+
+    def add_products(self, start, stop):
+        products = Product.objects.bulk_create([
+            Product(name=f'Phone {i}', slug=f'phone-{i}', sku=f'SKU-{i}', asin=f'B{i:09d}', brand=self.brand,
+                    category=self.category, price_usd=Decimal('100'), price_kes=Decimal('13000'))
+            for i in range(start, stop)
+        ])
+        ProductVariant.objects.bulk_create(
+            [ProductVariant(product=p, name='128GB', sku=f'VAR-{p.sku}', stock=3) for p in products]
+        )
+        ProductImage.objects.bulk_create(
+            [ProductImage(product=p, image=f'products/{p.slug}.jpg', is_primary=True) for p in products]
+        )
+        return products
+
+    def assert_constant_queries(self, model_admin, url, add_rows, existing=0):
+        """Grow to 100 then 1000 rows with ``add_rows(start, stop)``; returns the last response."""
+        counts = []
+        with mock.patch.object(model_admin, 'list_per_page', 1000):
+            for start, stop in ((existing, 100), (100, 1000)):
+                add_rows(start, stop)
+                cache.clear()   # cached changelist counts
+                with CaptureQueriesContext(connection) as queries:
+                    r = self.client.get(url)
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(len(r.context['cl'].result_list), stop)
+                counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        return r
+
+    def test_product_changelist(self):
+        r = self.assert_constant_queries(admin.ProductAdmin, '/admin/store/product/', self.add_products)
+        self.assertContains(r, 'products/phone-999.jpg')
+        self.assertContains(r, '✔ In Stock', count=1000)
+
+    def test_category_changelist(self):
+        self.add_products(0, 5)
+
+        def add_categories(start, stop):
+            Category.objects.bulk_create(
+                [Category(name=f'Sub {i}', slug=f'sub-{i}', parent=self.category) for i in range(start, stop)]
+            )
+
+        r = self.assert_constant_queries(admin.CategoryAdmin, '/admin/store/category/', add_categories, existing=1)
+        phones = next(c for c in r.context['cl'].result_list if c.pk == self.category.pk)
+        self.assertEqual(admin.CategoryAdmin.product_count(None, phones), 5)
+
+    def test_brand_changelist(self):
+        self.add_products(0, 5)
+
+        def add_brands(start, stop):
+            Brand.objects.bulk_create([Brand(name=f'Brand {i}', slug=f'brand-{i}') for i in range(start, stop)])
+
+        r = self.assert_constant_queries(admin.BrandAdmin, '/admin/store/brand/', add_brands, existing=1)
+        samsung = next(b for b in r.context['cl'].result_list if b.pk == self.brand.pk)
+        self.assertEqual(admin.BrandAdmin.product_count(None, samsung), 5)
+
+    def test_cart_changelist(self):
+        product = self.add_products(0, 1)[0]
+        variant = product.variants.get()
+
+        def add_carts(start, stop):
+            carts = Cart.objects.bulk_create([Cart(session_key=f'session-{i}') for i in range(start, stop)])
+            CartItem.objects.bulk_create([CartItem(cart=c, product=product, variant=variant, quantity=2) for c in carts])
+
+        r = self.assert_constant_queries(admin.CartAdmin, '/admin/store/cart/', add_carts)
+        self.assertContains(r, 'KES 26,000', count=1000)
+
+
+class LargeChangelistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.client.force_login(User.objects.create_superuser('root', 'root@example.com', 'pass12345'))
+        self.orders = [
+            Order.objects.create(full_name=name, email=f'{name.split()[0].lower()}@example.com', phone=phone,
+                                 subtotal=1, total=1)
+            for name, phone in [('Jane Doe', '+254712345678'), ('John Kamau', '0722000111'), ('Janet Wanjiru', '0733000222')]
+        ]
+
+    def changelist(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get('/admin/store/order/', params)
+        self.assertEqual(r.status_code, 200)
+        counts = [q['sql'] for q in queries if 'COUNT(' in q['sql'] and 'store_order' in q['sql']]
+        return [o.full_name for o in r.context['cl'].result_list], r.context['cl'].result_count, counts
+
+    @skipUnlessDBFeature('can_rollback_ddl')
+    @override_settings(ADMIN_ESTIMATED_COUNT_OVER=2)
+    def test_unfiltered_count_is_estimated_and_filtered_counts_are_cached(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE' if connection.vendor == 'sqlite' else f'ANALYZE {Order._meta.db_table}')
+        Order.objects.create(full_name='Late Order', email='late@example.com', phone='0700000000', subtotal=1, total=1)
+        names, count, counts = self.changelist()
+        self.assertEqual((len(names), count, counts), (4, 3, []))   # the estimate predates the fourth order
+        _, count, counts = self.changelist(status__exact='pending')
+        self.assertEqual((count, len(counts)), (4, 1))
+        _, count, counts = self.changelist(status__exact='pending')
+        self.assertEqual((count, counts), (4, []))
+
+    def test_search_by_order_number_phone_and_name_prefix(self):
+        self.assertEqual(self.changelist(q=self.orders[1].order_number.lower())[0], ['John Kamau'])
+        self.assertEqual(self.changelist(q='0712 345 678')[0], ['Jane Doe'])
+        self.assertEqual(self.changelist(q='722000111')[0], ['John Kamau'])
+        self.assertEqual(sorted(self.changelist(q='jan')[0]), ['Jane Doe', 'Janet Wanjiru'])
+        self.assertEqual(self.changelist(q='JOHN@example.com')[0], ['John Kamau'])
+        self.assertEqual(self.changelist(q='kamau')[0], [])    # prefix only: no leading-wildcard scan
+
+    def test_search_uses_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('plan check is SQLite-specific')
+        order_admin = admin.admin.site._registry[Order]
+        request = self.client.get('/admin/').wsgi_request
+        for term, index in [('jan', 'order_full_name_ci'), ('0712345678', 'order_phone_idx')]:
+            queryset, _ = order_admin.get_search_results(request, Order.objects.all(), term)
+            self.assertIn(index, queryset.explain())
+
+
+@override_settings(BULK_ACTION_INLINE_MAX=3, BULK_UPDATE_CHUNK_SIZE=2)
+class BulkAdminActionTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('root', 'root@example.com', 'pass12345'))
+        self.category = Category.objects.create(name='Phones', slug='phones')
+        self.products = [make_product(f'Phone {n}', category=self.category)[0] for n in range(5)]
+
+    def act(self, url, action, objects):
+        return self.client.post(url, {'action': action, '_selected_action': [o.pk for o in objects]}, follow=True)
+
+    def test_small_selection_is_updated_in_the_request(self):
+        r = self.act('/admin/store/product/', 'bulk_mark_as_featured', self.products[:3])
+        self.assertContains(r, 'Mark as featured: 3 row(s) updated.')
+        self.assertEqual(Product.objects.filter(is_featured=True).count(), 3)
+        self.assertFalse(BackgroundJob.objects.exists())
+
+    def test_large_selection_runs_as_chunked_job(self):
+        r = self.act('/admin/store/product/', 'bulk_mark_as_featured', self.products)
+        self.assertContains(r, 'background job')
+        job = BackgroundJob.objects.get(kind=bulk.BULK_UPDATE)
+        self.assertEqual((job.status, job.total), ('queued', 5))
+        self.assertFalse(Product.objects.filter(is_featured=True).exists())
+
+        before = Product.objects.get(pk=self.products[0].pk).updated_at
+        with self.assertNumQueries(2 + 2 + 3 * 5 + 1):   # claim, count and total, 3 chunks with progress, outcome
+            jobs.run(jobs.claim(1)[0])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.done, job.total, job.result), ('succeeded', 5, 5, {'updated': 5}))
+        self.assertEqual(Product.objects.filter(is_featured=True).count(), 5)
+        self.assertGreater(Product.objects.get(pk=self.products[0].pk).updated_at, before)
+        self.assertContains(self.client.get('/admin/store/backgroundjob/'), '<small>5/5</small>', html=False)
+
+    def test_brand_deactivation_covers_its_catalogue(self):
+        samsung = Brand.objects.create(name='Samsung', slug='samsung')
+        Product.objects.filter(pk__in=[p.pk for p in self.products[:4]]).update(brand=samsung)
+        self.act('/admin/store/brand/', 'deactivate_catalogue', [samsung])
+        jobs.run_pending()
+        samsung.refresh_from_db()
+        self.assertFalse(samsung.is_active)
+        self.assertEqual(list(Product.objects.filter(is_active=True)), [self.products[4]])
+
+    def test_select_all_stores_the_changelist_filter_not_the_rows(self):
+        Product.objects.filter(pk=self.products[0].pk).update(is_active=False)
+        self.client.post('/admin/store/product/?is_active__exact=1', {
+            'action': 'bulk_mark_as_featured', 'select_across': '1', '_selected_action': [self.products[1].pk],
+        })
+        job = BackgroundJob.objects.get(kind=bulk.BULK_UPDATE)
+        self.assertEqual((job.payload['selection'], job.total),
+                         ({'model': 'store.Product', 'changelist': 'is_active__exact=1'}, 4))
+
+        make_product('Phone 5', category=self.category)    # listed when the job runs, so included
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.result, {'updated': 5})
+        self.assertFalse(Product.objects.get(pk=self.products[0].pk).is_featured)
+
+    def test_cancelled_job_stops_after_current_chunk(self):
+        orders = [Order.objects.create(full_name='x', email='x@example.com', phone='0700000000', subtotal=1, total=1)
+                  for _ in range(5)]
+        self.act('/admin/store/order/', 'bulk_mark_as_shipped', orders)
+        job = BackgroundJob.objects.get()
+        self.act('/admin/store/backgroundjob/', 'cancel', [job])     # queued: never starts
+        self.assertEqual(jobs.claim(1), [])
+
+        BackgroundJob.objects.filter(pk=job.pk).update(status='queued')
+        with mock.patch.object(events, 'publish', side_effect=lambda *ids: jobs.cancel(BackgroundJob.objects.all())):
+            self.assertEqual(jobs.run(jobs.claim(1)[0]), 'cancelled')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.done, job.total), ('cancelled', 0, 5))
+        self.assertEqual(Order.objects.filter(status='shipped').count(), 2)   # the first chunk stands
+
+
+@override_settings(RECENTLY_VIEWED_BUFFER_SIZE=100, RECENTLY_VIEWED_FLUSH_INTERVAL=60, RECENTLY_VIEWED_KEEP=3)
+class RecentlyViewedTrackingTests(TestCase):
+    def setUp(self):
+        tracking._take()
+        self.addCleanup(tracking._take)
+        category = Category.objects.create(name='Phones', slug='phones')
+        self.products = [make_product(f'Phone {n}', category=category)[0] for n in range(5)]
+        self.user = make_shopper()
+        self.start = timezone.now() - timedelta(hours=1)
+
+    def view(self, n, minutes, **owner):
+        tracking.record(self.products[n].pk, when=self.start + timedelta(minutes=minutes), **owner)
+
+    def test_repeat_views_collapse_to_the_latest(self):
+        for minutes in (5, 1, 3):
+            self.view(0, minutes, user_id=self.user.pk)
+        self.assertEqual(tracking.pending_count(), 1)
+        self.assertEqual(tracking.flush(), 1)
+        self.assertEqual(RecentlyViewed.objects.get().viewed_at, self.start + timedelta(minutes=5))
+
+    def test_flush_upserts_in_a_fixed_number_of_queries(self):
+        RecentlyViewed.objects.create(user=self.user, product=self.products[0], viewed_at=self.start)
+        other = make_shopper('other')
+        for n in range(3):
+            self.view(n, 10 + n, user_id=self.user.pk)
+            self.view(n, 10 + n, user_id=other.pk)
+            self.view(n, 10 + n, session_key='s' * 32)
+        with self.assertNumQueries(2 + 2 + 2 + 2):  # live products and users, savepoint, upsert and trim per owner type
+            self.assertEqual(tracking.flush(), 9)
+        self.assertEqual(RecentlyViewed.objects.count(), 9)
+        self.assertEqual(RecentlyViewed.objects.get(user=self.user, product=self.products[0]).viewed_at,
+                         self.start + timedelta(minutes=10))
+
+    def test_history_is_capped_per_shopper(self):
+        for n in range(5):
+            self.view(n, n, user_id=self.user.pk)
+            self.view(4 - n, n, session_key='s' * 32)
+        tracking.flush()
+        self.assertEqual([v.product for v in RecentlyViewed.objects.filter(user=self.user)], self.products[:1:-1])
+        self.assertEqual([v.product for v in RecentlyViewed.objects.filter(session_key='s' * 32)], self.products[:3])
+
+    def test_product_page_defers_the_write_until_due(self):
+        self.client.force_login(self.user)
+        self.client.get(f'/api/products/{self.products[0].slug}/')
+        self.assertFalse(RecentlyViewed.objects.exists())
+        with override_settings(RECENTLY_VIEWED_BUFFER_SIZE=2):
+            self.client.get(f'/api/products/{self.products[1].slug}/')
+        self.assertEqual(RecentlyViewed.objects.count(), 2)
+
+    def test_own_history_reads_back_buffered_views(self):
+        self.client.force_login(self.user)
+        self.client.get(f'/api/products/{self.products[0].slug}/')
+        r = self.client.get('/api/recently-viewed/')
+        self.assertEqual([v['product']['slug'] for v in r.json()], [self.products[0].slug])
+
+    def test_failed_flush_keeps_the_views(self):
+        self.view(0, 0, user_id=self.user.pk)
+        with mock.patch.object(tracking, '_write', side_effect=DatabaseError('database is locked')):
+            self.assertEqual(tracking.flush(), 0)
+        self.assertEqual(tracking.pending_count(), 1)
+        self.assertEqual(tracking.flush(), 1)
+
+    def test_views_of_deleted_products_and_users_are_dropped(self):
+        gone = make_shopper('gone')
+        self.view(0, 0, user_id=self.user.pk)
+        self.view(1, 0, user_id=gone.pk)
+        self.view(2, 0, session_key='s' * 32)
+        gone.delete()
+        self.products[2].delete()
+        self.assertEqual(tracking.flush(), 1)
+        self.assertEqual(tracking.pending_count(), 0)
+        self.assertEqual(list(RecentlyViewed.objects.values_list('product', flat=True)), [self.products[0].pk])
+
+    @override_settings(RECENTLY_VIEWED_FLUSH_RETRIES=2)
+    def test_repeatedly_failing_flush_drops_the_views(self):
+        self.view(0, 0, user_id=self.user.pk)
+        with mock.patch.object(tracking, '_write', side_effect=DatabaseError('database is locked')):
+            for _ in range(2):
+                tracking.flush()
+                self.assertEqual(tracking.pending_count(), 1)
+            tracking.flush()
+        self.assertEqual(tracking.pending_count(), 0)
+
+    @override_settings(RECENTLY_VIEWED_BUFFER_MAX=2)
+    def test_buffer_is_capped(self):
+        for n in range(4):
+            self.view(n, n, user_id=self.user.pk)
+        self.view(0, 9, user_id=self.user.pk)       # a pair already buffered still updates
+        self.assertEqual(tracking.pending_count(), 2)
+        self.assertEqual(tracking.flush(), 2)
+        self.assertEqual(RecentlyViewed.objects.get(product=self.products[0]).viewed_at,
+                         self.start + timedelta(minutes=9))
+
+    def test_views_are_flushed_at_exit(self):
+        with mock.patch('atexit.register') as register:
+            importlib.reload(tracking)
+        register.assert_called_once_with(tracking.flush)
+
+
+@override_settings(PASSWORD_HASH_ITERATIONS=1000)
+class LoginTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('jane', 'Jane@Example.com', 'pass12345')
+        self.client = APIClient()
+
+    def login(self, email, password='pass12345'):
+        return self.client.post('/api/auth/login/', {'email': email, 'password': password}, format='json')
+
+    def test_login_by_email_ignores_case(self):
+        r = self.login('  jane@EXAMPLE.com ')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data['user']['username'], 'jane')
+
+    def test_login_by_username_still_works(self):
+        self.assertEqual(self.login('jane').status_code, 200)
+
+    def test_bad_credentials_are_rejected(self):
+        self.assertEqual(self.login('jane@example.com', 'wrong').status_code, 401)
+        self.assertEqual(self.login('nobody@example.com').status_code, 401)
+
+    def test_email_lookup_uses_case_insensitive_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('plan check is SQLite-specific')
+        self.assertIn('auth_user_email_ci_uniq', users_with_email('jane@example.com').explain())
+
+    def test_emails_are_unique_ignoring_case(self):
+        r = APIClient().post('/api/auth/register/', {
+            'username': 'jane2', 'email': 'JANE@example.com', 'first_name': 'Jane', 'last_name': 'W',
+            'password': 'pass12345', 'password2': 'pass12345',
+        }, format='json')
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('email', r.data)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create_user('jane3', 'jane@example.COM', 'pass12345')
+        User.objects.create_user('blank1', '', 'pass12345')
+        User.objects.create_user('blank2', '', 'pass12345')
+
+    def test_profile_email_race_is_a_validation_error(self):
+        other = User.objects.create_user('sam', 'sam@example.com', 'pass12345')
+        self.client.force_authenticate(other)
+        # The pre-check passed before 'jane' claimed the address; the index still refuses it.
+        with mock.patch('store.views.users_with_email', return_value=User.objects.none()):
+            r = self.client.patch('/api/auth/profile/', {'email': 'JANE@example.com'}, format='json')
+        self.assertEqual((r.status_code, r.data), (400, {'email': [EMAIL_TAKEN]}))
+        other.refresh_from_db()
+        self.assertEqual(other.email, 'sam@example.com')
+
+    def test_hash_is_upgraded_to_configured_cost_on_login(self):
+        self.assertEqual(self.user.password.split('$')[1], '1000')
+        with override_settings(PASSWORD_HASH_ITERATIONS=2000):
+            self.assertEqual(self.login('jane@example.com').status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password.split('$')[1], '2000')
+        self.assertTrue(self.user.check_password('pass12345'))
+
+
+@override_settings(PASSWORD_HASH_ITERATIONS=1000)
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        authentication.invalidate()
+        self.addCleanup(authentication.invalidate)
+        self.user = User.objects.create_user('jane', 'jane@example.com', 'pass12345')
+        UserProfile.objects.create(user=self.user, phone='0712345678')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def test_warm_profile_read_makes_no_queries(self):
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 200)
+        with self.assertNumQueries(0):
+            r = self.client.get('/api/auth/profile/')
+        self.assertEqual((r.data['username'], r.data['profile']['phone']), ('jane', '0712345678'))
+
+    def test_saves_refresh_the_snapshot(self):
+        self.client.get('/api/auth/profile/')
+        self.client.patch('/api/auth/profile/', {'first_name': 'Janet', 'phone': '0799999999'}, format='json')
+        r = self.client.get('/api/auth/profile/')
+        self.assertEqual((r.data['first_name'], r.data['profile']['phone']), ('Janet', '0799999999'))
+
+    def test_password_change_applies_to_cached_user(self):
+        self.client.get('/api/auth/profile/')
+        r = self.client.post('/api/auth/change-password/',
+                             {'old_password': 'pass12345', 'new_password': 'newpass123'}, format='json')
+        self.assertEqual(r.status_code, 200)
+        r = self.client.post('/api/auth/change-password/',
+                             {'old_password': 'pass12345', 'new_password': 'other1234'}, format='json')
+        self.assertEqual(r.status_code, 400)
+
+    def test_deactivated_or_deleted_user_is_rejected(self):
+        self.client.get('/api/auth/profile/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 401)
+        self.user.delete()
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 401)
+
+
+@override_settings(THROTTLE_ENABLED=True, THROTTLE_SHARED=False, THROTTLE_RATES={'login': '2/min', 'search': '1/min'})
+class ThrottleTests(TestCase):
+    def setUp(self):
+        throttling.reset()
+        self.addCleanup(throttling.reset)
+
+    def login(self, client, ip='10.0.0.1', **extra):
+        return client.post('/api/auth/login/', {'email': 'x@example.com', 'password': 'nope'}, format='json',
+                           REMOTE_ADDR=ip, **extra)
+
+    @mock.patch('store.throttling.time.time', return_value=1000.0)
+    def test_bucket_throttles_per_ip_with_retry_after(self, _):
+        client = APIClient()
+        self.assertEqual([self.login(client).status_code for _ in range(2)], [401, 401])
+        r = self.login(client)
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(r['Retry-After'], '30')
+        self.assertEqual(self.login(client, ip='10.0.0.2').status_code, 401)
+
+    def test_forwarded_for_does_not_pick_the_bucket(self):
+        client = APIClient()
+        statuses = [self.login(client, HTTP_X_FORWARDED_FOR=f'203.0.113.{n}').status_code for n in range(3)]
+        self.assertEqual(statuses, [401, 401, 429])
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            # Behind one proxy, the address it appended is the client.
+            self.assertEqual(self.login(client, HTTP_X_FORWARDED_FOR='spoofed, 203.0.113.9').status_code, 401)
+            self.assertEqual(self.login(client, HTTP_X_FORWARDED_FOR='other, 203.0.113.9').status_code, 401)
+            self.assertEqual(self.login(client, HTTP_X_FORWARDED_FOR='third, 203.0.113.9').status_code, 429)
+
+    def test_bucket_refills_over_time(self):
+        with mock.patch('store.throttling.time.time', return_value=1000.0):
+            for _ in range(2):
+                throttling.consume('login', 'ip:a')
+            self.assertEqual(throttling.consume('login', 'ip:a'), 30.0)
+        with mock.patch('store.throttling.time.time', return_value=1030.0):
+            self.assertEqual(throttling.consume('login', 'ip:a'), 0.0)
+
+    def test_users_get_their_own_buckets(self):
+        make_product()
+        clients = []
+        for name in ('a', 'b'):
+            client = APIClient()
+            client.force_authenticate(make_shopper(name))
+            clients.append(client)
+        self.assertEqual(clients[0].get('/api/products/search/?q=galaxy').status_code, 200)
+        self.assertEqual(clients[0].get('/api/products/search/?q=galaxy').status_code, 429)
+        self.assertEqual(clients[1].get('/api/products/search/?q=galaxy').status_code, 200)
+        self.assertEqual(APIClient().get('/api/products/').status_code, 200)
+
+    def test_async_view_is_throttled(self):
+        with override_settings(THROTTLE_RATES={'stk_push': '1/min'}):
+            user = make_shopper()
+            token = RefreshToken.for_user(user).access_token
+            factory = AsyncRequestFactory()
+            statuses = []
+            for _ in range(2):
+                request = factory.post('/api/payments/mpesa/stk-push/', {'phone': '0712345678'},
+                                       content_type='application/json', headers={'Authorization': f'Bearer {token}'})
+                r = async_to_sync(async_views.MpesaSTKPushView.as_view())(request)
+                statuses.append((r.status_code, r.get('Retry-After')))
+        self.assertEqual(statuses[1], (429, '60'))
+        self.assertNotEqual(statuses[0][0], 429)
+
+    def test_counters_are_exposed_to_staff(self):
+        self.login(APIClient())
+        self.login(APIClient())
+        self.login(APIClient())
+        admin = User.objects.create_user('admin', 'admin@example.com', 'pass12345', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+        r = client.get('/api/throttle/stats/')
+        self.assertEqual(r.data['scopes']['login'], {'rate': '2/min', 'allowed': 2, 'throttled': 1})
+        client.force_authenticate(make_shopper())
+        self.assertEqual(client.get('/api/throttle/stats/').status_code, 403)
+
+
+class NearestPickupStationTests(TestCase):
+    def setUp(self):
+        geo.invalidate()
+        self.addCleanup(geo.invalidate)
+        kenya = Country.objects.create(name='Kenya', code='KE', currency_code='KES')
+        nairobi = County.objects.create(country=kenya, name='Nairobi')
+        mombasa = County.objects.create(country=kenya, name='Mombasa')
+        self.stations = {
+            name: PickupStation.objects.create(county=county, name=name, address=name, latitude=Decimal(lat),
+                                               longitude=Decimal(lng), delivery_fee_kes=Decimal(fee))
+            for name, county, lat, lng, fee in [
+                ('CBD', nairobi, '-1.2864', '36.8172', '150'),
+                ('Westlands', nairobi, '-1.2676', '36.8108', '180'),
+                ('Karen', nairobi, '-1.3190', '36.7073', '200'),
+                ('Nyali', mombasa, '-4.0435', '39.7058', '250'),
+            ]
+        }
+
+    def nearest(self, **params):
+        return APIClient().get('/api/pickup-stations/nearest/', params)
+
+    def test_returns_k_nearest_with_distances_and_fees(self):
+        r = self.nearest(lat='-1.2921', lng='36.8219', k=3)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([s['name'] for s in r.data], ['CBD', 'Westlands', 'Karen'])
+        self.assertAlmostEqual(r.data[0]['distance_km'], 0.83, delta=0.02)
+        self.assertEqual((r.data[0]['delivery_fee_kes'], r.data[0]['county']), ('150.00', 'Nairobi'))
+        far = self.nearest(lat='-4.05', lng='39.67', k=2).data
+        self.assertEqual([s['name'] for s in far], ['Nyali', 'CBD'])
+        self.assertGreater(far[1]['distance_km'], 400)
+
+    def test_matches_brute_force_on_random_points(self):
+        rng = random.Random(7)
+        points = [(rng.uniform(-5, 5), rng.uniform(33, 42), n) for n in range(500)]
+        grid = geo.GridIndex(points, cell=0.3)
+        for _ in range(50):
+            lat, lng = rng.uniform(-6, 6), rng.uniform(32, 43)
+            expected = sorted(geo.haversine_km(lat, lng, p_lat, p_lng) for p_lat, p_lng, _ in points)[:7]
+            self.assertEqual([round(d, 9) for d, _ in grid.nearest(lat, lng, 7)], [round(d, 9) for d in expected])
+
+    def test_index_follows_station_changes(self):
+        self.assertEqual(self.nearest(lat='-1.2921', lng='36.8219', k=1).data[0]['name'], 'CBD')
+        self.stations['CBD'].is_active = False
+        self.stations['CBD'].save()
+        self.assertEqual(self.nearest(lat='-1.2921', lng='36.8219', k=1).data[0]['name'], 'Westlands')
+        with self.assertNumQueries(0):
+            self.nearest(lat='-1.2921', lng='36.8219', k=1)
+
+    def test_rejects_bad_coordinates(self):
+        self.assertEqual(self.nearest(lat='x', lng='36.8').status_code, 400)
+        self.assertEqual(self.nearest(lng='36.8').status_code, 400)
+        self.assertEqual(self.nearest(lat='91', lng='36.8').status_code, 400)
+
+
+class GeographyBundleTests(TestCase):
+    def setUp(self):
+        geo.invalidate()
+        self.addCleanup(geo.invalidate)
+        kenya = Country.objects.create(name='Kenya', code='KE', currency_code='KES')
+        self.nairobi = County.objects.create(country=kenya, name='Nairobi')
+        County.objects.create(country=kenya, name='Closed', is_active=False)
+        self.station = PickupStation.objects.create(county=self.nairobi, name='CBD', address='CBD')
+        self.client = APIClient()
+
+    def test_bundle_holds_active_geography(self):
+        r = self.client.get('/api/geography/bundle/')
+        self.assertEqual(r.status_code, 200)
+        data = json.loads(r.content)
+        self.assertEqual([c['code'] for c in data['countries']], ['KE'])
+        self.assertEqual([c['name'] for c in data['counties']], ['Nairobi'])
+        self.assertEqual(data['stations'][0]['county_id'], self.nairobi.id)
+        self.assertEqual(r['ETag'], f'"{data["version"]}"')
+        self.assertIn('max-age=300', r['Cache-Control'])
+        pinned = self.client.get('/api/geography/bundle/', {'v': data['version']})
+        self.assertIn('immutable', pinned['Cache-Control'])
+
+    def test_gzip_etag_and_not_modified(self):
+        r = self.client.get('/api/geography/bundle/', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(r['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(r.content))['stations'][0]['name'], 'CBD')
+        with self.assertNumQueries(0):
+            again = self.client.get('/api/geography/bundle/', HTTP_ACCEPT_ENCODING='gzip',
+                                    HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+    def test_version_follows_station_changes(self):
+        etag = self.client.get('/api/geography/bundle/')['ETag']
+        self.station.name = 'City Centre'
+        self.station.save()
+        r = self.client.get('/api/geography/bundle/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r['ETag'], etag)
+        self.assertEqual(json.loads(r.content)['stations'][0]['name'], 'City Centre')
+
+
+class ShippingQuoteTests(TestCase):
+    def setUp(self):
+        shipping.invalidate()
+        self.addCleanup(shipping.invalidate)
+        kenya = Country.objects.create(name='Kenya', code='KE', currency_code='KES')
+        self.nairobi = County.objects.create(country=kenya, name='Nairobi')
+        self.kisumu = County.objects.create(country=kenya, name='Kisumu')
+        self.station = PickupStation.objects.create(county=self.nairobi, name='CBD', address='CBD',
+                                                    delivery_fee_kes=Decimal('150'), delivery_fee_usd=Decimal('1.20'))
+        self.client = APIClient()
+
+    def make_zones(self):
+        metro = DeliveryZone.objects.create(name='Metro', eta_min_days=1, eta_max_days=2, free_over_kes=Decimal('5000'))
+        metro.counties.add(self.nairobi)
+        DeliveryRate.objects.create(zone=metro, delivery_type='home', max_weight_kg=Decimal('2'),
+                                    fee_kes=Decimal('200'), fee_usd=Decimal('1.50'))
+        DeliveryRate.objects.create(zone=metro, delivery_type='home', max_weight_kg=Decimal('10'),
+                                    fee_kes=Decimal('400'), fee_usd=Decimal('3.00'))
+        upcountry = DeliveryZone.objects.create(name='Upcountry', is_default=True, eta_min_days=3, eta_max_days=5)
+        DeliveryRate.objects.create(zone=upcountry, delivery_type='home', fee_kes=Decimal('600'), fee_usd=Decimal('4.50'))
+        return metro
+
+    def quote(self, **body):
+        return self.client.post('/api/shipping/quote/', body, format='json')
+
+    def test_flat_defaults_without_zones(self):
+        r = self.quote(carts=[{'subtotal': '1000'}], destinations=[
+            {'delivery_type': 'home', 'county_id': self.kisumu.id},
+            {'delivery_type': 'pickup', 'pickup_station_id': self.station.id},
+        ])
+        self.assertEqual([(q['fee'], q['free']) for q in r.data['quotes']], [(Decimal('350'), False), (Decimal('150'), False)])
+
+    def test_batch_quotes_zones_tiers_and_free_threshold(self):
+        self.make_zones()
+        destinations = [
+            {'delivery_type': 'home', 'county_id': self.nairobi.id},
+            {'delivery_type': 'home', 'county_id': self.kisumu.id},
+            {'delivery_type': 'pickup', 'pickup_station_id': self.station.id},
+            {'delivery_type': 'pickup', 'pickup_station_id': 999},
+        ]
+        carts = [{'subtotal': '1000', 'weight_kg': '1'}, {'subtotal': '1000', 'weight_kg': '5'},
+                 {'subtotal': '6000', 'weight_kg': '5'}, {'subtotal': '1000', 'weight_kg': '50'}]
+        shipping.rules()
+        with self.assertNumQueries(0):
+            r = self.quote(currency='KES', carts=carts, destinations=destinations)
+        grid = {(q['cart'], q['destination']): q for q in r.data['quotes']}
+        self.assertEqual(len(grid), 16)
+        self.assertEqual(grid[0, 0]['fee'], Decimal('200'))
+        self.assertEqual(grid[1, 0]['fee'], Decimal('400'))
+        self.assertEqual((grid[2, 0]['fee'], grid[2, 0]['free']), (Decimal('0'), True))
+        self.assertEqual((grid[0, 1]['fee'], grid[0, 1]['zone']), (Decimal('600'), 'Upcountry'))
+        self.assertEqual(grid[0, 2]['fee'], Decimal('150'))
+        self.assertFalse(grid[0, 3]['available'])
+        self.assertIn('over the delivery limit', grid[3, 0]['error'])
+        today = timezone.localdate()
+        self.assertEqual((grid[0, 0]['eta_min'], grid[0, 0]['eta_max']),
+                         (today + timedelta(days=1), today + timedelta(days=2)))
+
+    def test_station_fee_set_in_one_currency_is_converted(self):
+        ExchangeRate.objects.create(from_currency='USD', to_currency='KES', rate=Decimal('130'))
+        currency.invalidate()
+        self.addCleanup(currency.invalidate)
+        PickupStation.objects.filter(pk=self.station.pk).update(delivery_fee_usd=0)
+        body = {'carts': [{'subtotal': '10'}],
+                'destinations': [{'delivery_type': 'pickup', 'pickup_station_id': self.station.id}]}
+        for zones in (False, True):
+            if zones:
+                self.make_zones()
+            quote = self.quote(currency='USD', **body).data['quotes'][0]
+            self.assertEqual((quote['fee'], quote['free']), (Decimal('1.15'), False))
+
+    def test_rule_changes_apply_at_once(self):
+        metro = self.make_zones()
+        body = {'carts': [{'subtotal': '1000', 'weight_kg': '1'}],
+                'destinations': [{'delivery_type': 'home', 'county_id': self.nairobi.id}]}
+        self.assertEqual(self.quote(**body).data['quotes'][0]['fee'], Decimal('200'))
+        metro.rates.filter(max_weight_kg=Decimal('2')).update(fee_kes=Decimal('250'))
+        DeliveryRate.objects.get(zone=metro, max_weight_kg=Decimal('10')).save()
+        self.assertEqual(self.quote(**body).data['quotes'][0]['fee'], Decimal('250'))
+        metro.counties.remove(self.nairobi)
+        self.assertEqual(self.quote(**body).data['quotes'][0]['zone'], 'Upcountry')
+
+    def test_quotes_signed_in_users_cart_and_checkout_uses_engine(self):
+        self.make_zones()
+        product, variant = make_product(price_kes='1000.00')
+        Product.objects.filter(pk=product.pk).update(weight_kg=Decimal('1.5'))
+        user = make_shopper(product=product, variant=variant, quantity=2)
+        self.client.force_authenticate(user)
+        r = self.quote(destinations=[{'delivery_type': 'home', 'county_id': self.nairobi.id}])
+        self.assertEqual(r.data['quotes'][0]['fee'], Decimal('400'))
+        self.assertEqual(self.client.post('/api/shipping/quote/', {'destinations': []}, format='json').status_code, 400)
+
+        r = self.client.post('/api/orders/', {**ORDER_PAYLOAD, 'shipping_county_id': self.nairobi.id}, format='json')
+        self.assertEqual(r.status_code, 201, r.content)
+        order = Order.objects.get(id=r.data['id'])
+        self.assertEqual(order.shipping_fee, Decimal('400'))
+        self.assertEqual(order.estimated_delivery, timezone.localdate() + timedelta(days=2))
+
+    def test_checkout_rejects_undeliverable_destination(self):
+        self.make_zones()
+        DeliveryZone.objects.filter(is_default=True).delete()
+        product, variant = make_product()
+        self.client.force_authenticate(make_shopper(product=product, variant=variant))
+        r = self.client.post('/api/orders/', {**ORDER_PAYLOAD, 'shipping_county_id': self.kisumu.id}, format='json')
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('do not deliver', r.data['error'])
+        r = self.client.post('/api/orders/', {**ORDER_PAYLOAD, 'delivery_type': 'pickup'}, format='json')
+        self.assertEqual(r.status_code, 400)
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        product, variant = make_product(stock=5)
+        self.user = make_shopper(product=product, variant=variant)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, key, payload=ORDER_PAYLOAD):
+        return self.client.post('/api/orders/', payload, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_first_response(self):
+        first = self.post('k-1')
+        retry = self.post('k-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['id'], first.json()['id'])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_in_flight_duplicate_conflicts(self):
+        self.post('k-2')
+        IdempotencyKey.objects.filter(key='k-2').update(status='in_flight')
+        self.assertEqual(self.post('k-2').status_code, 409)
+        self.assertEqual(self.post('k-2', {**ORDER_PAYLOAD, 'notes': 'other'}).status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_expired_keys_are_purged_and_reusable(self):
+        self.post('k-3')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(purge_expired(), 1)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class IdentifierTests(TestCase):
+    def test_uuid7_is_versioned_and_monotonic(self):
+        ids = [identifiers.uuid7() for _ in range(5000)]
+        self.assertEqual({u.version for u in ids}, {7})
+        self.assertEqual(ids, sorted(ids, key=lambda u: u.int))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_order_numbers_and_asins_are_sequential(self):
+        identifiers.reset()
+        numbers = [identifiers.new_order_number() for _ in range(3)]
+        self.assertEqual(len(set(numbers)), 3)
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertRegex(numbers[0], r'^AMZ-\d{12}$')
+        asins = [identifiers.new_asin() for _ in range(3)]
+        self.assertEqual(asins, sorted(asins))
+        self.assertRegex(asins[0], r'^B1[0-9A-Z]{8}$')
+
+
+def mpesa_callback(checkout_request_id, result_code=0):
+    return {'Body': {'stkCallback': {
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'ok' if result_code == 0 else 'Request cancelled by user',
+        'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'RCP123'}]},
+    }}}
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.product, self.variant = make_product(stock=1)
+        self.client = APIClient()
+        self.client.force_authenticate(make_shopper('first', self.product, self.variant))
+        r = self.client.post('/api/orders/', ORDER_PAYLOAD, format='json')
+        self.assertEqual(r.status_code, 201, r.content)
+        self.order = Order.objects.get(id=r.data['id'])
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_1', amount=1, phone='254712345678')
+
+    def second_checkout(self):
+        client = APIClient()
+        client.force_authenticate(make_shopper('second', self.product, self.variant))
+        return client.post('/api/orders/', ORDER_PAYLOAD, format='json')
+
+    def test_pending_payment_holds_the_stock(self):
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 1)
+        self.assertEqual(reservations.available_quantities([self.variant.id]), {self.variant.id: 0})
+        self.assertEqual(self.second_checkout().status_code, 409)
+
+    def test_successful_payment_commits_the_reservation(self):
+        self.client.post('/api/payments/mpesa/callback/', mpesa_callback('ws_CO_1'), format='json')
+        callbacks.apply_all()
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 0)
+        self.assertEqual(StockReservation.objects.get().status, 'committed')
+
+    def test_failed_payment_releases_the_stock(self):
+        self.client.post('/api/payments/mpesa/callback/', mpesa_callback('ws_CO_1', result_code=1032), format='json')
+        callbacks.apply_all()
+        self.assertEqual(StockReservation.objects.get().status, 'released')
+        self.assertEqual(self.second_checkout().status_code, 201)
+
+    def test_expired_reservations_stop_counting_and_are_swept(self):
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(reservations.available_quantities([self.variant.id]), {self.variant.id: 1})
+        self.assertEqual(reservations.release_expired(), 1)
+        self.assertEqual(self.second_checkout().status_code, 201)
+
+
+class StubOAuthServer:
+    """Minimal local keep-alive OAuth endpoint that counts token requests (the first ``fail`` get a 503)."""
+
+    def __init__(self, expires_in=3599, delay=0.0, fail=0):
+        stub = self
+        self.hits = 0
+        self.peers = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _token(self):
+                stub.peers.add(self.client_address)
+                if self.headers.get('Content-Length'):
+                    self.rfile.read(int(self.headers['Content-Length']))
+                stub.hits += 1
+                time.sleep(delay)
+                if stub.hits <= fail:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps({'access_token': f'token-{stub.hits}', 'expires_in': str(expires_in)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _token
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class GatewayTokenTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for manager in (mpesa_tokens, paypal_tokens):
+            manager.invalidate()
+
+    def stub(self, **kwargs):
+        stub = StubOAuthServer(**kwargs)
+        self.addCleanup(stub.close)
+        settings_override = override_settings(
+            MPESA_BASE_URL=stub.url, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+            PAYPAL_BASE_URL=stub.url, PAYPAL_CLIENT_ID='id', PAYPAL_CLIENT_SECRET='secret',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return stub
+
+    def test_concurrent_callers_share_one_refresh(self):
+        stub = self.stub(delay=0.2)
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(mpesa_tokens.get_token())) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(stub.hits, 1)
+        self.assertEqual(set(tokens), {'token-1'})
+
+    def test_token_is_reused_until_close_to_expiry(self):
+        stub = self.stub(expires_in=3599)
+        self.assertEqual(paypal_tokens.get_token(), 'token-1')
+        self.assertEqual(paypal_tokens.get_token(), 'token-1')
+        self.assertEqual(stub.hits, 1)
+        with override_settings(GATEWAY_TOKEN_REFRESH_MARGIN=3600):
+            self.assertEqual(paypal_tokens.get_token(), 'token-2')
+        self.assertEqual(stub.hits, 2)
+
+    def test_other_processes_pick_the_token_up_from_the_cache(self):
+        stub = self.stub()
+        mpesa_tokens.get_token()
+        mpesa_tokens._remember(None, None, 0.0)     # what a fresh worker process looks like
+        self.assertEqual(mpesa_tokens.get_token(), 'token-1')
+        self.assertEqual(stub.hits, 1)
+
+    def test_caller_that_gives_up_waiting_leaves_the_lock_alone(self):
+        stub = self.stub()
+        lock_key = f'{mpesa_tokens._cache_key()}:refreshing'
+        cache.add(lock_key, 'other-process', timeout=60)
+        with mock.patch.object(mpesa_tokens, 'lock_timeout', 0.1):
+            self.assertEqual(mpesa_tokens.get_token(), 'token-1')
+        self.assertEqual(stub.hits, 1)
+        self.assertEqual(cache.get(lock_key), 'other-process')
+
+
+@override_settings(GATEWAY_RETRY_BACKOFF=0.01)
+class GatewayClientTests(TestCase):
+    def stub(self, **kwargs):
+        stub = StubOAuthServer(**kwargs)
+        self.addCleanup(stub.close)
+        settings_override = override_settings(MPESA_BASE_URL=stub.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return stub
+
+    def test_calls_reuse_one_pooled_connection(self):
+        stub = self.stub()
+        for _ in range(5):
+            self.assertEqual(mpesa_client.request('GET', '/ping', endpoint='ping').status_code, 200)
+        self.assertEqual(stub.hits, 5)
+        self.assertEqual(len(stub.peers), 1)
+
+    def test_idempotent_calls_are_retried_on_503(self):
+        stub = self.stub(fail=2)
+        self.assertEqual(mpesa_client.request('GET', '/ping', endpoint='retry').status_code, 200)
+        self.assertEqual(stub.hits, 3)
+        snapshot = latency_snapshot()['mpesa:retry']
+        self.assertEqual((snapshot['calls'], snapshot['errors']), (3, 2))
+
+    def test_latency_is_exposed_to_staff_and_logged_by_the_worker(self):
+        self.stub()
+        mpesa_client.request('GET', '/ping', endpoint='exposed')
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('admin', 'admin@example.com', 'pass12345', is_staff=True))
+        self.assertEqual(client.get('/api/gateways/latency/').data['mpesa:exposed']['calls'], 1)
+        client.force_authenticate(make_shopper())
+        self.assertEqual(client.get('/api/gateways/latency/').status_code, 403)
+        with self.assertLogs('store', 'INFO') as logs:
+            call_command('run_jobs', '--once', stdout=StringIO())
+        self.assertTrue(any('Gateway latency mpesa:exposed: 1 calls, 0 errors' in line for line in logs.output))
+
+    def test_non_idempotent_calls_are_not_retried(self):
+        stub = self.stub(fail=1)
+        self.assertEqual(mpesa_client.request('POST', '/push', json={}).status_code, 503)
+        self.assertEqual(stub.hits, 1)
+
+    def test_unreachable_gateway_raises_gateway_error(self):
+        stub = self.stub()
+        stub.close()
+        with override_settings(GATEWAY_MAX_RETRIES=0), self.assertRaises(GatewayError):
+            mpesa_client.request('GET', '/ping')
+
+
+class AsyncPaymentViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        mpesa_tokens.invalidate()
+        self.product, self.variant = make_product(stock=2)
+        self.user = make_shopper(product=self.product, variant=self.variant)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.order = Order.objects.get(id=client.post('/api/orders/', ORDER_PAYLOAD, format='json').data['id'])
+        stub = StubGateway().start()
+        self.addCleanup(stub.close)
+        settings_override = override_settings(
+            MPESA_BASE_URL=stub.url, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.factory = AsyncRequestFactory()
+        self.auth = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+
+    async def stk_push(self, **headers):
+        request = self.factory.post(
+            '/api/payments/mpesa/stk-push/', {'phone': '0712345678', 'order_id': str(self.order.id)},
+            content_type='application/json', headers={**self.auth, **headers},
+        )
+        return await async_views.MpesaSTKPushView.as_view()(request)
+
+    async def test_stk_push_and_callback(self):
+        r = await self.stk_push()
+        self.assertEqual(r.status_code, 202, r.content)
+        job_id = json.loads(r.content)['job_id']
+        self.assertEqual(await sync_to_async(jobs.run_pending)(), 1)
+        job = await BackgroundJob.objects.aget(id=job_id)
+        checkout_id = job.result['checkout_request_id']
+        await self.order.arefresh_from_db()
+        self.assertEqual(self.order.status, 'payment_pending')
+
+        request = self.factory.post('/api/payments/mpesa/callback/', mpesa_callback(checkout_id),
+                                    content_type='application/json')
+        r = await async_views.MpesaCallbackView.as_view()(request)
+        self.assertEqual(json.loads(r.content), {'ResultCode': 0, 'ResultDesc': 'Accepted'})
+        await sync_to_async(callbacks.apply_all)()
+        await self.order.arefresh_from_db()
+        await self.variant.arefresh_from_db()
+        self.assertEqual(self.order.payment_status, 'paid')
+        self.assertEqual(self.variant.stock, 1)
+
+    @staticmethod
+    def async_urlconf():
+        """The API's URLconf as built with ASYNC_PAYMENT_VIEWS on."""
+        spec = importlib.util.find_spec('store.urls')
+        store_urls = importlib.util.module_from_spec(spec)
+        with override_settings(ASYNC_PAYMENT_VIEWS=True):
+            spec.loader.exec_module(store_urls)
+        urlconf = types.ModuleType('async_urls')
+        urlconf.urlpatterns = [path('api/', include(store_urls.urlpatterns))]
+        return urlconf
+
+    def test_declined_capture_releases_the_held_stock(self):
+        declined = (422, {'name': 'UNPROCESSABLE_ENTITY', 'details': [{'issue': 'INSTRUMENT_DECLINED'}]})
+        capture_views = [
+            ('backend.urls', 'store.gateways.paypal_capture', mock.Mock(return_value=declined)),
+            (self.async_urlconf(), 'store.gateways.async_paypal_capture', mock.AsyncMock(return_value=declined)),
+        ]
+        for urlconf, target, capture in capture_views:
+            with self.subTest(urlconf=urlconf):
+                Order.objects.filter(pk=self.order.pk).update(payment_status='pending')
+                StockReservation.objects.update(status='active')
+                PayPalTransaction.objects.update_or_create(
+                    paypal_order_id='PP-1', defaults={'order': self.order, 'amount': 1, 'status': 'approved'},
+                )
+                with override_settings(ROOT_URLCONF=urlconf), mock.patch(target, capture):
+                    r = self.client.post('/api/payments/paypal/capture/',
+                                         {'order_id': str(self.order.id), 'paypal_order_id': 'PP-1'},
+                                         content_type='application/json', headers=self.auth)
+                self.assertEqual(r.status_code, 400, r.content)
+                self.order.refresh_from_db()
+                self.assertEqual(self.order.payment_status, 'failed')
+                self.assertEqual(PayPalTransaction.objects.get().status, 'failed')
+                self.assertEqual(StockReservation.objects.get().status, 'released')
+
+    async def test_requires_authentication(self):
+        self.auth = {}
+        self.assertEqual((await self.stk_push()).status_code, 401)
+
+    async def test_idempotency_key_replays_the_push(self):
+        first = await self.stk_push(**{'Idempotency-Key': 'push-1'})
+        second = await self.stk_push(**{'Idempotency-Key': 'push-1'})
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(await BackgroundJob.objects.acount(), 1)
+
+    def test_sync_and_async_views_answer_alike(self):
+        async_urlconf = self.async_urlconf()
+        self.assertIs(resolve('/api/payments/mpesa/stk-push/', async_urlconf).func.view_class,
+                      async_views.MpesaSTKPushView)
+
+        calls = [
+            ('/api/payments/mpesa/stk-push/', {'phone': '0712345678', 'order_id': str(self.order.id)}),
+            ('/api/payments/paypal/create/', {'order_id': str(self.order.id)}),
+        ]
+        for url, data in calls:
+            answers = []
+            for urlconf in ('backend.urls', async_urlconf):
+                with self.subTest(url=url, urlconf=urlconf), override_settings(ROOT_URLCONF=urlconf):
+                    r = self.client.post(url, data, content_type='application/json', headers=self.auth)
+                    self.assertEqual(r.status_code, 202, r.content)
+                    body = r.json()
+                    self.assertTrue(body.pop('status_url').endswith(f"/api/payments/jobs/{body.pop('job_id')}/"))
+                    answers.append(body)
+            self.assertEqual(answers[0], answers[1])
+        self.assertEqual(BackgroundJob.objects.count(), 4)
+
+
+@override_settings(MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret', JOB_RETRY_BACKOFF=60, GATEWAY_RETRY_BACKOFF=0.01)
+class PaymentJobTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        mpesa_tokens.invalidate()
+        product, variant = make_product()
+        self.client = APIClient()
+        self.client.force_authenticate(make_shopper(product=product, variant=variant))
+        self.order_id = self.client.post('/api/orders/', ORDER_PAYLOAD, format='json').data['id']
+
+    def stk_push(self):
+        r = self.client.post('/api/payments/mpesa/stk-push/', {'phone': '0712345678', 'order_id': self.order_id},
+                             format='json')
+        self.assertEqual(r.status_code, 202, r.content)
+        return r.data['job_id']
+
+    def status(self):
+        return self.client.get(f'/api/payments/mpesa/status/{self.order_id}/').data
+
+    def test_stk_push_is_queued_then_sent_by_the_worker(self):
+        job_id = self.stk_push()
+        self.assertEqual(self.status()['job']['status'], 'queued')
+        with StubGateway() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            self.assertEqual(jobs.run_pending(), 1)
+        status = self.status()
+        self.assertEqual(status['order_status'], 'payment_pending')
+        self.assertEqual(status['job']['status'], 'succeeded')
+        checkout_id = status['job']['result']['checkout_request_id']
+        self.assertTrue(MpesaTransaction.objects.filter(checkout_request_id=checkout_id).exists())
+        self.assertEqual(self.client.get(f'/api/payments/jobs/{job_id}/').data['status'], 'succeeded')
+
+    def test_unreachable_gateway_is_retried_with_backoff_then_dead_lettered(self):
+        self.stk_push()
+        BackgroundJob.objects.update(max_attempts=2)
+        stub = StubGateway()        # bound but never started: connections are refused
+        stub.server.server_close()
+        with override_settings(MPESA_BASE_URL=stub.url):
+            jobs.run_pending()
+            job = BackgroundJob.objects.get()
+            self.assertEqual((job.status, job.attempts), ('queued', 1))
+            self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=20))
+            self.assertEqual(jobs.run_pending(), 0)     # not due yet
+
+            BackgroundJob.objects.update(run_after=timezone.now())
+            jobs.run_pending()
+        job = self.status()['job']
+        self.assertEqual((job['status'], job['attempts']), ('dead', 2))
+        self.assertIn('failed', job['error'])
+
+    def test_gateway_503_is_not_retried(self):
+        self.stk_push()
+        with StubGateway(error_rate=1.0) as stub, override_settings(MPESA_BASE_URL=stub.url):
+            jobs.run_pending()
+        job = BackgroundJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('dead', 1))      # the prompt may have gone out
+        self.assertIn('not retried', job.last_error)
+        self.assertEqual(stub.hits['errors'], 1)
+
+    def test_push_that_cannot_be_recorded_is_not_resent(self):
+        self.stk_push()
+        with StubGateway() as stub, override_settings(MPESA_BASE_URL=stub.url), \
+                mock.patch.object(MpesaTransaction.objects, 'create', side_effect=DatabaseError('disk I/O error')):
+            jobs.run_pending()
+        job = BackgroundJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('dead', 1))
+        self.assertIn('was sent but could not be recorded', job.last_error)
+        self.assertEqual(stub.hits['stkpush'], 1)
+
+    def test_permanent_failures_skip_retries(self):
+        job = jobs.enqueue('no.such.kind')
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('dead', 1))
+
+    def test_expired_lease_is_reclaimed(self):
+        job = jobs.enqueue('no.such.kind')
+        self.assertEqual(jobs.claim(10), [job])
+        self.assertEqual(jobs.claim(10), [])
+        BackgroundJob.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([j.attempts for j in jobs.claim(10)], [2])
+
+
+class CallbackInboxTests(TestCase):
+    def setUp(self):
+        product, self.variant = make_product(stock=3)
+        self.client = APIClient()
+        self.client.force_authenticate(make_shopper(product=product, variant=self.variant))
+        self.order = Order.objects.get(id=self.client.post('/api/orders/', ORDER_PAYLOAD, format='json').data['id'])
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_1', amount=1, phone='254712345678')
+
+    def deliver(self, checkout_request_id='ws_CO_1', result_code=0):
+        r = self.client.post('/api/payments/mpesa/callback/', mpesa_callback(checkout_request_id, result_code),
+                             format='json')
+        self.assertEqual(r.data, {'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+    def test_callback_is_only_stored_until_the_worker_applies_it(self):
+        with self.assertNumQueries(1):
+            self.deliver()
+        self.assertEqual(MpesaTransaction.objects.get().status, 'pending')
+        self.assertEqual(callbacks.apply_all(), 1)
+        self.order.refresh_from_db()
+        self.variant.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.variant.stock), ('paid', 2))
+        self.assertEqual(MpesaCallback.objects.get().outcome, 'applied')
+
+    def test_repeat_deliveries_are_stored_and_applied_once(self):
+        for _ in range(3):
+            self.deliver()
+        self.assertEqual(MpesaCallback.objects.count(), 1)
+        callbacks.apply_all()
+        self.deliver(result_code=1032)          # a late failure can't undo the payment
+        callbacks.apply_all()
+        self.assertEqual(MpesaTransaction.objects.get().status, 'success')
+        self.assertEqual(MpesaCallback.objects.get(result_code='1032').outcome, 'duplicate')
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 2)
+
+    def test_batch_applies_many_payments(self):
+        orders = [self.order]
+        for n in range(2, 6):
+            orders.append(Order.objects.create(full_name='x', email='x@example.com', phone='0700000000',
+                                               subtotal=1, total=1))
+            MpesaTransaction.objects.create(order=orders[-1], checkout_request_id=f'ws_CO_{n}', amount=1,
+                                            phone='254712345678')
+        for n in range(1, 6):
+            self.deliver(f'ws_CO_{n}', result_code=0 if n % 2 else 1032)
+        self.assertEqual(callbacks.apply_pending(batch_size=100), 5)
+        self.assertEqual(
+            sorted(MpesaTransaction.objects.values_list('status', flat=True)),
+            ['failed', 'failed', 'success', 'success', 'success'],
+        )
+
+    def test_retry_success_and_first_failure_in_one_batch_leave_the_order_paid(self):
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_2', amount=1,
+                                        phone='254712345678')
+        self.deliver('ws_CO_2')                         # the retry is paid...
+        self.deliver('ws_CO_1', result_code=1032)       # ...before the first push reports its cancellation
+        self.assertEqual(callbacks.apply_pending(batch_size=100), 2)
+        self.order.refresh_from_db()
+        self.variant.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.status), ('paid', 'confirmed'))
+        self.assertEqual(self.variant.stock, 2)
+        self.assertEqual(StockReservation.objects.get().status, 'committed')    # not released
+
+    def test_callback_that_beats_its_transaction_is_requeued(self):
+        self.deliver('ws_CO_early')
+        callbacks.apply_all()
+        self.assertEqual(MpesaCallback.objects.get().outcome, 'unknown')
+        MpesaTransaction.objects.filter(checkout_request_id='ws_CO_1').update(checkout_request_id='ws_CO_early')
+        self.assertEqual(callbacks.requeue_unknown('ws_CO_early'), 1)
+        callbacks.apply_all()
+        self.assertEqual(MpesaTransaction.objects.get().status, 'success')
+
+    def test_replay_command_requeues_processed_callbacks(self):
+        self.deliver()
+        callbacks.apply_all()
+        MpesaTransaction.objects.update(status='pending')
+        call_command('replay_mpesa_callbacks', checkout_request_id=['ws_CO_1'], apply=True, stdout=StringIO())
+        self.assertEqual(MpesaTransaction.objects.get().status, 'success')
+
+
+
+class ReconcileTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        mpesa_tokens.invalidate()
+        paypal_tokens.invalidate()
+        stub = StubGateway().start()
+        self.addCleanup(stub.close)
+        self.stub = stub
+        settings_override = override_settings(
+            MPESA_BASE_URL=stub.url, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+            PAYPAL_BASE_URL=stub.url, PAYPAL_CLIENT_ID='id', PAYPAL_CLIENT_SECRET='secret',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def order(self):
+        return Order.objects.create(full_name='x', email='x@example.com', phone='0700000000', subtotal=1, total=1)
+
+    def mpesa(self, checkout_request_id, result_code=None):
+        if result_code is not None:
+            self.stub.stk_results[checkout_request_id] = result_code
+        return MpesaTransaction.objects.create(order=self.order(), checkout_request_id=checkout_request_id,
+                                               amount=1, phone='254712345678')
+
+    def paypal(self, paypal_order_id, status=None):
+        if status is not None:
+            self.stub.paypal_orders[paypal_order_id] = status
+        return PayPalTransaction.objects.create(order=self.order(), paypal_order_id=paypal_order_id, amount=1)
+
+    def reconcile(self, *args):
+        MpesaTransaction.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        PayPalTransaction.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        out = StringIO()
+        call_command('reconcile_payments', '--batch', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_stale_payments_are_settled_from_the_gateways(self):
+        self.mpesa('ws_CO_paid', 0)
+        self.mpesa('ws_CO_cancelled', 1032)
+        self.mpesa('ws_CO_waiting')
+        self.paypal('PP-APPROVED', 'APPROVED')
+        self.paypal('PP-COMPLETED', 'COMPLETED')
+        self.paypal('PP-CREATED', 'CREATED')
+        self.paypal('PP-EXPIRED')
+        out = self.reconcile()
+
+        statuses = dict(MpesaTransaction.objects.values_list('checkout_request_id', 'status'))
+        self.assertEqual(statuses, {'ws_CO_paid': 'success', 'ws_CO_cancelled': 'failed', 'ws_CO_waiting': 'pending'})
+        statuses = dict(PayPalTransaction.objects.values_list('paypal_order_id', 'status'))
+        self.assertEqual(statuses, {'PP-APPROVED': 'completed', 'PP-COMPLETED': 'completed',
+                                    'PP-CREATED': 'created', 'PP-EXPIRED': 'failed'})
+        self.assertEqual(self.stub.hits['orders.capture'], 1)
+        self.assertEqual(Order.objects.get(paypal_transactions__paypal_order_id='PP-APPROVED').payment_status, 'paid')
+        self.assertEqual(Order.objects.get(mpesa_transactions__checkout_request_id='ws_CO_cancelled').payment_status,
+                         'failed')
+        self.assertIn('mpesa             3        1        1        1        0', out)
+        self.assertIn('paypal            4        2        1        1        0', out)
+
+    def test_voided_sibling_does_not_undo_a_capture(self):
+        captured = self.paypal('PP-COMPLETED', 'COMPLETED')
+        PayPalTransaction.objects.create(order=captured.order, paypal_order_id='PP-VOIDED', amount=1)
+        self.stub.paypal_orders['PP-VOIDED'] = 'VOIDED'
+        _, variant = make_product(stock=3)
+        StockReservation.objects.create(order=captured.order, variant=variant, quantity=1,
+                                        expires_at=timezone.now() + timedelta(minutes=5))
+        self.reconcile()
+        captured.order.refresh_from_db()
+        variant.refresh_from_db()
+        self.assertEqual((captured.order.payment_status, captured.order.status), ('paid', 'confirmed'))
+        self.assertEqual((StockReservation.objects.get().status, variant.stock), ('committed', 2))
+
+    def test_real_callback_after_a_query_still_records_the_receipt(self):
+        tx = self.mpesa('ws_CO_paid', 0)
+        callbacks.record(mpesa_callback('ws_CO_other'))             # not the reconciler's to apply
+        self.reconcile()
+        tx.refresh_from_db()
+        self.assertEqual((tx.status, tx.mpesa_receipt), ('success', ''))
+        self.assertIsNone(MpesaCallback.objects.get(checkout_request_id='ws_CO_other').processed_at)
+
+        callbacks.record(mpesa_callback('ws_CO_paid'))
+        callbacks.apply_all()
+        tx.refresh_from_db()
+        self.assertEqual((tx.status, tx.mpesa_receipt, tx.order.mpesa_transaction_id), ('success', 'RCP123', 'RCP123'))
+        self.assertEqual(MpesaCallback.objects.get(checkout_request_id='ws_CO_paid', source='callback').outcome,
+                         'applied')
+
+    def test_recent_and_settled_payments_are_not_checked(self):
+        tx = self.mpesa('ws_CO_done', 0)
+        self.reconcile()
+        MpesaTransaction.objects.create(order=self.order(), checkout_request_id='ws_CO_new', amount=1, phone='254712345678')
+        with self.assertNumQueries(2):          # the two indexed scans, nothing else
+            call_command('reconcile_payments', stdout=StringIO())
+        self.assertEqual(self.stub.hits['stkquery'], 1)
+        tx.refresh_from_db()
+        self.assertEqual(tx.status, 'success')
+
+
+@override_settings(PAYMENT_STATUS_POLL_INTERVAL=60)
+class PaymentStatusWatchTests(TestCase):
+    def setUp(self):
+        product, variant = make_product()
+        self.user = make_shopper(product=product, variant=variant)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.order = Order.objects.get(id=client.post('/api/orders/', ORDER_PAYLOAD, format='json').data['id'])
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_1', amount=1, phone='254712345678')
+        self.factory = AsyncRequestFactory()
+        self.auth = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+
+    async def watch(self, headers=None, **params):
+        request = self.factory.get(f'/api/payments/status/{self.order.id}/watch/', params,
+                                   headers={**self.auth, **(headers or {})})
+        return await async_views.PaymentStatusWatchView.as_view()(request, order_id=self.order.id)
+
+    async def test_returns_at_once_without_a_current_version(self):
+        r = await self.watch(since='stale')
+        body = json.loads(r.content)
+        self.assertEqual(body['payment_status'], 'pending')
+        self.assertEqual(len(body['version']), 16)
+
+    async def test_publish_wakes_a_long_poll(self):
+        version = json.loads((await self.watch()).content)['version']
+        waiting = asyncio.ensure_future(self.watch(since=version, timeout=10))
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiting.done())
+
+        await callbacks.arecord(mpesa_callback('ws_CO_1'))
+        await sync_to_async(callbacks.apply_all)()
+        events.publish(self.order.id)           # on_commit doesn't fire inside TestCase
+        body = json.loads((await asyncio.wait_for(waiting, 2)).content)
+        self.assertEqual(body['payment_status'], 'paid')
+        self.assertNotEqual(body['version'], version)
+
+    async def test_long_poll_times_out_with_the_same_status(self):
+        version = json.loads((await self.watch()).content)['version']
+        body = json.loads((await self.watch(since=version, timeout=0.1)).content)
+        self.assertEqual(body['version'], version)
+
+    async def test_event_stream_sends_status_and_ends_once_settled(self):
+        await Order.objects.filter(id=self.order.id).aupdate(payment_status='paid')
+        r = await self.watch(headers={'Accept': 'text/event-stream'})
+        self.assertEqual(r['Content-Type'], 'text/event-stream')
+        chunks = [chunk async for chunk in r.streaming_content]
+        self.assertEqual(len(chunks), 1)
+        self.assertTrue(chunks[0].startswith(b'event: status\n'))
+        self.assertIn(b'"payment_status": "paid"', chunks[0])
+
+    def test_poll_wakes_watchers_of_changed_orders(self):
+        async def scenario():
+            order = await payments.status_queryset().aget(id=self.order.id)
+            watcher = events.subscribe(self.order.id, payments.status_stamp(order))
+            try:
+                self.assertEqual(await sync_to_async(events.poll_once)(), 0)
+                await Order.objects.filter(id=self.order.id).aupdate(updated_at=timezone.now())
+                self.assertEqual(await sync_to_async(events.poll_once)(), 1)
+                self.assertTrue(await watcher.wait(1))
+            finally:
+                events.unsubscribe(watcher)
+        async_to_sync(scenario)()
+
+    def test_failed_payment_marks_the_order(self):
+        callbacks.record(mpesa_callback('ws_CO_1', result_code=1032))
+        callbacks.apply_all()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'failed')
+        self.assertTrue(payments.is_settled(payments.payment_status(self.order)))
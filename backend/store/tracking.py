@@ -0,0 +1,197 @@
+"""
+Write-behind tracking of recently viewed products.
+
+A product page view used to write its RecentlyViewed row in the request,
+with a SELECT and an UPDATE or INSERT. ``record()`` now only notes
+(user or session, product, time) in this process's buffer. Repeat views of
+the same product by the same shopper collapse into one entry with the latest
+time.
+
+``flush()`` writes the buffer:
+
+* entries whose product or user has been deleted since are dropped, with
+  one lookup per type;
+* one bulk upsert for signed-in shoppers (keyed on user + product) and one
+  for anonymous sessions (keyed on session + product);
+* then each shopper it touched is trimmed to their newest
+  ``RECENTLY_VIEWED_KEEP`` rows, with one window query per owner type.
+
+The buffer is flushed once a request has finished (``request_finished``, so
+never inside the response), but only when it is due: it holds
+``RECENTLY_VIEWED_BUFFER_SIZE`` entries, or its oldest entry is
+``RECENTLY_VIEWED_FLUSH_INTERVAL`` seconds old. It is also flushed at
+interpreter exit, and before a shopper's own history is read
+(``flush_for()``). A worker killed outright loses at most one interval of
+views.
+
+The buffer never holds more than ``RECENTLY_VIEWED_BUFFER_MAX`` entries; views
+of new (shopper, product) pairs past that are dropped. A flush that fails is
+retried by the next one, up to ``RECENTLY_VIEWED_FLUSH_RETRIES`` times in a
+row, after which the buffered views are dropped.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+logger = logging.getLogger('store')
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_state = {'pending': {}, 'since': None, 'failures': 0, 'dropped': 0}    # pending: (user, session, product) -> when
+
+
+def record(product_id, user_id=None, session_key=None, when=None):
+    """Note that a shopper viewed ``product_id``; written by a later flush()."""
+    if user_id is None and not session_key:
+        return
+    key = (user_id, None if user_id is not None else session_key, product_id)
+    when = when or timezone.now()
+    with _lock:
+        pending = _state['pending']
+        if key not in pending and len(pending) >= settings.RECENTLY_VIEWED_BUFFER_MAX:
+            _state['dropped'] += 1
+            return
+        if key not in pending or pending[key] < when:
+            pending[key] = when
+        if _state['since'] is None:
+            _state['since'] = time.monotonic()
+
+
+def pending_count():
+    with _lock:
+        return len(_state['pending'])
+
+
+def _due():
+    with _lock:
+        if not _state['pending']:
+            return False
+        return (len(_state['pending']) >= settings.RECENTLY_VIEWED_BUFFER_SIZE
+                or time.monotonic() - _state['since'] >= settings.RECENTLY_VIEWED_FLUSH_INTERVAL)
+
+
+def _take():
+    with _lock:
+        pending, _state['pending'], _state['since'] = _state['pending'], {}, None
+        dropped, _state['dropped'] = _state['dropped'], 0
+    if dropped:
+        logger.warning(f'Recently viewed buffer was full: {dropped} views dropped')
+    return pending
+
+
+def _requeue(pending):
+    """Put a failed flush's entries back for the next one, unless it has failed too often in a row."""
+    with _lock:
+        _state['failures'] += 1
+        if _state['failures'] > settings.RECENTLY_VIEWED_FLUSH_RETRIES:
+            _state['failures'] = 0
+            return False
+        buffered = _state['pending']
+        for key, when in pending.items():
+            if key in buffered or len(buffered) < settings.RECENTLY_VIEWED_BUFFER_MAX:
+                buffered[key] = max(when, buffered.get(key, when))
+        if _state['since'] is None:
+            _state['since'] = time.monotonic()
+    return True
+
+
+def _live(pending):
+    """``pending`` without entries whose product or user no longer exists."""
+    from .models import Product, User
+
+    products = set(Product.objects.filter(pk__in={p for _, _, p in pending}).values_list('pk', flat=True))
+    user_ids = {u for u, _, _ in pending if u is not None}
+    users = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True)) if user_ids else set()
+    return {
+        (u, s, p): t for (u, s, p), t in pending.items() if p in products and (u is None or u in users)
+    }
+
+
+def _trim(owner, owners, keep):
+    """Delete all but the ``keep`` newest rows of each of ``owners`` (user ids or session keys)."""
+    from .models import RecentlyViewed
+
+    rows = RecentlyViewed.objects.filter(**{f'{owner}__in': owners})
+    if owner == 'session_key':
+        rows = rows.filter(user__isnull=True)
+    ranked = rows.annotate(rank=Window(RowNumber(), partition_by=[F(owner)], order_by=F('viewed_at').desc()))
+    stale = list(ranked.filter(rank__gt=keep).values_list('pk', flat=True))
+    if stale:
+        RecentlyViewed.objects.filter(pk__in=stale).delete()
+    return len(stale)
+
+
+def _write(pending):
+    """Upsert the live entries of ``pending`` and trim their shoppers; returns how many were written."""
+    from .models import RecentlyViewed
+
+    pending = _live(pending)
+    users = [RecentlyViewed(user_id=u, product_id=p, viewed_at=t) for (u, _, p), t in pending.items() if u is not None]
+    sessions = [RecentlyViewed(session_key=s, product_id=p, viewed_at=t) for (u, s, p), t in pending.items() if u is None]
+    keep = settings.RECENTLY_VIEWED_KEEP
+    with transaction.atomic():
+        if users:
+            RecentlyViewed.objects.bulk_create(
+                users, update_conflicts=True, unique_fields=['user', 'product'], update_fields=['viewed_at'],
+            )
+            _trim('user_id', {row.user_id for row in users}, keep)
+        if sessions:
+            RecentlyViewed.objects.bulk_create(
+                sessions, update_conflicts=True, unique_fields=['session_key', 'product'], update_fields=['viewed_at'],
+            )
+            _trim('session_key', {row.session_key for row in sessions}, keep)
+    return len(pending)
+
+
+def flush():
+    """Write everything buffered; returns how many entries were written."""
+    with _flush_lock:
+        pending = _take()
+        if not pending:
+            return 0
+        try:
+            written = _write(pending)
+        except IntegrityError as e:
+            # A product or user deleted between _live() and the upsert: the
+            # same entries would fail again, so drop them.
+            logger.warning(f'Recently viewed flush dropped {len(pending)} entries: {e}')
+            return 0
+        except DatabaseError as e:
+            # The database is away or locked: keep the entries for the next
+            # flush rather than failing a request.
+            kept = _requeue(pending)
+            logger.warning(f'Recently viewed flush of {len(pending)} entries failed'
+                           f'{"" if kept else ", dropping them after repeated failures"}: {e}')
+            return 0
+        with _lock:
+            _state['failures'] = 0
+    return written
+
+
+def flush_if_due(**kwargs):
+    if _due():
+        flush()
+
+
+def flush_for(user_id=None, session_key=None):
+    """Flush if ``user_id`` or ``session_key`` has views still buffered, so their history reads back whole."""
+    with _lock:
+        waiting = any(
+            (user_id is not None and u == user_id) or (user_id is None and session_key and s == session_key)
+            for u, s, _ in _state['pending']
+        )
+    if waiting:
+        flush()
+
+
+request_finished.connect(flush_if_due, dispatch_uid='store.tracking.flush_if_due')
+atexit.register(flush)
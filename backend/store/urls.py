@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenRefreshView
 
-from . import views
+from . import async_views, views
+
+# Under ASGI the async payment views stop gateway I/O from pinning a worker per request.
+payment_views = views
+if settings.ASYNC_PAYMENT_VIEWS:
+    from . import async_views as payment_views
 
 router = DefaultRouter()
 
@@ -29,6 +35,7 @@ urlpatterns = [
 
     # Homepage aggregated
     path('homepage/', views.HomepageView.as_view(), name='homepage'),
+    path('geography/bundle/', views.GeographyBundleView.as_view(), name='geography_bundle'),
 
     # Auth
     path('auth/register/', views.RegisterView.as_view(), name='register'),
@@ -38,14 +45,21 @@ urlpatterns = [
     path('auth/change-password/', views.ChangePasswordView.as_view(), name='change_password'),
 
     # Payments
-    path('payments/mpesa/stk-push/', views.MpesaSTKPushView.as_view(), name='mpesa_stk'),
-    path('payments/mpesa/callback/', views.MpesaCallbackView.as_view(), name='mpesa_callback'),
+    path('payments/mpesa/stk-push/', payment_views.MpesaSTKPushView.as_view(), name='mpesa_stk'),
+    path('payments/mpesa/callback/', payment_views.MpesaCallbackView.as_view(), name='mpesa_callback'),
     path('payments/mpesa/status/<uuid:order_id>/', views.MpesaStatusView.as_view(), name='mpesa_status'),
-    path('payments/paypal/create/', views.PayPalCreateOrderView.as_view(), name='paypal_create'),
-    path('payments/paypal/capture/', views.PayPalCaptureView.as_view(), name='paypal_capture'),
+    # Async either way: waiting requests park on the event loop, not a worker thread.
+    path('payments/status/<uuid:order_id>/watch/', async_views.PaymentStatusWatchView.as_view(),
+         name='payment_status_watch'),
+    path('payments/paypal/create/', payment_views.PayPalCreateOrderView.as_view(), name='paypal_create'),
+    path('payments/jobs/<uuid:job_id>/', views.JobStatusView.as_view(), name='job_status'),
+    path('payments/paypal/capture/', payment_views.PayPalCaptureView.as_view(), name='paypal_capture'),
 
     # Utilities
+    path('shipping/quote/', views.ShippingQuoteView.as_view(), name='shipping_quote'),
     path('coupons/validate/', views.CouponValidateView.as_view(), name='coupon_validate'),
     path('recently-viewed/', views.RecentlyViewedView.as_view(), name='recently_viewed'),
     path('exchange-rates/', views.ExchangeRateView.as_view(), name='exchange_rates'),
+    path('throttle/stats/', views.ThrottleStatsView.as_view(), name='throttle_stats'),
+    path('gateways/latency/', views.GatewayLatencyView.as_view(), name='gateway_latency'),
 ]
\ No newline at end of file
@@ -1,26 +1,27 @@
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
-from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.db.models import Q, Avg, Count
 from django_filters.rest_framework import DjangoFilterBackend
 from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.views import View
 from decimal import Decimal
-from datetime import datetime, timedelta
-import requests
-import base64
+from datetime import timedelta
 import logging
 
 from .models import (
     Country, County, PickupStation,
     Category, Brand, Product, ProductVariant, Review,
-    Banner, Cart, CartItem, Address, Order, OrderItem,
-    RecentlyViewed, UserProfile, Wishlist, Coupon,
-    MpesaTransaction, PayPalTransaction, ExchangeRate
+    Banner, Cart, CartItem, Address, Order,
+    RecentlyViewed, UserProfile, Wishlist,
+    PayPalTransaction, BackgroundJob
 )
 from .serializers import (
     CountrySerializer, CountySerializer, CountyListSerializer, PickupStationSerializer,
@@ -29,11 +30,17 @@ from .serializers import (
     ProductVariantSerializer, ReviewSerializer,
     BannerSerializer, CartSerializer, CartItemSerializer,
     AddressSerializer, OrderSerializer, OrderCreateSerializer,
-    UserSerializer, RegisterSerializer,
+    UserSerializer, RegisterSerializer, EMAIL_TAKEN,
     RecentlyViewedSerializer, WishlistSerializer,
     MpesaSTKSerializer, PayPalCreateOrderSerializer, PayPalCaptureSerializer,
-    CouponSerializer, ExchangeRateSerializer,
+    CouponSerializer, ExchangeRateSerializer, ShippingQuoteSerializer,
 )
+from .backends import users_with_email
+from . import (
+    callbacks, coupons, currency, events, gateways, geo, jobs, payments, reservations, shipping, throttling, tracking,
+)
+from .checkout import CheckoutError, place_order
+from .idempotency import idempotent
 
 logger = logging.getLogger('store')
 
@@ -65,6 +72,42 @@ class PickupStationViewSet(viewsets.ReadOnlyModelViewSet):
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['county__slug', 'county__country__code']
 
+    @action(detail=False, methods=['get'])
+    def nearest(self, request):
+        try:
+            lat = float(request.query_params['lat'])
+            lng = float(request.query_params['lng'])
+            k = int(request.query_params.get('k', 5))
+        except (KeyError, ValueError):
+            return Response({'error': 'lat and lng are required numbers; k must be a whole number.'}, status=400)
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            return Response({'error': 'lat must be within ±90 and lng within ±180.'}, status=400)
+        k = max(1, min(k, settings.PICKUP_NEAREST_MAX))
+        return Response(geo.nearest(lat, lng, k))
+
+
+class GeographyBundleView(View):
+    """
+    Countries, counties and pickup stations as one prebuilt document
+    (store/geo.py), gzipped when the client accepts it. A URL with
+    ``?v=<version>`` is cached for good. The bare URL is cached briefly,
+    then revalidated with the ETag.
+    """
+
+    def get(self, request):
+        bundle = geo.bundle()
+        gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+        response = HttpResponse(bundle.gzipped if gzipped else bundle.body, content_type='application/json')
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        response['ETag'] = f'"{bundle.version}-gzip"' if gzipped else f'"{bundle.version}"'
+        response['Vary'] = 'Accept-Encoding'
+        if request.GET.get('v') == bundle.version:
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = f'public, max-age={settings.GEOGRAPHY_BUNDLE_MAX_AGE}, must-revalidate'
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+
 
 # ─── Category ─────────────────────────────────────────────────────────────────
 
@@ -112,6 +155,7 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         'brand', 'category'
     ).prefetch_related('images', 'variants', 'reviews')
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    throttle_scope = None  # set per action
     filterset_fields = ['brand__slug', 'category__slug', 'is_featured',
                         'is_best_seller', 'is_new_arrival', 'is_prime', 'condition']
     search_fields = ['name', 'description', 'brand__name', 'tags', 'asin', 'sku']
@@ -126,17 +170,11 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
-        # Track recently viewed
+        # Track recently viewed (buffered, written in batches by tracking.flush())
         if request.user.is_authenticated:
-            RecentlyViewed.objects.update_or_create(
-                user=request.user, product=instance,
-                defaults={}
-            )
+            tracking.record(instance.pk, user_id=request.user.pk)
         elif request.session.session_key:
-            RecentlyViewed.objects.update_or_create(
-                session_key=request.session.session_key, product=instance,
-                defaults={}
-            )
+            tracking.record(instance.pk, session_key=request.session.session_key)
         return Response(ProductDetailSerializer(instance, context={'request': request}).data)
 
     @action(detail=True, methods=['get'])
@@ -206,7 +244,7 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         except Category.DoesNotExist:
             return Response({'error': 'Category not found'}, status=404)
 
-    @action(detail=False, methods=['get'])
+    @action(detail=False, methods=['get'], throttle_scope='search')
     def search(self, request):
         query = request.query_params.get('q', '')
         if not query:
@@ -364,181 +402,107 @@ class OrderViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Order.objects.filter(user=self.request.user).prefetch_related('items')
 
+    @idempotent
     def create(self, request):
         serializer = OrderCreateSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
-
-        data = serializer.validated_data
-
         try:
-            cart = Cart.objects.get(user=request.user)
-        except Cart.DoesNotExist:
-            return Response({'error': 'Your cart is empty.'}, status=400)
-
-        if not cart.items.exists():
-            return Response({'error': 'Your cart is empty.'}, status=400)
+            order = place_order(request, serializer.validated_data)
+        except CheckoutError as e:
+            return Response({'error': str(e)}, status=e.status)
+        return Response(OrderSerializer(order, context={'request': request}).data, status=201)
 
-        currency = data.get('currency', 'USD')
 
-        # Compute shipping fee
-        shipping_fee = Decimal('0')
-        if data.get('delivery_type') == 'pickup' and data.get('pickup_station_id'):
-            try:
-                station = PickupStation.objects.get(id=data['pickup_station_id'])
-                shipping_fee = station.delivery_fee_kes if currency == 'KES' else station.delivery_fee_usd
-            except PickupStation.DoesNotExist:
-                pass
-        else:
-            shipping_fee = Decimal('350') if currency == 'KES' else Decimal('3.00')
-
-        # Compute subtotal
-        subtotal = cart.total_kes if currency == 'KES' else cart.total_usd
-
-        # Apply coupon
-        discount = Decimal('0')
-        coupon_code = data.get('coupon_code', '').upper()
-        if coupon_code:
-            from django.utils import timezone
-            try:
-                coupon = Coupon.objects.get(
-                    code=coupon_code, is_active=True,
-                    valid_from__lte=timezone.now(), valid_until__gte=timezone.now()
-                )
-                if coupon.discount_type == 'percent':
-                    discount = subtotal * coupon.discount_value / 100
-                elif coupon.discount_type == 'fixed_usd' and currency == 'USD':
-                    discount = coupon.discount_value
-                elif coupon.discount_type == 'fixed_kes' and currency == 'KES':
-                    discount = coupon.discount_value
-                coupon.used_count += 1
-                coupon.save()
-            except Coupon.DoesNotExist:
-                return Response({'error': 'Invalid or expired coupon code.'}, status=400)
-
-        tax = subtotal * Decimal('0.16')  # 16% VAT
-        total = subtotal + shipping_fee + tax - discount
-
-        # Create order
-        order = Order.objects.create(
-            user=request.user,
-            full_name=data['full_name'],
-            email=data['email'],
-            phone=data['phone'],
-            payment_method=data['payment_method'],
-            currency=currency,
-            delivery_type=data.get('delivery_type', 'home'),
-            pickup_station_id=data.get('pickup_station_id'),
-            shipping_address=data.get('shipping_address', ''),
-            shipping_city=data.get('shipping_city', ''),
-            shipping_county_id=data.get('shipping_county_id'),
-            shipping_country_id=data.get('shipping_country_id'),
-            shipping_postal_code=data.get('shipping_postal_code', ''),
-            subtotal=subtotal,
-            shipping_fee=shipping_fee,
-            tax=tax,
-            discount=discount,
-            total=total,
-            mpesa_phone=data.get('mpesa_phone', ''),
-            notes=data.get('notes', ''),
-        )
+# ─── Shipping ─────────────────────────────────────────────────────────────────
 
-        # Create order items
-        for cart_item in cart.items.select_related('product', 'variant'):
-            price = cart_item.unit_price_kes if currency == 'KES' else cart_item.unit_price_usd
-            main_image = cart_item.product.main_image
-            image_url = ''
-            if main_image and main_image.image:
-                try:
-                    image_url = request.build_absolute_uri(main_image.image.url)
-                except Exception:
-                    pass
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                variant=cart_item.variant,
-                product_name=cart_item.product.name,
-                variant_name=cart_item.variant.name if cart_item.variant else '',
-                sku=cart_item.variant.sku if cart_item.variant else cart_item.product.sku,
-                image_url=image_url,
-                price=price,
-                quantity=cart_item.quantity,
-                currency=currency,
-            )
+class ShippingQuoteView(APIView):
+    """
+    Quote delivery for every cart × destination in one call, e.g. the user's
+    cart against home delivery to their county and each nearby station.
+    """
+    permission_classes = [AllowAny]
 
-        cart.items.all().delete()
-        return Response(OrderSerializer(order, context={'request': request}).data, status=201)
+    def post(self, request):
+        serializer = ShippingQuoteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        data = serializer.validated_data
+        currency = data['currency']
+        if 'carts' in data:
+            carts = [(cart['subtotal'], cart['weight_kg']) for cart in data['carts']]
+        elif request.user.is_authenticated:
+            items = CartItem.objects.filter(cart__user=request.user).select_related('product', 'variant__product')
+            carts = [shipping.cart_totals(items, currency)]
+        else:
+            return Response({'carts': ['Required unless signed in.']}, status=400)
+        if len(carts) * len(data['destinations']) > settings.SHIPPING_QUOTE_MAX_PAIRS:
+            return Response({'error': f'At most {settings.SHIPPING_QUOTE_MAX_PAIRS} cart × destination pairs.'},
+                            status=400)
+
+        quotes = []
+        for c, d, result in shipping.quote_many(currency, carts, data['destinations']):
+            if isinstance(result, shipping.ShippingError):
+                quotes.append({'cart': c, 'destination': d, 'available': False, 'error': str(result)})
+            else:
+                quotes.append({
+                    'cart': c, 'destination': d, 'available': True,
+                    'fee': result.fee, 'currency': currency, 'free': result.free, 'zone': result.zone,
+                    'eta_min': result.eta_min, 'eta_max': result.eta_max,
+                })
+        return Response({'quotes': quotes})
 
 
 # ─── Coupon ───────────────────────────────────────────────────────────────────
 
 class CouponValidateView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'coupon'
 
     def post(self, request):
-        from django.utils import timezone
-        code = request.data.get('code', '').upper()
-        cart_total = Decimal(str(request.data.get('cart_total', 0)))
         currency = request.data.get('currency', 'USD')
+        items = CartItem.objects.filter(cart__user=request.user).select_related('product', 'variant__product')
+        if items:
+            lines = [
+                (item.product.category_id, item.subtotal_kes if currency == 'KES' else item.subtotal_usd)
+                for item in items
+            ]
+        else:
+            lines = [(None, Decimal(str(request.data.get('cart_total', 0))))]
         try:
-            coupon = Coupon.objects.get(
-                code=code, is_active=True,
-                valid_from__lte=timezone.now(), valid_until__gte=timezone.now()
-            )
-            if coupon.max_uses and coupon.used_count >= coupon.max_uses:
-                return Response({'error': 'Coupon has reached its usage limit.'}, status=400)
-            if cart_total < coupon.min_order_value:
-                return Response({
-                    'error': f'Minimum order value for this coupon is {coupon.min_order_value}.'
-                }, status=400)
-            # Compute discount
-            if coupon.discount_type == 'percent':
-                discount = cart_total * coupon.discount_value / 100
-            elif coupon.discount_type == 'fixed_usd':
-                discount = coupon.discount_value
-            elif coupon.discount_type == 'fixed_kes':
-                discount = coupon.discount_value
-            else:
-                discount = Decimal('0')
-            return Response({
-                'valid': True,
-                'discount': float(discount),
-                'discount_type': coupon.discount_type,
-                'discount_value': float(coupon.discount_value),
-                'description': coupon.description,
-            })
-        except Coupon.DoesNotExist:
-            return Response({'error': 'Invalid coupon code.'}, status=400)
+            coupon = coupons.get_coupon(request.data.get('code', ''))
+            discount, _ = coupons.compute_discount(coupon, lines, currency)
+        except coupons.CouponError as e:
+            return Response({'error': str(e)}, status=400)
+        return Response({
+            'valid': True,
+            'discount': float(discount),
+            'discount_type': coupon.discount_type,
+            'discount_value': float(coupon.discount_value),
+            'description': coupon.description,
+        })
 
 
-# ─── M-Pesa ───────────────────────────────────────────────────────────────────
+# ─── Payments ─────────────────────────────────────────────────────────────────
 
-class MpesaSTKPushView(APIView):
+class JobStatusView(APIView):
     permission_classes = [IsAuthenticated]
 
-    def _get_access_token(self):
-        consumer_key = settings.MPESA_CONSUMER_KEY
-        consumer_secret = settings.MPESA_CONSUMER_SECRET
-        if not consumer_key or not consumer_secret:
-            raise ValueError('M-Pesa credentials not configured.')
-        auth = base64.b64encode(f"{consumer_key}:{consumer_secret}".encode()).decode()
+    def get(self, request, job_id):
         try:
-            r = requests.get(
-                f"{settings.MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
-                headers={"Authorization": f"Basic {auth}"},
-                timeout=30,
-            )
-            r.raise_for_status()
-            if not r.text.strip():
-                raise ValueError(f'Empty M-Pesa OAuth response (HTTP {r.status_code}).')
-            data = r.json()
-            token = data.get('access_token')
-            if not token:
-                raise ValueError(f'No access_token in response: {data}')
-            return token
-        except requests.exceptions.RequestException as e:
-            raise ValueError(f'M-Pesa OAuth failed: {e}')
+            job = BackgroundJob.objects.get(id=job_id, user=request.user)
+        except BackgroundJob.DoesNotExist:
+            return Response({'error': 'Job not found.'}, status=404)
+        return Response(jobs.progress(job))
+
 
+# ─── M-Pesa ───────────────────────────────────────────────────────────────────
+
+class MpesaSTKPushView(APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_scope = 'stk_push'
+
+    @idempotent
     def post(self, request):
         serializer = MpesaSTKSerializer(data=request.data)
         if not serializer.is_valid():
@@ -549,90 +513,16 @@ class MpesaSTKPushView(APIView):
             order = Order.objects.get(id=order_id, user=request.user)
         except Order.DoesNotExist:
             return Response({'error': 'Order not found.'}, status=404)
-        try:
-            token = self._get_access_token()
-        except ValueError as e:
-            return Response({'error': str(e)}, status=502)
-
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password = base64.b64encode(
-            f"{settings.MPESA_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}".encode()
-        ).decode()
-        # Amount must be in KES integers
-        amount = int(order.total) if order.currency == 'KES' else int(order.total * 130)
-        payload = {
-            "BusinessShortCode": settings.MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": amount,
-            "PartyA": phone,
-            "PartyB": settings.MPESA_SHORTCODE,
-            "PhoneNumber": phone,
-            "CallBackURL": settings.MPESA_CALLBACK_URL,
-            "AccountReference": order.order_number,
-            "TransactionDesc": f"Payment for {order.order_number}",
-        }
-        try:
-            r = requests.post(
-                f"{settings.MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest",
-                json=payload,
-                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-                timeout=30,
-            )
-            data = r.json()
-        except Exception as e:
-            return Response({'error': f'STK push failed: {e}'}, status=502)
-
-        if data.get('ResponseCode') == '0':
-            checkout_id = data['CheckoutRequestID']
-            MpesaTransaction.objects.create(
-                order=order,
-                checkout_request_id=checkout_id,
-                merchant_request_id=data.get('MerchantRequestID', ''),
-                amount=amount,
-                phone=phone,
-            )
-            order.mpesa_checkout_request_id = checkout_id
-            order.mpesa_phone = phone
-            order.status = 'payment_pending'
-            order.save()
-            return Response({
-                'message': 'STK push sent. Check your phone.',
-                'checkout_request_id': checkout_id,
-            })
-        return Response({'error': 'Failed to initiate payment', 'details': data}, status=400)
+        job = jobs.enqueue(payments.MPESA_STK_PUSH, {'phone': phone}, user=request.user, order=order)
+        return Response(payments.accepted(request, job, 'Sending the M-Pesa prompt to your phone.'), status=202)
 
 
 class MpesaCallbackView(APIView):
     permission_classes = [AllowAny]
 
     def post(self, request):
-        data = request.data
-        stk = data.get('Body', {}).get('stkCallback', {})
-        checkout_request_id = stk.get('CheckoutRequestID')
-        result_code = str(stk.get('ResultCode', ''))
-        result_desc = stk.get('ResultDesc', '')
-        try:
-            tx = MpesaTransaction.objects.get(checkout_request_id=checkout_request_id)
-            tx.result_code = result_code
-            tx.result_desc = result_desc
-            if result_code == '0':
-                items = {
-                    i['Name']: i.get('Value', '')
-                    for i in stk.get('CallbackMetadata', {}).get('Item', [])
-                }
-                tx.mpesa_receipt = items.get('MpesaReceiptNumber', '')
-                tx.status = 'success'
-                tx.order.payment_status = 'paid'
-                tx.order.status = 'confirmed'
-                tx.order.mpesa_transaction_id = tx.mpesa_receipt
-                tx.order.save()
-            else:
-                tx.status = 'failed'
-            tx.save()
-        except MpesaTransaction.DoesNotExist:
-            logger.warning(f'M-Pesa callback for unknown tx: {checkout_request_id}')
+        # Just store it; process_mpesa_callbacks applies the inbox in batches.
+        callbacks.record(request.data)
         return Response({'ResultCode': 0, 'ResultDesc': 'Accepted'})
 
 
@@ -642,12 +532,9 @@ class MpesaStatusView(APIView):
     def get(self, request, order_id):
         try:
             order = Order.objects.get(id=order_id, user=request.user)
-            return Response({
-                'payment_status': order.payment_status,
-                'order_status': order.status,
-            })
         except Order.DoesNotExist:
             return Response({'error': 'Order not found.'}, status=404)
+        return Response(payments.payment_status(order))
 
 
 # ─── PayPal ───────────────────────────────────────────────────────────────────
@@ -655,18 +542,7 @@ class MpesaStatusView(APIView):
 class PayPalCreateOrderView(APIView):
     permission_classes = [IsAuthenticated]
 
-    def _get_access_token(self):
-        client_id = settings.PAYPAL_CLIENT_ID
-        client_secret = settings.PAYPAL_CLIENT_SECRET
-        auth = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-        r = requests.post(
-            f"{settings.PAYPAL_BASE_URL}/v1/oauth2/token",
-            headers={"Authorization": f"Basic {auth}", "Content-Type": "application/x-www-form-urlencoded"},
-            data="grant_type=client_credentials",
-            timeout=30,
-        )
-        return r.json().get('access_token')
-
+    @idempotent
     def post(self, request):
         serializer = PayPalCreateOrderSerializer(data=request.data)
         if not serializer.is_valid():
@@ -677,48 +553,8 @@ class PayPalCreateOrderView(APIView):
         except Order.DoesNotExist:
             return Response({'error': 'Order not found.'}, status=404)
 
-        try:
-            token = self._get_access_token()
-            amount = str(order.total.quantize(Decimal('0.01')))
-            currency = order.currency if order.currency == 'USD' else 'USD'
-            payload = {
-                "intent": "CAPTURE",
-                "purchase_units": [{
-                    "reference_id": order.order_number,
-                    "amount": {"currency_code": currency, "value": amount},
-                    "description": f"Order {order.order_number}",
-                }],
-                "application_context": {
-                    "return_url": f"{settings.FRONTEND_URL}/checkout/success?order={order.id}",
-                    "cancel_url": f"{settings.FRONTEND_URL}/checkout/cancel?order={order.id}",
-                }
-            }
-            r = requests.post(
-                f"{settings.PAYPAL_BASE_URL}/v2/checkout/orders",
-                json=payload,
-                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-                timeout=30,
-            )
-            data = r.json()
-            if r.status_code == 201:
-                paypal_order_id = data['id']
-                approval_url = next(
-                    (link['href'] for link in data.get('links', []) if link['rel'] == 'approve'), None
-                )
-                PayPalTransaction.objects.create(
-                    order=order,
-                    paypal_order_id=paypal_order_id,
-                    amount=order.total,
-                    currency=currency,
-                    raw_response=data,
-                )
-                order.paypal_order_id = paypal_order_id
-                order.status = 'payment_pending'
-                order.save()
-                return Response({'paypal_order_id': paypal_order_id, 'approval_url': approval_url})
-            return Response({'error': 'PayPal order creation failed', 'details': data}, status=400)
-        except Exception as e:
-            return Response({'error': str(e)}, status=502)
+        job = jobs.enqueue(payments.PAYPAL_CREATE_ORDER, user=request.user, order=order)
+        return Response(payments.accepted(request, job, 'Creating your PayPal order.'), status=202)
 
 
 class PayPalCaptureView(APIView):
@@ -736,21 +572,7 @@ class PayPalCaptureView(APIView):
             return Response({'error': 'Order not found.'}, status=404)
 
         try:
-            client_id = settings.PAYPAL_CLIENT_ID
-            client_secret = settings.PAYPAL_CLIENT_SECRET
-            auth = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-            token_r = requests.post(
-                f"{settings.PAYPAL_BASE_URL}/v1/oauth2/token",
-                headers={"Authorization": f"Basic {auth}", "Content-Type": "application/x-www-form-urlencoded"},
-                data="grant_type=client_credentials", timeout=30,
-            )
-            token = token_r.json().get('access_token')
-            r = requests.post(
-                f"{settings.PAYPAL_BASE_URL}/v2/checkout/orders/{paypal_order_id}/capture",
-                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-                timeout=30,
-            )
-            data = r.json()
+            _, data = gateways.paypal_capture(paypal_order_id, request_id=f'capture-{paypal_order_id}')
             if data.get('status') == 'COMPLETED':
                 capture_id = data['purchase_units'][0]['payments']['captures'][0]['id']
                 try:
@@ -765,7 +587,10 @@ class PayPalCaptureView(APIView):
                 order.status = 'confirmed'
                 order.paypal_capture_id = capture_id
                 order.save()
+                reservations.commit(order)
+                events.publish(order.id)
                 return Response({'status': 'success', 'capture_id': capture_id})
+            payments.paypal_capture_failed(order, paypal_order_id, data)
             return Response({'error': 'Payment capture failed', 'details': data}, status=400)
         except Exception as e:
             return Response({'error': str(e)}, status=502)
@@ -775,6 +600,7 @@ class PayPalCaptureView(APIView):
 
 class RegisterView(APIView):
     permission_classes = [AllowAny]
+    throttle_scope = 'register'
 
     def post(self, request):
         serializer = RegisterSerializer(data=request.data)
@@ -790,16 +616,12 @@ class RegisterView(APIView):
 
 class LoginView(APIView):
     permission_classes = [AllowAny]
+    throttle_scope = 'login'
 
     def post(self, request):
         email = request.data.get('email', '')
         password = request.data.get('password', '')
-        try:
-            user_obj = User.objects.get(email=email)
-            username = user_obj.username
-        except User.DoesNotExist:
-            username = email
-        user = authenticate(username=username, password=password)
+        user = authenticate(request, username=email, password=password)
         if user and user.is_active:
             refresh = RefreshToken.for_user(user)
             return Response({
@@ -817,10 +639,17 @@ class ProfileView(APIView):
 
     def patch(self, request):
         user = request.user
+        if request.data.get('email') and users_with_email(request.data['email']).exclude(pk=user.pk).exists():
+            return Response({'email': [EMAIL_TAKEN]}, status=400)
         for field in ['first_name', 'last_name', 'email']:
             if field in request.data:
                 setattr(user, field, request.data[field])
-        user.save()
+        try:
+            with transaction.atomic():
+                user.save()
+        except IntegrityError:
+            # Lost a race with another account taking the same email.
+            return Response({'email': [EMAIL_TAKEN]}, status=400)
         profile, _ = UserProfile.objects.get_or_create(user=user)
         for field in ['phone', 'preferred_currency', 'newsletter_subscribed']:
             if field in request.data:
@@ -876,20 +705,40 @@ class WishlistViewSet(viewsets.ViewSet):
 class RecentlyViewedView(APIView):
     def get(self, request):
         if request.user.is_authenticated:
+            tracking.flush_for(user_id=request.user.pk)
             items = RecentlyViewed.objects.filter(user=request.user)[:10]
         elif request.session.session_key:
+            tracking.flush_for(session_key=request.session.session_key)
             items = RecentlyViewed.objects.filter(session_key=request.session.session_key)[:10]
         else:
             items = []
         return Response(RecentlyViewedSerializer(items, many=True, context={'request': request}).data)
 
 
+# ─── Throttling ───────────────────────────────────────────────────────────────
+
+class ThrottleStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(throttling.counters())
+
+
+# ─── Gateway Latency ──────────────────────────────────────────────────────────
+
+class GatewayLatencyView(APIView):
+    """Latency histograms of this worker's gateway calls; ``run_jobs`` logs its own."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(gateways.latency_snapshot())
+
+
 # ─── Exchange Rate ────────────────────────────────────────────────────────────
 
 class ExchangeRateView(APIView):
     def get(self, request):
-        rates = ExchangeRate.objects.all()
-        return Response(ExchangeRateSerializer(rates, many=True).data)
+        return Response(ExchangeRateSerializer(currency.rows(), many=True).data)
 
 
 # ─── Homepage Aggregated Data ─────────────────────────────────────────────────
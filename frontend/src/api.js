@@ -100,7 +100,11 @@ export const cancelOrder    = (id)             => api.post(`/orders/${id}/cancel
 // ── Payments ──────────────────────────────────────────────
 export const mpesaSTKPush       = (data)       => api.post('/payments/mpesa/stk-push/', data);
 export const getMpesaStatus     = (orderId)    => api.get(`/payments/mpesa/status/${orderId}/`);
+// Long poll: answers as soon as the status differs from `since` (or after ~25s unchanged)
+export const watchPaymentStatus = (orderId, since) =>
+  api.get(`/payments/status/${orderId}/watch/`, { params: { since, timeout: 25 }, timeout: 35000 });
 export const paypalCreateOrder  = (data)       => api.post('/payments/paypal/create/', data);
+export const getPaymentJob      = (jobId)      => api.get(`/payments/jobs/${jobId}/`);
 export const paypalCapture      = (data)       => api.post('/payments/paypal/capture/', data);
 
 // ── Utilities ─────────────────────────────────────────────
@@ -108,8 +112,13 @@ export const validateCoupon     = (code, cartTotal, currency) =>
   api.post('/coupons/validate/', { code, cart_total: cartTotal, currency });  // ✅ FIXED: matches CouponValidateView params
 export const getRecentlyViewed  = ()             => api.get('/recently-viewed/');
 export const getExchangeRates   = ()             => api.get('/exchange-rates/');
+export const quoteShipping      = (data)         => api.post('/shipping/quote/', data);
 
 // ── Geography ─────────────────────────────────────────────
 export const getCountries       = ()           => api.get('/countries/');
 export const getCounties        = (params)     => api.get('/counties/', { params });
-export const getPickupStations  = (params)     => api.get('/pickup-stations/', { params });
\ No newline at end of file
+export const getPickupStations  = (params)     => api.get('/pickup-stations/', { params });
+// Countries, counties and stations in one cached document; `version` pins a URL that never changes.
+export const getGeographyBundle = (version)    => api.get('/geography/bundle/', { params: version ? { v: version } : {} });
+export const getNearestPickupStations = (lat, lng, k = 5) =>
+  api.get('/pickup-stations/nearest/', { params: { lat, lng, k } });
\ No newline at end of file
@@ -7,11 +7,13 @@ import { useToast } from '../context/ToastContext';
 import {
   createOrder,
   mpesaSTKPush,        // ✅ was: mpesaStkPush
-  getMpesaStatus,      // ✅ was: mpesaStatus
+  watchPaymentStatus,
+  getPaymentJob,
   paypalCreateOrder,
   validateCoupon,
-  getCounties,
-  getPickupStations,
+  getGeographyBundle,
+  getNearestPickupStations,
+  quoteShipping,
 } from '../api';
 import { Spinner } from '../components/common/index.jsx';
 
@@ -26,10 +28,12 @@ export default function CheckoutPage() {
   const [step, setStep] = useState(0);
   const [counties, setCounties] = useState([]);
   const [stations, setStations] = useState([]);
+  const [allStations, setAllStations] = useState([]);
   const [loading, setLoading] = useState(false);
   const [couponCode, setCouponCode] = useState('');
   const [couponData, setCouponData] = useState(null);
   const [mpesaPolling, setMpesaPolling] = useState(false);
+  const [delivery, setDelivery] = useState(null);
 
   const [form, setForm] = useState({
     full_name: user ? `${user.first_name || ''} ${user.last_name || ''}`.trim() : '',
@@ -46,21 +50,41 @@ export default function CheckoutPage() {
     notes: '',
   });
 
+  // The whole geography comes in one cached request; stations are filtered per county locally.
   useEffect(() => {
-    getCounties().then(r => setCounties(r.data.results || r.data)).catch(() => {});
+    getGeographyBundle().then(r => {
+      setCounties(r.data.counties);
+      setAllStations(r.data.stations);
+    }).catch(() => {});
   }, []);
 
   useEffect(() => {
     if (form.shipping_county_id) {
-      const county = counties.find(c => c.id === Number(form.shipping_county_id));
-      if (county) {
-        // ✅ getPickupStations takes params object, not a plain string
-        getPickupStations({ 'county__slug': county.slug })
-          .then(r => setStations(r.data.results || r.data))
-          .catch(() => {});
-      }
+      setStations(allStations.filter(s => s.county_id === Number(form.shipping_county_id)));
+    }
+  }, [form.shipping_county_id, allStations]);
+
+  const useMyLocation = () => {
+    navigator.geolocation?.getCurrentPosition(({ coords }) => {
+      getNearestPickupStations(coords.latitude, coords.longitude)
+        .then(r => setStations(r.data))
+        .catch(() => {});
+    });
+  };
+
+  // One batch call prices the chosen delivery option (and re-prices when the cart changes).
+  useEffect(() => {
+    const destination = form.delivery_type === 'pickup'
+      ? { delivery_type: 'pickup', pickup_station_id: Number(form.pickup_station_id) || null }
+      : { delivery_type: 'home', county_id: Number(form.shipping_county_id) || null };
+    if (destination.delivery_type === 'pickup' && !destination.pickup_station_id) {
+      setDelivery(null);
+      return;
     }
-  }, [form.shipping_county_id, counties]);
+    quoteShipping({ currency: form.currency, destinations: [destination] })
+      .then(r => setDelivery(r.data.quotes[0]))
+      .catch(() => setDelivery(null));
+  }, [form.delivery_type, form.pickup_station_id, form.shipping_county_id, form.currency, cart?.total_kes]);
 
   const set = (k, v) => setForm(f => ({ ...f, [k]: v }));
 
@@ -68,7 +92,7 @@ export default function CheckoutPage() {
 
   const subtotal = Number(cart?.total_kes || 0);
   const couponDiscount = couponData ? Number(couponData.discount || 0) : 0;
-  const shipping = form.delivery_type === 'pickup' ? 0 : 350;
+  const shipping = delivery?.available ? Number(delivery.fee) : 0;
   const tax = subtotal * 0.16;
   const total = subtotal + shipping + tax - couponDiscount;
 
@@ -111,34 +135,43 @@ export default function CheckoutPage() {
           await mpesaSTKPush({ phone: form.mpesa_phone, order_id: order.id });
           showToast('M-Pesa prompt sent! Check your phone.', 'success');
           setMpesaPolling(true);
-          let tries = 0;
-          const poll = setInterval(async () => {
-            tries++;
-            try {
-              const { data: status } = await getMpesaStatus(order.id);
-              if (status.payment_status === 'paid') {
-                clearInterval(poll);
-                setMpesaPolling(false);
+          const deadline = Date.now() + 90000;
+          let status = {};
+          try {
+            while (Date.now() < deadline) {
+              ({ data: status } = await watchPaymentStatus(order.id, status.version));
+              if (status.job?.status === 'dead') {
+                showToast(status.job.error || 'M-Pesa push failed. You can pay from your orders page.', 'error');
+                break;
+              } else if (status.payment_status === 'paid') {
                 fetchCart();
                 navigate(`/orders/${order.id}?success=1`);
-              } else if (tries >= 20) {
-                clearInterval(poll);
-                setMpesaPolling(false);
-                navigate(`/orders/${order.id}`);
+                return;
+              } else if (status.payment_status === 'failed') {
+                showToast('M-Pesa payment was not completed. You can retry from your orders page.', 'error');
+                break;
               }
-            } catch {
-              clearInterval(poll);
-              setMpesaPolling(false);
             }
-          }, 3000);
+          } catch {
+            // fall through to the order page, which shows the latest status
+          } finally {
+            setMpesaPolling(false);
+          }
+          navigate(`/orders/${order.id}`);
         } catch (e) {
           showToast(e.response?.data?.error || 'M-Pesa push failed. You can pay from your orders page.', 'error');
           navigate(`/orders/${order.id}`);
         }
       } else if (form.payment_method === 'paypal') {
-        const { data: pp } = await paypalCreateOrder({ order_id: order.id });
-        if (pp.approval_url) window.location.href = pp.approval_url;
-        else showToast('Could not get PayPal URL', 'error');
+        // Order creation runs as a background job: poll it until PayPal hands back the approval URL.
+        const { data: queued } = await paypalCreateOrder({ order_id: order.id });
+        let job = queued;
+        for (let tries = 0; job.status !== 'succeeded' && job.status !== 'dead' && tries < 30; tries++) {
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          ({ data: job } = await getPaymentJob(queued.job_id));
+        }
+        if (job.result?.approval_url) window.location.href = job.result.approval_url;
+        else showToast(job.error || 'Could not get PayPal URL', 'error');
       } else {
         // COD or card
         fetchCart();
@@ -324,12 +357,21 @@ export default function CheckoutPage() {
                         <option value="">-- Select Station --</option>
                         {stations.map(s => (
                           <option key={s.id} value={s.id}>
-                            {s.name} — KES {fmtKes(s.delivery_fee_kes)} | {s.operating_hours}
+                            {s.name}{s.distance_km != null ? ` (${s.distance_km} km)` : ''} — KES {fmtKes(s.delivery_fee_kes)} | {s.operating_hours}
                           </option>
                         ))}
                       </select>
                     </div>
                   )}
+                  {form.delivery_type === 'pickup' && navigator.geolocation && (
+                    <button
+                      type="button"
+                      onClick={useMyLocation}
+                      style={{ background: 'none', border: 'none', padding: 0, marginTop: 6, color: '#007185', fontSize: '.85rem', cursor: 'pointer' }}
+                    >
+                      <i className="bi bi-geo-alt" /> Show stations nearest to me
+                    </button>
+                  )}
                   {form.delivery_type === 'pickup' && form.shipping_county_id && stations.length === 0 && (
                     <div className="alert alert-info" style={{ marginTop: 8 }}>
                       <i className="bi bi-info-circle" /> No pickup stations found in this county.
@@ -642,7 +684,10 @@ export default function CheckoutPage() {
               <div style={{ borderTop: '1px solid #f0f0f0', paddingTop: 10 }}>
                 {[
                   { label: `Items (${cart.item_count})`, value: `KES ${fmtKes(subtotal)}` },
-                  { label: 'Shipping', value: shipping === 0 ? 'FREE' : `KES ${fmtKes(shipping)}`, green: shipping === 0 },
+                  delivery && !delivery.available
+                    ? { label: 'Shipping', value: delivery.error }
+                    : { label: 'Shipping', value: shipping === 0 ? 'FREE' : `KES ${fmtKes(shipping)}`, green: shipping === 0 },
+                  ...(delivery?.available ? [{ label: 'Arrives', value: `${delivery.eta_min} – ${delivery.eta_max}` }] : []),
                   { label: 'VAT (16%)', value: `KES ${fmtKes(tax)}` },
                   ...(couponDiscount > 0 ? [{ label: 'Discount', value: `− KES ${fmtKes(couponDiscount)}`, green: true }] : []),
                 ].map(row => (